@@ -2,10 +2,23 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.server.core.env_variables import local_config
+from app.server.db_utils.bot_user import refresh_bot_user_search, create_bot_user_indexes, \
+    refresh_last_message_previews
+from app.server.db_utils.conversation_summary import refresh_conversation_summaries, \
+    create_conversation_summary_indexes
+from app.server.db_utils.dashboard.confidence import refresh_confidence_sketches
+from app.server.db_utils.dashboard.distinct import refresh_distinct_counters
+from app.server.db_utils.dashboard.enrichment import enrich_new_messages, create_enrichment_indexes
+from app.server.db_utils.dashboard.rollup import refresh_dashboard_daily
+from app.server.db_utils.dashboard.word_cloud import refresh_word_cloud, create_word_cloud_indexes
+from app.server.db_utils.grading_clusters import refresh_grading_clusters, create_grading_cluster_indexes
+from app.server.db_utils.grading_queue import refresh_grading_queue, create_grading_queue_indexes
+from app.server.db_utils.message_search import refresh_message_index, create_message_index_indexes
 # from .internal import admin
 # from app.server.db.client import connect_to_mongo, close_mongo_connection, get_database
 from app.server.routers import items, users, students, login, questions, flows, bot, broadcasts, upload, conversations, \
     bot_user, grading, dashboard
+from app.server.utils.scheduler import run_periodically
 
 app = FastAPI()
 print(local_config.ALLOWED_HOSTS)
@@ -19,6 +32,7 @@ app.add_middleware(
 )
 
 # app.add_event_handler("startup", connect_to_mongo)
+
 app.include_router(users.router)
 app.include_router(items.router)
 app.include_router(students.router)
@@ -46,6 +60,28 @@ app.include_router(dashboard.router)
 # )
 
 
+@app.on_event("startup")
+async def start_background_jobs():
+    await create_word_cloud_indexes()
+    await create_enrichment_indexes()
+    await create_bot_user_indexes()
+    await create_message_index_indexes()
+    await create_conversation_summary_indexes()
+    await create_grading_queue_indexes()
+    await create_grading_cluster_indexes()
+    run_periodically(refresh_dashboard_daily, interval=60)
+    run_periodically(refresh_word_cloud, interval=60)
+    run_periodically(refresh_confidence_sketches, interval=60)
+    run_periodically(refresh_distinct_counters, interval=60)
+    run_periodically(enrich_new_messages, interval=60)
+    run_periodically(refresh_bot_user_search, interval=60)
+    run_periodically(refresh_last_message_previews, interval=60)
+    run_periodically(refresh_message_index, interval=60)
+    run_periodically(refresh_conversation_summaries, interval=60)
+    run_periodically(refresh_grading_queue, interval=60)
+    run_periodically(refresh_grading_clusters, interval=60)
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello Bigger Applications!"}
@@ -16,6 +16,19 @@ portal_user_group_collection: AgnosticCollection = db.get_collection('portal_use
 broadcast_template_collection: AgnosticCollection = db.get_collection('broadcast_template', codec_options=codec_options)
 broadcast_collection: AgnosticCollection = db.get_collection('broadcast', codec_options=codec_options)
 message_collection: AgnosticCollection = db.get_collection('message', codec_options=codec_options)
+dashboard_daily_collection: AgnosticCollection = db.get_collection('dashboard_daily', codec_options=codec_options)
+job_state_collection: AgnosticCollection = db.get_collection('job_state', codec_options=codec_options)
+term_frequency_collection: AgnosticCollection = db.get_collection('term_frequency', codec_options=codec_options)
+nlp_confidence_daily_collection: AgnosticCollection = db.get_collection('nlp_confidence_daily',
+                                                                        codec_options=codec_options)
+distinct_daily_collection: AgnosticCollection = db.get_collection('distinct_daily', codec_options=codec_options)
+message_postings_collection: AgnosticCollection = db.get_collection('message_postings', codec_options=codec_options)
+message_terms_collection: AgnosticCollection = db.get_collection('message_terms', codec_options=codec_options)
+conversation_collection: AgnosticCollection = db.get_collection('conversation', codec_options=codec_options)
+grading_queue_collection: AgnosticCollection = db.get_collection('grading_queue', codec_options=codec_options)
+grading_cluster_collection: AgnosticCollection = db.get_collection('grading_cluster', codec_options=codec_options)
+dashboard_day_cache_collection: AgnosticCollection = db.get_collection('dashboard_day_cache',
+                                                                       codec_options=codec_options)
 
 # test
 student_user_collection = db['students_collection']
@@ -1,9 +1,33 @@
-from bson import ObjectId
+from re import escape
 
-from app.server.db.collections import bot_user_collection as collection
-from app.server.db_utils.helper import bot_user_helper
+from bson import ObjectId, Regex
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from app.server.db.collections import bot_user_collection as collection, message_collection
+from app.server.db_utils.helper import bot_user_helper, message_preview
+from app.server.db_utils.watermark import iterate_new_documents, iterate_new_messages, reset_job_state, \
+    leased_job, get_job_state, update_job_state, settled_id, CHANGE_STREAM_HISTORY_LOST, \
+    CHANGE_STREAMS_UNSUPPORTED
 from app.server.models.bot_user import BotUserSchemaDb, BotUserBasicSchemaDb, BotUserUpdateModel
 from app.server.utils.common import form_query
+from app.server.utils.tokenizer import name_tokens, prefix_tokens
+
+BOT_USER_SEARCH_JOB = 'bot_user_search'
+BOT_USER_SEARCH_BATCHES_PER_RUN = 20
+SEARCH_PREFIX_LENGTH = 15
+LAST_MESSAGE_PREVIEW_JOB = 'bot_user_last_message_preview'
+LAST_MESSAGE_PREVIEW_BATCHES_PER_RUN = 20
+PREVIEW_TEXT_LENGTH = 100
+
+# renames and replacements of bot users, their names are all the search fields need
+NAME_CHANGE_PIPELINE = [
+    {"$match": {"$or": [{"operationType": "replace"},
+                        {"updateDescription.updatedFields.first_name": {"$exists": True}},
+                        {"updateDescription.updatedFields.last_name": {"$exists": True}},
+                        {"updateDescription.removedFields": {"$in": ["first_name", "last_name"]}}]}},
+    {"$project": {"fullDocument._id": 1, "fullDocument.first_name": 1, "fullDocument.last_name": 1}},
+]
 
 
 async def get_bot_user_tags_db() -> list:
@@ -55,10 +79,184 @@ async def get_bot_user_db(user_id: str) -> BotUserSchemaDb:
     return BotUserSchemaDb(**bot_user_helper(await collection.find_one(query)))
 
 
+async def get_bot_user_names(ids: list) -> dict[str, str]:
+    """
+    {id: full name} of every bot user of `ids` found, in one query
+    """
+    query = {"_id": {"$in": list({ObjectId(_id) for _id in ids})}}
+    return {str(user['_id']): ' '.join(filter(None, [user.get('first_name'), user.get('last_name')]))
+            async for user in collection.find(query, projection={"first_name": 1, "last_name": 1})}
+
+
 async def update_bot_user_db(user_id: str, update: BotUserUpdateModel):
     db_key = [("tags", update.tags if update.tags else ...),
               ("chatbot.note", update.note if update.note else ...)]
     query = form_query(db_key)
     new_values = {"$set": query}
     result = await collection.update_one({"_id": ObjectId(user_id)}, new_values)
+    await update_bot_user_search(user_id)
     return f"Updated {result.modified_count} bot user."
+
+
+def bot_user_search_fields(user: dict) -> dict:
+    """
+    # Search key of a bot user: the lowercased, accent folded full name and every prefix of its words
+    :return:
+    """
+    tokens = name_tokens(' '.join(filter(None, [user.get('first_name'), user.get('last_name')])))
+    return {"search.name": ' '.join(tokens), "search.tokens": prefix_tokens(tokens, SEARCH_PREFIX_LENGTH)}
+
+
+def bot_user_search_query(search_query: str) -> dict:
+    """
+    Users having a name word starting with each word of the search, answered by the `search.tokens` index. A search
+    without any word matches no user.
+    """
+    tokens = name_tokens(search_query)
+    if not tokens:
+        return {"_id": {"$in": []}}
+    query = {"search.tokens": {"$all": sorted({token[:SEARCH_PREFIX_LENGTH] for token in tokens})}}
+    if long_tokens := [token for token in tokens if len(token) > SEARCH_PREFIX_LENGTH]:
+        # prefixes are truncated, check the rest of long words on the already narrowed users
+        query["$and"] = [{"search.name": Regex(rf"\b{escape(token)}")} for token in long_tokens]
+    return query
+
+
+async def create_bot_user_indexes():
+    await collection.create_index([("search.tokens", 1)])
+    # conversation list order
+    await collection.create_index([("last_active.received_at", -1), ("_id", -1)])
+
+
+async def update_bot_user_search(user_id: str):
+    if user := await collection.find_one({"_id": ObjectId(user_id)}, projection={"first_name": 1, "last_name": 1}):
+        await collection.update_one({"_id": user['_id']}, {"$set": bot_user_search_fields(user)})
+
+
+async def sync_renamed_bot_users(*, batch_size: int = 1000) -> int:
+    """
+    Rewrite the search fields of users renamed since the last run, read from a change stream resumed from the token
+    kept in the job state. When the stream history is lost (the oplog rolled over) the job state is reset, so every
+    user is indexed again. A standalone server has no change streams, renames are then only synced by
+    `update_bot_user_search`.
+    """
+    state = await get_job_state(BOT_USER_SEARCH_JOB)
+    renamed = 0
+    try:
+        async with collection.watch(NAME_CHANGE_PIPELINE, full_document='updateLookup',
+                                    resume_after=state.get('resume_token')) as stream:
+            for _ in range(BOT_USER_SEARCH_BATCHES_PER_RUN):
+                changes = []
+                while len(changes) < batch_size and (change := await stream.try_next()):
+                    changes.append(change)
+                requests = [UpdateOne({"_id": change['fullDocument']['_id']},
+                                      {"$set": bot_user_search_fields(change['fullDocument'])})
+                            for change in changes if change.get('fullDocument')]
+                if requests:
+                    await collection.bulk_write(requests, ordered=False)
+                    renamed += len(requests)
+                await update_job_state(BOT_USER_SEARCH_JOB, resume_token=stream.resume_token)
+                if len(changes) < batch_size:
+                    break
+    except OperationFailure as e:
+        if e.code == CHANGE_STREAMS_UNSUPPORTED:
+            return renamed
+        if e.code != CHANGE_STREAM_HISTORY_LOST:
+            raise
+        await reset_job_state(BOT_USER_SEARCH_JOB)
+    return renamed
+
+
+@leased_job(BOT_USER_SEARCH_JOB)
+async def refresh_bot_user_search(*, batch_size: int = 1000) -> str:
+    """
+    Write the search fields of bot users renamed or created since the last run, the first run backfills every user.
+    Renames are synced first, a user created meanwhile is indexed with its current name anyway.
+    """
+    renamed = await sync_renamed_bot_users(batch_size=batch_size)
+    indexed = 0
+    async for users in iterate_new_documents(BOT_USER_SEARCH_JOB, collection,
+                                             projection={"first_name": 1, "last_name": 1},
+                                             batch_size=batch_size, max_batches=BOT_USER_SEARCH_BATCHES_PER_RUN):
+        requests = [UpdateOne({"_id": user['_id']}, {"$set": bot_user_search_fields(user)}) for user in users]
+        await collection.bulk_write(requests, ordered=False)
+        indexed += len(users)
+    return f"Indexed {indexed} bot users and {renamed} renamed ones."
+
+
+@leased_job(BOT_USER_SEARCH_JOB)
+async def rebuild_bot_user_search() -> str:
+    await reset_job_state(BOT_USER_SEARCH_JOB)
+    return await refresh_bot_user_search()
+
+
+def last_message_preview(message: dict) -> dict:
+    """
+    What the conversation list shows of the last message of a user, kept on the bot user so listing needs no join
+    """
+    return {"id": message['_id'],
+            "text": message_preview(message)[:PREVIEW_TEXT_LENGTH],
+            "type": message.get('type'),
+            "handler": message.get('handler'),
+            "created_at": message['created_at']}
+
+
+async def backfill_last_message_previews(*, batch_size: int = 1000) -> int:
+    """
+    Store the preview of the last message of every user with one $sort/$group pass over the messages, then move
+    the job's watermark past them. Previews are overwritten, never removed first, so the conversation list stays
+    full meanwhile.
+    """
+    upper = settled_id()
+    pipeline = [{"$match": {"handler": "bot", "sender_id": {"$exists": True}, "_id": {"$lt": upper}}},
+                {"$sort": {"sender_id": 1, "_id": 1}},
+                {"$group": {"_id": "$sender_id", "message": {"$last": {
+                    "_id": "$_id", "created_at": "$created_at", "handler": "$handler", "type": "$type",
+                    "data": {"text": "$data.text"}}}}}]
+    updated = 0
+    requests = []
+    async for user in message_collection.aggregate(pipeline, allowDiskUse=True):
+        requests.append(UpdateOne({"_id": user['_id']},
+                                  {"$set": {"last_message_preview": last_message_preview(user['message'])}}))
+        if len(requests) == batch_size:
+            await collection.bulk_write(requests, ordered=False)
+            updated += len(requests)
+            requests = []
+    if requests:
+        await collection.bulk_write(requests, ordered=False)
+        updated += len(requests)
+    await update_job_state(LAST_MESSAGE_PREVIEW_JOB, last_message_id=upper)
+    return updated
+
+
+@leased_job(LAST_MESSAGE_PREVIEW_JOB)
+async def refresh_last_message_previews(*, batch_size: int = 1000) -> str:
+    """
+    Store the preview of the messages received from users since the last run on their bot user, the first run
+    backfills every user in one pass. An older message never replaces a newer preview.
+    """
+    if not (await get_job_state(LAST_MESSAGE_PREVIEW_JOB)).get('last_message_id'):
+        updated = await backfill_last_message_previews(batch_size=batch_size)
+        return f"Backfilled the last message of {updated} bot users."
+    updated = 0
+    async for messages in iterate_new_messages(LAST_MESSAGE_PREVIEW_JOB,
+                                               query={"handler": "bot", "sender_id": {"$exists": True}},
+                                               projection={"created_at": 1, "handler": 1, "type": 1, "data.text": 1,
+                                                           "sender_id": 1},
+                                               batch_size=batch_size, max_batches=LAST_MESSAGE_PREVIEW_BATCHES_PER_RUN):
+        # messages come in `_id` order, the last one of each sender wins
+        latest = {message['sender_id']: message for message in messages}
+        requests = [UpdateOne({"_id": sender_id,
+                               "$or": [{"last_message_preview": {"$exists": False}},
+                                       {"last_message_preview.created_at": {"$lte": message['created_at']}}]},
+                              {"$set": {"last_message_preview": last_message_preview(message)}})
+                    for sender_id, message in latest.items()]
+        await collection.bulk_write(requests, ordered=False)
+        updated += len(requests)
+    return f"Updated the last message of {updated} bot users."
+
+
+@leased_job(LAST_MESSAGE_PREVIEW_JOB)
+async def rebuild_last_message_previews() -> str:
+    await reset_job_state(LAST_MESSAGE_PREVIEW_JOB)
+    return await refresh_last_message_previews()
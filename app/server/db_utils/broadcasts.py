@@ -1,3 +1,4 @@
+import asyncio
 import re
 from datetime import datetime
 from re import escape
@@ -12,7 +13,8 @@ from app.server.models.broadcast import BroadcastTemplateSchemaDb, NewBroadcastT
     BroadcastHistoryListSchemaDbOut, \
     BroadcastHistorySchemaDbOut, FlowComponentIn, FlowButtonsIn, BroadcastTemplateSchemaDbOut, BroadcastIn
 from app.server.models.portal_user import PortalUserBasicSchemaOut
-from app.server.utils.common import clean_dict_helper, form_query, add_user_pipeline, to_camel
+from app.server.utils.common import clean_dict_helper, form_query, to_camel
+from app.server.utils.dataloader import Loaders
 from app.server.utils.timezone import get_local_datetime_now, get_local_now
 
 
@@ -154,14 +156,18 @@ async def validate_broadcast_template(broadcast_template: NewBroadcastTemplate,
     return True, ''
 
 
-async def get_broadcast_history_list(*, tags: [], intersect: bool, status: str) -> list[BroadcastHistoryListSchemaDbOut]:
+async def get_broadcast_history_list(*, tags: [], intersect: bool, status: str,
+                                     loaders: Loaders) -> list[BroadcastHistoryListSchemaDbOut]:
     db_key = [("tags", {'$all' if intersect else '$in': tags} if tags else ...),
               ("is_active", True)]
     query = form_query(db_key)
-    user_pipeline = add_user_pipeline('created_by', 'created_by')
-    pipeline = [{"$match": query}] + user_pipeline + [{"$sort": {"created_at": -1}}]
+    broadcasts = await collection.find(query, sort=[("created_at", -1)]).to_list(length=None)
+    creators = await loaders.portal_user.load_many([broadcast['created_by'] for broadcast in broadcasts])
     broadcast_history = []
-    async for broadcast in collection.aggregate(pipeline):
+    for broadcast, created_by in zip(broadcasts, creators):
+        if not created_by:
+            continue
+        broadcast['created_by'] = created_by
         if status == 'completed':
             if broadcast["total"] != broadcast["processed"]:
                 continue
@@ -177,16 +183,17 @@ async def get_broadcast_history_list(*, tags: [], intersect: bool, status: str)
     return broadcast_history
 
 
-async def get_broadcast_history_one(_id) -> BroadcastHistorySchemaDbOut:
+async def get_broadcast_history_one(_id, loaders: Loaders) -> BroadcastHistorySchemaDbOut:
     query = {"_id": ObjectId(_id)}
-
-    user_pipeline = add_user_pipeline('created_by', 'created_by')
-    pipeline = [{"$match": query},
-                {"$lookup": {"from": "bot_user", "localField": 'targets', "foreignField": "_id",
-                             "as": "targets"}},
-                {"$lookup": {"from": "bot_user", "localField": 'failed', "foreignField": "facebook.id",
-                             "as": "failed"}}] + user_pipeline
-    broadcast = await collection.aggregate(pipeline).next()
+    broadcast = await collection.find_one(query)
+    # the three lookups share one event loop tick, each collection is queried once
+    created_by, targets, failed = await asyncio.gather(
+        loaders.portal_user.load(broadcast['created_by']),
+        loaders.bot_user.load_many(broadcast.get('targets', [])),
+        loaders.bot_user_by_facebook_id.load_many(broadcast.get('failed', [])))
+    broadcast |= {"created_by": created_by,
+                  "targets": [user for user in targets if user],
+                  "failed": [user for user in failed if user]}
     return BroadcastHistorySchemaDbOut(**broadcast_history_helper(broadcast))
 
 
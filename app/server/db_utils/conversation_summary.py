@@ -0,0 +1,106 @@
+from datetime import date, datetime
+from typing import Union, Optional
+
+from pymongo import UpdateOne
+
+from app.server.db.collections import conversation_collection, message_collection
+from app.server.db_utils.helper import message_preview
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job, not_applied, \
+    bulk_write_batch
+from app.server.utils.timezone import make_timezone_aware
+
+CONVERSATION_SUMMARY_JOB = 'conversation_summary'
+CONVERSATION_SUMMARY_BATCHES_PER_RUN = 20
+# messages making a conversation count as active, for the summaries and the dashboard alike
+USER_CONVERSATION_MESSAGE = {"handler": "bot", "chatbot.convo_id": {"$ne": None}}
+
+
+async def create_conversation_summary_indexes():
+    await conversation_collection.create_index([("last_message_at", -1), ("_id", -1)])
+    await conversation_collection.create_index([("participants", 1), ("last_message_at", -1)])
+
+
+def conversation_summary_update(messages: list[dict], batch_id) -> dict:
+    """
+    Update folding new messages of one conversation (in `_id` order) into its summary document, recording the batch
+    so a replay of it is skipped (see `not_applied`)
+    """
+    last = messages[-1]
+    participants = {message[key] for message in messages for key in ('sender_id', 'receiver_id') if message.get(key)}
+    return {
+        "$addToSet": {"participants": {"$each": list(participants)}},
+        "$min": {"first_message_at": messages[0]['created_at']},
+        "$max": {"last_message_at": last['created_at']},
+        "$inc": {
+            "message_count": len(messages),
+            "user_message_count": sum(message.get('handler') == 'bot' for message in messages),
+            "answered_count": sum('qnid' in message.get('chatbot', {}) for message in messages),
+            "unanswered_count": sum(message.get('chatbot', {}).get('unanswered') is True for message in messages),
+        },
+        # messages come in `_id` order, so the newest batch always holds the last message
+        "$set": {"last_message": {"id": last['_id'],
+                                  "preview": message_preview(last),
+                                  "handler": last.get('handler'),
+                                  "created_at": last['created_at']},
+                 "applied_through": batch_id},
+    }
+
+
+@leased_job(CONVERSATION_SUMMARY_JOB)
+async def refresh_conversation_summaries(*, batch_size: int = 1000) -> str:
+    """
+    Fold the messages received since the last run into their `conversation` documents
+    """
+    summarized = 0
+    async for messages in iterate_new_messages(CONVERSATION_SUMMARY_JOB,
+                                               query={"chatbot.convo_id": {"$ne": None}},
+                                               projection={"created_at": 1, "handler": 1, "type": 1, "data.text": 1,
+                                                           "sender_id": 1, "receiver_id": 1, "chatbot.convo_id": 1,
+                                                           "chatbot.qnid": 1, "chatbot.unanswered": 1},
+                                               batch_size=batch_size,
+                                               max_batches=CONVERSATION_SUMMARY_BATCHES_PER_RUN):
+        conversations = {}
+        for message in messages:
+            conversations.setdefault(message['chatbot']['convo_id'], []).append(message)
+        batch_id = messages[-1]['_id']
+        requests = [UpdateOne({"_id": convo_id} | not_applied(batch_id),
+                              conversation_summary_update(convo_messages, batch_id), upsert=True)
+                    for convo_id, convo_messages in conversations.items()]
+        await bulk_write_batch(conversation_collection, requests)
+        summarized += len(messages)
+    return f"Summarized {summarized} messages."
+
+
+@leased_job(CONVERSATION_SUMMARY_JOB)
+async def rebuild_conversation_summaries() -> str:
+    await conversation_collection.delete_many({})
+    await reset_job_state(CONVERSATION_SUMMARY_JOB)
+    return await refresh_conversation_summaries()
+
+
+async def count_conversations(*, start: Union[date, datetime] = None, end: Union[date, datetime] = None) -> int:
+    """
+    Conversations with a user message in the period (bounds inclusive), as the dashboard's $facet mode counts
+    them. Over all time every summary with a user message is one, otherwise the distinct conversations of the
+    period's user messages are counted.
+    """
+    if not start and not end:
+        return await conversation_collection.count_documents({"user_message_count": {"$gt": 0}})
+    created_at = {}
+    if start:
+        created_at["$gte"] = make_timezone_aware(start)
+    if end:
+        created_at["$lte"] = make_timezone_aware(end)
+    pipeline = [{"$match": USER_CONVERSATION_MESSAGE | {"created_at": created_at}},
+                {"$group": {"_id": "$chatbot.convo_id"}},
+                {"$count": "count"}]
+    result = await message_collection.aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+    return result[0]['count'] if result else 0
+
+
+async def get_conversation_message_count(convo_id: str) -> Optional[int]:
+    """
+    Messages of a conversation from its summary, None when it is not summarized yet
+    """
+    summary = await conversation_collection.find_one({"_id": convo_id}, projection={"message_count": 1})
+    return summary['message_count'] if summary else None
@@ -1,14 +1,19 @@
-from re import escape
+from typing import Optional
 
-from bson import SON, ObjectId, Regex
+from bson import SON, ObjectId
 
 from app.server.db.collections import bot_user_collection
-from app.server.db.collections import message_collection
-from app.server.db_utils.helper import message_helper, bot_user_helper
-from app.server.models.conversations import ConversationBotUserSchema, ConversationMessageUserSchema
-from app.server.models.flow import FlowTypeEnum
+from app.server.db.collections import message_collection, conversation_collection
+from app.server.db_utils.bot_user import bot_user_search_query
+from app.server.db_utils.conversation_summary import get_conversation_message_count
+from app.server.db_utils.helper import message_helper, bot_user_helper, conversation_summary_helper
+from app.server.db_utils.message_search import search_messages
+from app.server.db_utils.pagination import CountMode, PageCount, get_page_and_count, skip_stages
+from app.server.models.conversations import ConversationBotUserSchema, ConversationMessageUserSchema, \
+    ConversationSummarySchema
 from app.server.models.message import MessageSchemaDb, ConversationMessageDisplay
-from app.server.utils.common import clean_dict_helper, form_pipeline
+from app.server.utils.common import clean_dict_helper, form_query
+from app.server.utils.pagination import decode_cursor, keyset_query, next_cursor
 
 
 def convo_message_search_helper(message) -> dict:
@@ -19,40 +24,42 @@ def convo_message_search_helper(message) -> dict:
     }
 
 
+CONVERSATIONS_SORT = [("last_active.received_at", -1), ("_id", -1)]
+MESSAGE_CONVERSATIONS_SORT = [("score", -1), ("_id", -1)]
+MESSAGES_SORT = [("_id", -1)]
+CONVERSATION_SUMMARIES_SORT = [("last_message_at", -1), ("_id", -1)]
+
+
+def page_stages(*, sort: list[tuple[str, int]], current_page: int, page_size: int, cursor: str = None) -> list[dict]:
+    """
+    Sort and page stages, a cursor (see utils.pagination) continues after its item instead of skipping pages
+    """
+    if cursor:
+        return [{"$match": keyset_query(sort, decode_cursor(cursor, len(sort)))},
+                {"$sort": SON(sort)},
+                {"$limit": page_size}]
+    return skip_stages(sort=sort, current_page=current_page, page_size=page_size)
+
+
+def page_count_mode(count_mode: CountMode, cursor: Optional[str]) -> CountMode:
+    """
+    Pages after the first come from a cursor, the client already has the total and an exact recount would cost
+    every match again
+    """
+    return CountMode.CAPPED if cursor and count_mode == CountMode.EXACT else count_mode
+
+
 async def get_conversations_and_count_db(*, current_page: int, page_size: int, tags: list[str] = None,
-                                         search_query: str = ''):
+                                         search_query: str = '', cursor: str = None,
+                                         count_mode: CountMode = CountMode.EXACT):
     conversations = []
-    db_key = [("$addFields", {"fullname": {"$concat": ["$first_name", " ", "$last_name"]}}),
-              ("$match", {"tags": {"$all": tags}} if tags else ...),
-              ("$match", {"fullname": Regex(f".*{escape(search_query)}.*", "i")} if search_query else ...),
-              ]
-
-    pipeline = form_pipeline(db_key)
-    total = await bot_user_pipeline_count(pipeline=pipeline[:])
+    raw = []
+    query = form_query([("tags", {"$all": tags} if tags else ...)])
+    if search_query:
+        query |= bot_user_search_query(search_query)
     extra_stages = [
-        {"$sort": SON([("last_active.received_at", -1)])},
-        {"$skip": (current_page - 1) * page_size},
-        {"$limit": page_size},
-        {"$lookup": {
-            "from": "message",
-            "localField": "last_active.received_message_id",
-            "foreignField": "_id",
-            "as": "last_message"}},
-        {"$unwind": {
-            "path": "$last_message",
-            "preserveNullAndEmptyArrays": False
-        }},
-        # {"$lookup": {
-        #     "from": "message",
-        #     "localField": "message.chatbot.convo_id",
-        #     "foreignField": "chatbot.convo_id",
-        #     "as": "conversations"
-        # }},
-        # {"$addFields": {
-        #     "last_message": {
-        #         "$last": "$conversations"
-        #     }
-        # }},
+        *page_stages(sort=CONVERSATIONS_SORT, current_page=current_page, page_size=page_size, cursor=cursor),
+        {"$addFields": {"fullname": {"$concat": ["$first_name", " ", "$last_name"]}}},
         {"$project": {
             "_id": 1,
             "fullname": 1,
@@ -66,119 +73,110 @@ async def get_conversations_and_count_db(*, current_page: int, page_size: int, t
             "chatbot": 1,
             "tags": 1,
             "platforms": 1,
-            "last_message": 1
+            "last_message_preview": 1
         }}
     ]
 
-    pipeline.extend(extra_stages)
-
-    cursor = bot_user_collection.aggregate(pipeline)
-
-    async for conversation in cursor:
+    items, count = await get_page_and_count(bot_user_collection, query=query, page_stages=extra_stages,
+                                            count_mode=page_count_mode(count_mode, cursor))
+    for conversation in items:
+        raw.append({"_id": conversation['_id'], "last_active": conversation.get('last_active')})
+        # users without a received message (or not backfilled yet) have no preview and stay out of the list
+        if not (preview := conversation.pop('last_message_preview', None)):
+            continue
         entry = ConversationBotUserSchema(**bot_user_helper(conversation))
-        if entry.last_message:
-            entry.last_message = format_message_to_display(entry.last_message)
+        entry.last_message = ConversationMessageDisplay(message=preview['text'], created_at=preview['created_at'])
         conversations.append(entry)
-    return conversations, total
-
-
-def format_message_to_display(message: MessageSchemaDb) -> ConversationMessageDisplay:
-    sender = ''
-    if message.handler != 'bot':
-        sender = 'Bot: '
-
-    if message.type == FlowTypeEnum.GENERIC_TEMPLATE:
-        text = '[Generic Template]'
-    elif message.type in [FlowTypeEnum.IMAGES, FlowTypeEnum.IMAGE]:
-        text = '[Image]'
-    elif message.type == FlowTypeEnum.FILE:
-        text = '[Attachment]'
-    elif message.type == FlowTypeEnum.BUTTON_TEMPLATE:
-        text = '[Button Template]'
-    elif message.type == FlowTypeEnum.MESSAGE:
-        text = message.data.text
-    elif message.type in [FlowTypeEnum.VIDEOS, FlowTypeEnum.VIDEO]:
-        text = '[Video]'
-    else:
-        text = 'Unsupported Message'
-
-    return ConversationMessageDisplay(**{"message": sender + text, "created_at": message.created_at})
+    return conversations, count, next_cursor(raw, CONVERSATIONS_SORT, page_size)
 
 
-async def get_message_conversations_and_count_db(*, current_page: int, page_size: int, search_query: str):
+async def get_message_conversations_and_count_db(*, current_page: int, page_size: int, search_query: str,
+                                                 cursor: str = None):
+    """
+    Users whose messages match the search (see db_utils.message_search), the user with the best matching message
+    first. Only the senders of the best matches are listed, the count says so when more messages match.
+    """
     conversations = []
-    pipeline = [{"$match": {"$text": {"$search": f"\"{search_query}\"" if search_query else ''}}},
-                {"$group": {"_id": "$sender_id",
-                            "convo_id": {
-                                "$addToSet": "$chatbot.convo_id"
-                            },
-                            "last_message_date": {
-                                "$first": "$created_at"}}}]
-    total = await message_pipeline_count(pipeline=pipeline[:])
-    extra_stages = [{"$sort": SON([("last_message_date", -1)])},
-                    {"$skip": (current_page - 1) * page_size},
-                    {"$limit": page_size},
-                    {"$lookup": {
-                        "from": "bot_user",
-                        "localField": "_id",
-                        "foreignField": "_id",
-                        "as": "user"}},
-                    {"$unwind": {"path": "$user"}},
-                    # {"$match": {"user.tags": tags}},
-                    {"$addFields": {"fullname": {"$concat": ["$user.first_name", " ", "$user.last_name"]},
-                                    "convo_count": {"$size": "$convo_id"}}}]
-    pipeline.extend(extra_stages)
-
-    cursor = message_collection.aggregate(pipeline)
-
-    async for conversation in cursor:
+    senders = {}
+    results = await search_messages(search_query or '')
+    for hit in results.hits:
+        if not hit.sender_id:
+            continue
+        sender = senders.setdefault(hit.sender_id, {"_id": hit.sender_id, "score": hit.score, "convo_id": set(),
+                                                    "last_message_date": hit.created_at})
+        sender['score'] = max(sender['score'], hit.score)
+        sender['last_message_date'] = max(sender['last_message_date'], hit.created_at)
+        if hit.convo_id:
+            sender['convo_id'].add(hit.convo_id)
+
+    ranked = sorted(senders.values(), key=lambda item: (item['score'], item['_id']), reverse=True)
+    if cursor:
+        score, last_id = decode_cursor(cursor, len(MESSAGE_CONVERSATIONS_SORT))
+        ranked = [item for item in ranked if (item['score'], item['_id']) < (score, last_id)]
+    else:
+        ranked = ranked[(current_page - 1) * page_size:]
+    page = ranked[:page_size]
+
+    users = {user['_id']: user async for user in bot_user_collection.find({"_id": {"$in": [s['_id'] for s in page]}})}
+    for sender in page:
+        if not (user := users.get(sender['_id'])):
+            continue
+        conversation = sender | {"convo_id": sorted(sender['convo_id']),
+                                 "user": user,
+                                 "fullname": f"{user.get('first_name', '')} {user.get('last_name', '')}",
+                                 "convo_count": len(sender['convo_id'])}
         conversations.append(ConversationMessageUserSchema(**convo_message_search_helper(conversation)))
-    return conversations, total
+    count = PageCount(len(senders), capped=not results.complete)
+    return conversations, count, next_cursor(page, MESSAGE_CONVERSATIONS_SORT, page_size)
 
 
-async def get_user_message_conversations_and_count_db(*, current_page: int, page_size: int, user_id: str):
-    messages = []
+async def get_user_message_conversations_and_count_db(*, current_page: int, page_size: int, user_id: str,
+                                                      cursor: str = None, count_mode: CountMode = CountMode.EXACT):
     query = {"$or": [{"sender_id": ObjectId(user_id)},
                      {"receiver_id": ObjectId(user_id)}]}
-    sort = [("_id", -1)]
-    total = await message_query_count(query=query)
-    cursor = message_collection.find(query, sort=sort)
-    cursor.skip((current_page - 1) * page_size).limit(page_size)
-    async for conversation in cursor:
-        messages.append(MessageSchemaDb(**message_helper(conversation)))
-    return messages, total
+    return await get_messages_page(query=query, current_page=current_page, page_size=page_size, cursor=cursor,
+                                   count_mode=count_mode)
 
 
-async def get_convo_conversations_and_count_db(*, current_page: int, page_size: int, convo_id: str):
-    messages = []
+async def get_convo_conversations_and_count_db(*, current_page: int, page_size: int, convo_id: str,
+                                               cursor: str = None, count_mode: CountMode = CountMode.EXACT):
     query = {"chatbot.convo_id": convo_id}
-    sort = [("_id", -1)]
-    total = await message_query_count(query=query)
-    cursor = message_collection.find(query, sort=sort)
-    cursor.skip((current_page - 1) * page_size).limit(page_size)
-    async for conversation in cursor:
-        messages.append(MessageSchemaDb(**message_helper(conversation)))
-    return messages, total
-
-
-async def bot_user_pipeline_count(*, pipeline: list[dict]) -> int:
-    pipeline.append({"$count": "total_count"})
-    cursor = bot_user_collection.aggregate(pipeline)
-    total = 0
-    async for conversations in cursor:
-        total = conversations['total_count']
-    return total
+    return await get_messages_page(query=query, current_page=current_page, page_size=page_size, cursor=cursor,
+                                   count_mode=count_mode, total=await get_conversation_message_count(convo_id))
 
 
-async def message_pipeline_count(*, pipeline: list[dict]) -> int:
-    pipeline.append({"$count": "total_count"})
-    cursor = message_collection.aggregate(pipeline)
-    total = 0
-    async for conversations in cursor:
-        total = conversations['total_count']
-    return total
-
-
-async def message_query_count(*, query: dict) -> int:
-    count = message_collection.count_documents(query)
-    return await count
+async def get_messages_page(*, query: dict, current_page: int, page_size: int, cursor: str = None,
+                            count_mode: CountMode = CountMode.EXACT, total: int = None):
+    """
+    Newest first page of messages, with the total and the cursor of the next page
+    :param total: number of matching messages when already known (e.g. from the conversation summary), only the
+    page is queried then
+    """
+    messages = []
+    raw = []
+    stages = page_stages(sort=MESSAGES_SORT, current_page=current_page, page_size=page_size, cursor=cursor)
+    if total is not None:
+        items = await message_collection.aggregate([{"$match": query}, *stages]).to_list(length=page_size)
+        count = PageCount(total)
+    else:
+        items, count = await get_page_and_count(message_collection, query=query, page_stages=stages,
+                                                count_mode=page_count_mode(count_mode, cursor))
+    for conversation in items:
+        raw.append({"_id": conversation['_id']})
+        messages.append(MessageSchemaDb(**message_helper(conversation)))
+    return messages, count, next_cursor(raw, MESSAGES_SORT, page_size)
+
+
+async def get_conversation_summaries_db(*, current_page: int, page_size: int, user_id: str = None,
+                                        cursor: str = None, count_mode: CountMode = CountMode.EXACT):
+    """
+    Conversation summaries (see db_utils.conversation_summary), the most recently active first, only those
+    `user_id` took part in if given
+    """
+    query = {"participants": ObjectId(user_id)} if user_id else None
+    stages = page_stages(sort=CONVERSATION_SUMMARIES_SORT, current_page=current_page, page_size=page_size,
+                         cursor=cursor)
+    items, count = await get_page_and_count(conversation_collection, query=query, page_stages=stages,
+                                            count_mode=page_count_mode(count_mode, cursor))
+    conversations = [ConversationSummarySchema(**conversation_summary_helper(item)) for item in items]
+    return conversations, count, next_cursor(items, CONVERSATION_SUMMARIES_SORT, page_size)
@@ -0,0 +1,106 @@
+from collections import defaultdict
+from datetime import date
+from typing import Union, Optional
+
+from pydantic.main import BaseModel
+from pymongo import UpdateOne
+
+from app.server.db.collections import nlp_confidence_daily_collection
+from app.server.db_utils.dashboard.day_cache import iterate_days, period_start
+from app.server.db_utils.dashboard.rollup import day_key
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job, not_applied, \
+    bulk_write_batch
+from app.server.models.dashboard import Granularity
+from app.server.utils.sketches import ConfidenceSketch
+
+CONFIDENCE_JOB = 'nlp_confidence'
+CONFIDENCE_BATCHES_PER_RUN = 20
+HISTOGRAM_BUCKETS = 10
+
+
+@leased_job(CONFIDENCE_JOB)
+async def refresh_confidence_sketches(*, batch_size: int = 1000) -> str:
+    """
+    Merge the confidences of bot messages received since the last run into the daily sketches
+    """
+    added = 0
+    # confidence of 1 is an exact match, it says nothing about the model
+    query = {"handler": "bot", "chatbot.highest_confidence": {"$lt": 1}}
+    async for messages in iterate_new_messages(CONFIDENCE_JOB, query=query,
+                                               projection={"created_at": 1, "chatbot.highest_confidence": 1},
+                                               batch_size=batch_size, max_batches=CONFIDENCE_BATCHES_PER_RUN):
+        sketches = defaultdict(ConfidenceSketch)
+        for message in messages:
+            sketches[day_key(message['created_at'])].add(message['chatbot']['highest_confidence'])
+        batch_id = messages[-1]['_id']
+        requests = [UpdateOne({"_id": day} | not_applied(batch_id),
+                              sketch.to_update() | {"$set": {"applied_through": batch_id}}, upsert=True)
+                    for day, sketch in sketches.items()]
+        await bulk_write_batch(nlp_confidence_daily_collection, requests)
+        added += len(messages)
+    return f"Added {added} confidences."
+
+
+@leased_job(CONFIDENCE_JOB)
+async def rebuild_confidence_sketches() -> str:
+    await nlp_confidence_daily_collection.delete_many({})
+    await reset_job_state(CONFIDENCE_JOB)
+    return await refresh_confidence_sketches()
+
+
+async def get_confidence_sketches(start: date, end: date) -> dict[str, ConfidenceSketch]:
+    query = {"_id": {"$gte": day_key(start), "$lte": day_key(end)}}
+    return {doc['_id']: ConfidenceSketch.from_document(doc)
+            async for doc in nlp_confidence_daily_collection.find(query)}
+
+
+class NlpTrendAreaLine(BaseModel):
+    time: str
+    value: Union[list[float], float, None, list[None]]
+
+
+class NlpTrendQuantiles(BaseModel):
+    time: str
+    p10: Optional[float]
+    p50: Optional[float]
+    p90: Optional[float]
+
+
+class NlpHistogramBucket(BaseModel):
+    start: float
+    end: float
+    count: int
+
+
+class NlpTrendModel(BaseModel):
+    area: list[NlpTrendAreaLine]
+    line: list[NlpTrendAreaLine]
+    quantiles: list[NlpTrendQuantiles]
+    histogram: list[NlpHistogramBucket]
+
+
+async def nlp_confidence_trend(since: list[date], granularity: Granularity = Granularity.DAY) -> NlpTrendModel:
+    """
+    Min/max band, mean, p10/p50/p90 per day, week or month and the confidence histogram of the whole range.
+    Weeks and months merge the stored day sketches, messages are never re-read.
+    """
+    daily = await get_confidence_sketches(since[0], since[1])
+    periods: dict[date, ConfidenceSketch] = {}
+    overall = ConfidenceSketch()
+    for day in iterate_days(since[0], since[1]):
+        sketch = periods.setdefault(period_start(day, granularity), ConfidenceSketch())
+        if day_sketch := daily.get(day_key(day)):
+            sketch.merge(day_sketch)
+            overall.merge(day_sketch)
+
+    res = {"area": [], "line": [], "quantiles": [], "histogram": []}
+    for start, sketch in periods.items():
+        datestr = start.strftime('%Y-%-m-%-d')
+        res['area'].append({"time": datestr, "value": [sketch.minimum, sketch.maximum]})
+        res['line'].append({"time": datestr, "value": sketch.mean})
+        res['quantiles'].append({"time": datestr, "p10": sketch.quantile(0.1), "p50": sketch.quantile(0.5),
+                                 "p90": sketch.quantile(0.9)})
+    for index, count in enumerate(overall.histogram(HISTOGRAM_BUCKETS)):
+        res['histogram'].append({"start": index / HISTOGRAM_BUCKETS, "end": (index + 1) / HISTOGRAM_BUCKETS,
+                                 "count": count})
+    return NlpTrendModel(**res)
@@ -0,0 +1,86 @@
+from datetime import date, timedelta
+from typing import Any, Awaitable, Callable
+
+from pymongo import UpdateOne
+
+from app.server.db.collections import dashboard_day_cache_collection
+from app.server.db_utils.dashboard.rollup import day_key
+from app.server.models.dashboard import Granularity
+from app.server.utils.cache import TTLCache
+from app.server.utils.timezone import get_local_datetime_now
+
+OPEN_DAY_TTL_SECONDS = 30
+
+# cells of the current (still changing) day, keyed by (metric, day)
+open_day_cache = TTLCache(maxsize=256, ttl=OPEN_DAY_TTL_SECONDS)
+
+DayCellsComputer = Callable[[date, date], Awaitable[dict[str, Any]]]
+
+
+def iterate_days(start: date, end: date):
+    current = start
+    while current <= end:
+        yield current
+        current += timedelta(days=1)
+
+
+def period_start(day: date, granularity: Granularity) -> date:
+    """
+    First day of the week (Monday) or month containing `day`
+    """
+    if granularity == Granularity.WEEK:
+        return day - timedelta(days=day.weekday())
+    if granularity == Granularity.MONTH:
+        return day.replace(day=1)
+    return day
+
+
+async def get_day_cells(metric: str, start: date, end: date, compute: DayCellsComputer) -> dict[str, Any]:
+    """
+    Per local day values of a metric between start and end (both inclusive), keyed by 'YYYY-MM-DD'.
+    Finished days are computed once and stored permanently in `dashboard_day_cache`, missing ones are computed
+    together by a single `compute(first_missing, last_missing)` call. The open day is recomputed at most every
+    OPEN_DAY_TTL_SECONDS. Days without data are None.
+    :param metric: cache namespace, change it whenever the shape of a cell changes
+    :param compute: coroutine returning {day_key: cell} for the days between its arguments that have data
+    """
+    today = date.today()
+    cells = {}
+
+    closed_end = min(end, today - timedelta(days=1))
+    if start <= closed_end:
+        query = {"_id": {"$gte": f"{metric}:{day_key(start)}", "$lte": f"{metric}:{day_key(closed_end)}"}}
+        async for cell in dashboard_day_cache_collection.find(query, projection={"day": 1, "value": 1}):
+            cells[cell['day']] = cell['value']
+
+        missing = [day for day in iterate_days(start, closed_end) if day_key(day) not in cells]
+        if missing:
+            computed = await compute(missing[0], missing[-1])
+            now = get_local_datetime_now()
+            requests = []
+            for day in missing:
+                key = day_key(day)
+                cells[key] = computed.get(key)
+                requests.append(UpdateOne({"_id": f"{metric}:{key}"},
+                                          {"$set": {"metric": metric, "day": key, "value": cells[key],
+                                                    "created_at": now}},
+                                          upsert=True))
+            await dashboard_day_cache_collection.bulk_write(requests, ordered=False)
+
+    if start <= today <= end:
+        key = day_key(today)
+        if (cell := open_day_cache.get((metric, key), ...)) is ...:
+            cell = (await compute(today, today)).get(key)
+            open_day_cache.set((metric, key), cell)
+        cells[key] = cell
+
+    return cells
+
+
+async def clear_day_cache(metric: str = None) -> str:
+    """
+    Forget cached days, e.g. after historical messages were imported or edited
+    """
+    result = await dashboard_day_cache_collection.delete_many({"metric": metric} if metric else {})
+    open_day_cache.clear()
+    return f"Removed {result.deleted_count} cached days."
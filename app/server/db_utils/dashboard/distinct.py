@@ -0,0 +1,102 @@
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Union
+
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+from app.server.db.collections import distinct_daily_collection
+from app.server.db_utils.dashboard.day_cache import iterate_days, period_start
+from app.server.db_utils.dashboard.rollup import day_key, day_key_query
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job
+from app.server.models.dashboard import Granularity
+from app.server.utils.hyperloglog import HyperLogLog
+
+DISTINCT_JOB = 'distinct_counters'
+DISTINCT_BATCHES_PER_RUN = 20
+DISTINCT_FIELDS = ("senders", "conversations")
+MERGE_RETRIES = 5
+
+
+async def merge_day_counters(day: str, counters: dict[str, HyperLogLog]):
+    """
+    Fold counters into the stored registers of a day. Registers are read, merged and written back with a version
+    check, so two workers refreshing at the same time never lose each other's values.
+    """
+    for _ in range(MERGE_RETRIES):
+        doc = await distinct_daily_collection.find_one({"_id": day})
+        merged = {}
+        for field, counter in counters.items():
+            merged[field] = HyperLogLog.from_bytes(doc[field]).merge(counter) if doc and doc.get(field) else counter
+        registers = {field: Binary(counter.to_bytes()) for field, counter in merged.items()}
+
+        if not doc:
+            try:
+                await distinct_daily_collection.insert_one({"_id": day, "version": 1} | registers)
+                return
+            except DuplicateKeyError:
+                continue
+        result = await distinct_daily_collection.update_one({"_id": day, "version": doc.get('version', 0)},
+                                                            {"$set": registers, "$inc": {"version": 1}})
+        if result.modified_count:
+            return
+    raise RuntimeError(f"Could not merge distinct counters of {day}, too many concurrent writers")
+
+
+@leased_job(DISTINCT_JOB)
+async def refresh_distinct_counters(*, batch_size: int = 1000) -> str:
+    """
+    Add the senders and conversations of bot messages received since the last run to the daily HyperLogLogs
+    """
+    added = 0
+    async for messages in iterate_new_messages(DISTINCT_JOB, query={"handler": "bot"},
+                                               projection={"created_at": 1, "sender_id": 1, "chatbot.convo_id": 1},
+                                               batch_size=batch_size, max_batches=DISTINCT_BATCHES_PER_RUN):
+        days = defaultdict(lambda: {field: HyperLogLog() for field in DISTINCT_FIELDS})
+        for message in messages:
+            counters = days[day_key(message['created_at'])]
+            counters['senders'].add(message['sender_id'])
+            if convo_id := message.get('chatbot', {}).get('convo_id'):
+                counters['conversations'].add(convo_id)
+        for day, counters in days.items():
+            await merge_day_counters(day, counters)
+        added += len(messages)
+    return f"Counted {added} messages."
+
+
+@leased_job(DISTINCT_JOB)
+async def rebuild_distinct_counters() -> str:
+    await distinct_daily_collection.delete_many({})
+    await reset_job_state(DISTINCT_JOB)
+    return await refresh_distinct_counters()
+
+
+async def get_distinct_estimate(field: str, *, start: Union[date, datetime] = None,
+                                end: Union[date, datetime] = None) -> int:
+    """
+    Approximate distinct senders or conversations between two days, bounds as in `day_key_query`
+    :param field: one of DISTINCT_FIELDS
+    """
+    merged = HyperLogLog()
+    async for doc in distinct_daily_collection.find(day_key_query(start=start, end=end), projection={field: 1}):
+        if doc.get(field):
+            merged.merge(HyperLogLog.from_bytes(doc[field]))
+    return merged.estimate()
+
+
+async def get_distinct_trend(field: str, since: list[date],
+                             granularity: Granularity = Granularity.DAY) -> dict[date, int]:
+    """
+    Approximate distinct senders or conversations of every day, week or month of the range, keyed by period start.
+    A week or month merges its day registers, so someone active on several days counts once.
+    """
+    query = {"_id": {"$gte": day_key(since[0]), "$lte": day_key(since[1])}}
+    daily = {doc['_id']: doc[field] async for doc in distinct_daily_collection.find(query, projection={field: 1})
+             if doc.get(field)}
+
+    periods: dict[date, HyperLogLog] = {}
+    for day in iterate_days(since[0], since[1]):
+        counter = periods.setdefault(period_start(day, granularity), HyperLogLog())
+        if registers := daily.get(day_key(day)):
+            counter.merge(HyperLogLog.from_bytes(registers))
+    return {start: counter.estimate() for start, counter in periods.items()}
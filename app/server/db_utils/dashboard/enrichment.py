@@ -0,0 +1,58 @@
+from collections import defaultdict
+
+from bson import ObjectId
+from pymongo import UpdateMany
+
+from app.server.db.collections import message_collection
+from app.server.db_utils.question_lookup import get_question_lookup
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job
+
+ENRICHMENT_JOB = 'question_enrichment'
+ENRICHMENT_BATCHES_PER_RUN = 20
+
+
+def question_stamp(question: dict) -> dict:
+    """
+    Question fields copied onto the messages it answered, so dashboards group messages without joining `question`
+    """
+    return {"chatbot.question_topic": question.get('topic'), "chatbot.question_text": question.get('text')}
+
+
+async def create_enrichment_indexes():
+    await message_collection.create_index([("handler", 1), ("created_at", 1), ("chatbot.question_topic", 1)])
+
+
+@leased_job(ENRICHMENT_JOB)
+async def enrich_new_messages(*, batch_size: int = 1000) -> str:
+    """
+    Stamp the topic and text of the answering question on messages received since the last run. The first run (or
+    the first after `rebuild_enrichment`) backfills the whole history, ENRICHMENT_BATCHES_PER_RUN batches at a time.
+    """
+    enriched = 0
+    questions = await get_question_lookup()
+    async for messages in iterate_new_messages(ENRICHMENT_JOB, query={"chatbot.qnid": {"$exists": True}},
+                                               projection={"chatbot.qnid": 1},
+                                               batch_size=batch_size, max_batches=ENRICHMENT_BATCHES_PER_RUN):
+        answered_by = defaultdict(list)
+        for message in messages:
+            answered_by[str(message['chatbot']['qnid'])].append(message['_id'])
+        requests = [UpdateMany({"_id": {"$in": ids}}, {"$set": question_stamp(questions[qnid])})
+                    for qnid, ids in answered_by.items() if qnid in questions]
+        if requests:
+            await message_collection.bulk_write(requests, ordered=False)
+        enriched += len(messages)
+    return f"Enriched {enriched} messages."
+
+
+@leased_job(ENRICHMENT_JOB)
+async def rebuild_enrichment() -> str:
+    await reset_job_state(ENRICHMENT_JOB)
+    return await enrich_new_messages()
+
+
+async def restamp_question_messages(qnid: str, question: dict) -> str:
+    """
+    Rewrite the stamp of every message answered by a question after its topic or text changed
+    """
+    result = await message_collection.update_many({"chatbot.qnid": ObjectId(qnid)}, {"$set": question_stamp(question)})
+    return f"Restamped {result.modified_count} messages."
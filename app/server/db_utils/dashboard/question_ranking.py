@@ -0,0 +1,176 @@
+from datetime import datetime, date, timedelta
+from typing import Union, Optional
+
+import numpy as np
+from pydantic.main import BaseModel
+
+from app.server.db.collections import message_collection
+from app.server.db_utils.dashboard.day_cache import iterate_days
+from app.server.db_utils.dashboard.rollup import day_key, local_day_expression, local_day_range
+from app.server.db_utils.question_lookup import get_question_text
+
+RECENT_DAY_WEIGHT = 0.875  # weight of the newest day of a window, the older days share the remainder
+
+
+class QuestionCountMatrix:
+    """
+    Messages answered per question (rows) and local day (columns), built by a single aggregation
+    """
+
+    def __init__(self, qnids: list[str], days: list[date], counts: np.ndarray):
+        self.qnids = qnids
+        self.days = days
+        self.counts = counts
+
+    @classmethod
+    async def load(cls, first_day: date, last_day: date) -> 'QuestionCountMatrix':
+        days = list(iterate_days(first_day, last_day))
+        column = {day_key(day): index for index, day in enumerate(days)}
+        pipeline = [{"$match": {"chatbot.qnid": {"$exists": True},
+                                "created_at": local_day_range(first_day, last_day)}},
+                    {"$group": {"_id": {"qnid": "$chatbot.qnid", "day": local_day_expression("$created_at")},
+                                "count": {"$sum": 1}}}]
+        rows, columns, values, qnids = [], [], [], {}
+        async for item in message_collection.aggregate(pipeline):
+            qnid = str(item['_id']['qnid'])
+            rows.append(qnids.setdefault(qnid, len(qnids)))
+            columns.append(column[item['_id']['day']])
+            values.append(item['count'])
+
+        counts = np.zeros((len(qnids), len(days)), dtype=np.int64)
+        np.add.at(counts, (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)), values)
+        return cls(list(qnids), days, counts)
+
+
+def decay_weights(window: int, recent_weight: float = RECENT_DAY_WEIGHT) -> np.ndarray:
+    """
+    Weights of the days of a window, oldest first. The newest day gets `recent_weight`, the others
+    `1 - recent_weight`, which keeps the historical 0.875/0.125 split for the default window.
+    """
+    weights = np.full(window, 1 - recent_weight)
+    weights[-1] = recent_weight
+    return weights
+
+
+class QuestionTotalHistoryViewModel(BaseModel):
+    date: date
+    count: int
+
+
+class QuestionTotalViewModel(BaseModel):
+    value: Union[int, None]
+    trend: Union[float, None]
+    history: list[QuestionTotalHistoryViewModel]
+
+
+class QuestionAverageHistoryViewModel(BaseModel):
+    date: date
+    average: Optional[float]
+
+
+class QuestionAverageViewModel(BaseModel):
+    value: Union[float, None]
+    trend: Union[float, None]
+    history: list[QuestionAverageHistoryViewModel]
+
+
+async def question_ranking(today: datetime, *, sorter: str = None, window: int = 7,
+                           recent_weight: float = RECENT_DAY_WEIGHT, language: str = 'EN'):
+    """
+    Rank the questions of the `window` days up to today against the same window shifted back by one day.
+    One aggregation builds the question x day matrix, the scoring and sorting run on arrays and the question text
+    is fetched once for the ranked rows.
+    """
+    last_day = today.date() if isinstance(today, datetime) else today
+    matrix = await QuestionCountMatrix.load(last_day - timedelta(days=window), last_day)
+    counts = matrix.counts
+    weights = decay_weights(window, recent_weight)
+
+    recent = counts[:, 1:] @ weights
+    past = counts[:, :-1] @ weights
+    recent_total = counts[:, 1:].sum(axis=1)
+
+    data = await question_ranking_data(matrix.qnids, recent, past, recent_total, sorter=sorter, language=language)
+    total_model = question_ranking_total(recent, past, matrix)
+    average_model = question_ranking_average(recent, past, matrix)
+    return data, total_model, average_model
+
+
+async def question_ranking_data(qnids: list[str], recent: np.ndarray, past: np.ndarray, recent_total: np.ndarray, *,
+                                sorter: str = None, language: str = 'EN') -> list[dict]:
+    """
+    -1 means question is not asked recently, -0.12% means decreasing interest of 12%, 0.04 means increasing interest of 4%
+    """
+    asked = np.flatnonzero(recent > 0)
+    trend = np.zeros(len(qnids))
+    np.divide(recent, past, out=trend, where=past > 0)
+    trend = np.where(past > 0, trend - 1, 0)
+
+    columns = {"trend": trend, "count": recent_total}
+    if sorter and sorter[1:] in columns:  # +count
+        # trend +,-| count +,-
+        values = columns[sorter[1:]][asked]
+        order = asked[np.argsort(-values if sorter[:1] == '+' else values, kind='stable')]
+    else:
+        order = asked[np.lexsort((-recent_total[asked], -trend[asked]))]
+
+    res = []
+    for index in order:
+        if not (text := await get_question_text(qnids[index], language)):
+            continue
+        res.append({
+            "text": text,
+            "count": int(recent_total[index]),
+            "trend": float(trend[index]),
+            "rank": len(res) + 1
+        })
+    return res
+
+
+def question_day_history(matrix: QuestionCountMatrix) -> list['QuestionHistoryModel']:
+    """
+    Answered messages and distinct questions asked per day of the matrix
+    """
+    day_totals = matrix.counts.sum(axis=0).tolist()
+    day_questions = np.count_nonzero(matrix.counts, axis=0).tolist()
+    return [QuestionHistoryModel(**{"date": day, "count": count, "questions": questions})
+            for day, count, questions in zip(matrix.days, day_totals, day_questions)]
+
+
+def question_ranking_total(recent: np.ndarray, past: np.ndarray,
+                           matrix: QuestionCountMatrix) -> QuestionTotalViewModel:
+    recent_total = float(recent.sum())
+    past_total = float(past.sum())
+    total_trend = (recent_total / past_total) - 1 if past_total else None
+    history = [QuestionTotalHistoryViewModel(**{"date": entry.date, "count": entry.count})
+               for entry in question_day_history(matrix)]
+    return QuestionTotalViewModel(**{"value": recent_total, "trend": total_trend, "history": history})
+
+
+def question_ranking_average(recent: np.ndarray, past: np.ndarray,
+                             matrix: QuestionCountMatrix) -> QuestionAverageViewModel:
+    asked = np.count_nonzero(recent)
+    recent_average = float(recent.sum()) / asked if asked else None
+    past_average = float(past.sum()) / asked if asked else None
+    average_trend = (recent_average / past_average) - 1 if past_average else None
+
+    history = [QuestionAverageHistoryViewModel(**{"date": entry.date,
+                                                  "average": entry.count / entry.questions if entry.count else None})
+               for entry in question_day_history(matrix)]
+    return QuestionAverageViewModel(**{"value": recent_average, "history": history, "trend": average_trend})
+
+
+class QuestionHistoryModel(BaseModel):
+    date: date
+    count: int
+    questions: int
+
+
+async def question_history(today: datetime, *, window: int = 7) -> list[QuestionHistoryModel]:
+    """
+    Answered messages and distinct questions asked per local day, from `window` days before today up to today.
+    Read from the question x day matrix, days without questions are zeros.
+    """
+    last_day = today.date() if isinstance(today, datetime) else today
+    matrix = await QuestionCountMatrix.load(last_day - timedelta(days=window), last_day)
+    return question_day_history(matrix)
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Optional, Union
+
+from pymongo import UpdateOne
+
+from app.server.core.env_variables import local_config
+from app.server.db.collections import message_collection, bot_user_collection, dashboard_daily_collection
+from app.server.db_utils.watermark import leased_job
+from app.server.utils.timezone import make_timezone_aware, get_local_datetime_now
+
+ROLLUP_FIELDS = ("message", "user", "conversation", "answered", "unanswered")
+ROLLUP_MAX_AGE_SECONDS = 60
+DASHBOARD_DAILY_JOB = 'dashboard_daily'
+
+_refresh_lock: Optional[asyncio.Lock] = None  # created on first use so it binds to the server's event loop
+_last_refresh = 0.0
+
+
+def day_key(day: date) -> str:
+    return day.strftime('%Y-%m-%d')
+
+
+def local_day_expression(field: str) -> dict:
+    """
+    Aggregation expression turning a datetime field into the 'YYYY-MM-DD' of the configured timezone
+    """
+    return {"$dateToString": {"format": "%Y-%m-%d", "date": field, "timezone": local_config.TIMEZONE}}
+
+
+def local_day_range(start: date, end: date) -> dict:
+    """
+    created_at filter for the local days start..end, both inclusive
+    """
+    return {"$gte": make_timezone_aware(start), "$lt": make_timezone_aware(end + timedelta(days=1))}
+
+
+async def get_first_open_day() -> Optional[date]:
+    """
+    # Day after the newest closed rollup row, the first day a refresh has to rescan. None if never built
+    :return:
+    """
+    last_closed = await dashboard_daily_collection.find_one({"closed": True}, sort=[("_id", -1)])
+    if last_closed:
+        return datetime.strptime(last_closed['_id'], '%Y-%m-%d').date() + timedelta(days=1)
+    return None
+
+
+async def write_rollup_days(start: Optional[date]) -> Optional[date]:
+    """
+    Count the local days from `start` (the whole history when None) up to today and upsert their rollup rows.
+    Every day of the range gets a row, days without messages are zeros. Returns the first day written, None when
+    there was nothing to write.
+    """
+    global _last_refresh
+    today = date.today()
+    created_at = {"$gte": make_timezone_aware(start)} if start else {"$exists": True}
+    counts = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+
+    pipeline = [{"$match": {"created_at": created_at}},
+                {"$group": {"_id": local_day_expression("$created_at"),
+                            "message": {"$sum": {"$cond": [{"$eq": ["$handler", "bot"]}, 1, 0]}},
+                            "answered": {"$sum": {"$cond": [{"$ne": [{"$type": "$chatbot.qnid"}, "missing"]}, 1, 0]}},
+                            "unanswered": {"$sum": {"$cond": [{"$eq": ["$chatbot.unanswered", True]}, 1, 0]}},
+                            "conversations": {"$addToSet": {"$cond": [{"$eq": ["$handler", "bot"]},
+                                                                      "$chatbot.convo_id", "$$REMOVE"]}}}},
+                {"$project": {"message": 1, "answered": 1, "unanswered": 1,
+                              "conversation": {"$size": "$conversations"}}}]
+    async for day in message_collection.aggregate(pipeline, allowDiskUse=True):
+        counts[day['_id']] |= {"message": day['message'], "answered": day['answered'],
+                               "unanswered": day['unanswered'], "conversation": day['conversation']}
+
+    pipeline = [{"$match": {"is_active": True, "created_at": created_at}},
+                {"$group": {"_id": local_day_expression("$created_at"), "count": {"$sum": 1}}}]
+    async for day in bot_user_collection.aggregate(pipeline, allowDiskUse=True):
+        counts[day['_id']]['user'] = day['count']
+
+    if start is None:
+        if not counts:
+            return None
+        start = datetime.strptime(min(counts), '%Y-%m-%d').date()
+
+    now = get_local_datetime_now()
+    requests = []
+    current = start
+    while current <= today:
+        key = day_key(current)
+        doc = counts[key] | {"date": make_timezone_aware(current), "closed": current < today, "updated_at": now}
+        requests.append(UpdateOne({"_id": key}, {"$set": doc}, upsert=True))
+        current += timedelta(days=1)
+
+    if requests:
+        await dashboard_daily_collection.bulk_write(requests, ordered=False)
+    _last_refresh = time.monotonic()
+    return start if requests else None
+
+
+@leased_job(DASHBOARD_DAILY_JOB)
+async def refresh_dashboard_daily() -> str:
+    """
+    Incrementally rebuild `dashboard_daily`. Closed days are never rescanned, only the open day (today) and
+    whatever days passed since the last refresh. The very first run builds the whole history.
+    """
+    start = await get_first_open_day()
+    if not (first_day := await write_rollup_days(start)):
+        return "Refreshed 0 days."
+    return f"Refreshed {(date.today() - first_day).days + 1} days."
+
+
+@leased_job(DASHBOARD_DAILY_JOB)
+async def rebuild_dashboard_daily() -> str:
+    """
+    Build the history again, for when past messages were edited or imported. The rows are overwritten in place so
+    the dashboard keeps reading the former figures meanwhile, rows outside the rebuilt days are dropped.
+    """
+    first_day = await write_rollup_days(None)
+    outside = {"$or": [{"_id": {"$lt": day_key(first_day)}}, {"_id": {"$gt": day_key(date.today())}}]} \
+        if first_day else {}
+    await dashboard_daily_collection.delete_many(outside)
+    if not first_day:
+        return "Refreshed 0 days."
+    return f"Refreshed {(date.today() - first_day).days + 1} days."
+
+
+async def ensure_dashboard_daily_fresh(max_age: float = ROLLUP_MAX_AGE_SECONDS):
+    """
+    Refresh the open day if the last refresh of this process is older than `max_age` seconds. Concurrent dashboard
+    requests share a single refresh.
+    """
+    global _refresh_lock
+    if time.monotonic() - _last_refresh < max_age:
+        return
+    _refresh_lock = _refresh_lock or asyncio.Lock()
+    async with _refresh_lock:
+        if time.monotonic() - _last_refresh < max_age:
+            return
+        await refresh_dashboard_daily()
+
+
+def day_key_query(*, start: Union[date, datetime] = None, end: Union[date, datetime] = None) -> dict:
+    """
+    Query on day keyed `_id`s. A plain `date` end is exclusive (midnight), a `datetime` end includes its day,
+    matching how the dashboard passes `end=now` for to-date figures.
+    """
+    day_range = {}
+    if start:
+        day_range["$gte"] = day_key(start)
+    if end:
+        day_range["$lte" if isinstance(end, datetime) else "$lt"] = day_key(end)
+    return {"_id": day_range} if day_range else {}
+
+
+async def get_daily_rollup(start: date, end: date) -> dict[str, dict]:
+    """
+    Rollup rows of the local days start..end (both inclusive), keyed by day
+    """
+    await ensure_dashboard_daily_fresh()
+    query = {"_id": {"$gte": day_key(start), "$lte": day_key(end)}}
+    return {row['_id']: row async for row in dashboard_daily_collection.find(query)}
+
+
+async def get_daily_rollup_sum(field: str, *, start: Union[date, datetime] = None,
+                               end: Union[date, datetime] = None) -> int:
+    """
+    Sum one rollup counter over whole local days, see `day_key_query` for the bounds
+    :param field: one of ROLLUP_FIELDS
+    """
+    await ensure_dashboard_daily_fresh()
+    pipeline = [{"$match": day_key_query(start=start, end=end)},
+                {"$group": {"_id": None, "count": {"$sum": f"${field}"}}}]
+    async for total in dashboard_daily_collection.aggregate(pipeline):
+        return total['count']
+    return 0
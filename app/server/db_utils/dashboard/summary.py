@@ -1,8 +1,12 @@
 from datetime import date, timedelta, datetime
 from enum import Enum, auto
 
+from motor.core import AgnosticCollection
+
 from app.server.db.collections import message_collection, bot_user_collection
-from app.server.utils.common import form_query
+from app.server.db_utils.conversation_summary import count_conversations, USER_CONVERSATION_MESSAGE
+from app.server.db_utils.dashboard.distinct import get_distinct_estimate
+from app.server.db_utils.dashboard.rollup import get_daily_rollup_sum
 from app.server.utils.timezone import make_timezone_aware
 
 
@@ -13,43 +17,90 @@ class DashboardSummary(Enum):
     ANSWER_RATE = auto()
 
 
-class DashboardMessage:
-    async def get_count(self, *, start: date = None, end: date = None) -> int:
-        db_key = [("handler", "bot"),
-                  ("created_at", {"$gte": make_timezone_aware(start)} if start else ...),
-                  ("created_at", {"$lte": make_timezone_aware(end)} if end else ...)]
-        query = form_query(db_key)
+class SummaryMode(str, Enum):
+    ROLLUP = 'rollup'  # sum pre-aggregated daily rows
+    FACET = 'facet'  # one $facet pass over the raw collection
+
+
+def get_summary_periods() -> dict[str, tuple]:
+    """
+    # (start, end) of every period a top card shows. Open periods end now, closed ones at midnight
+    :return:
+    """
+    today = date.today()
+    now = datetime.now()
+    start_of_this_month = today.replace(day=1)  # get first day of this month and put it at 0:00
+    start_of_last_month = (start_of_this_month - timedelta(days=1)).replace(day=1)
+    monday_of_this_week = today - timedelta(days=today.weekday())
+    monday_of_last_week = today - timedelta(days=7)
+    return {
+        "total": (None, None),
+        "this_month": (start_of_this_month, now),
+        "last_month": (start_of_last_month, start_of_this_month),
+        "this_week": (monday_of_this_week, now),
+        "last_week": (monday_of_last_week, monday_of_this_week),
+        "today": (today, now),
+    }
 
-        return await message_collection.count_documents(query)
 
+def get_monthly_trend(count_now: int, count_last_month: int) -> (float, (int, int)):
+    count_last_month = count_last_month or 1  # when zero count
+    normalized_count = (count_now / date.today().day) * 30
+    return (normalized_count / count_last_month) - 1, (count_now, count_last_month)
+
+
+def get_weekly_trend(count_now: int, count_last_week: int) -> (float, (int, int)):
+    count_last_week = count_last_week or 1  # when zero count
+    normalized_count = (count_now / date.today().isoweekday()) * 7
+    return (normalized_count / count_last_week) - 1, (count_now, count_last_week)
+
+
+def get_facet_pipeline(match: dict, count_stages: list[dict], periods: dict[str, tuple]) -> list[dict]:
+    """
+    Bucket `created_at` into every period in a single collection pass, each facet ends with the count stages
+    """
+    facets = {}
+    for period, (start, end) in periods.items():
+        created_at = {}
+        if start:
+            created_at["$gte"] = make_timezone_aware(start)
+        if end:
+            created_at["$lte"] = make_timezone_aware(end)
+        bucket = [{"$match": {"created_at": created_at}}] if created_at else []
+        facets[period] = bucket + count_stages
+    return [{"$match": match}, {"$facet": facets}]
+
+
+class DashboardMessage:
+    collection: AgnosticCollection = message_collection
+    facet_match = {"handler": "bot"}
+    facet_count_stages = [{"$count": "count"}]
 
-class DashboardUser:
     async def get_count(self, *, start: date = None, end: date = None) -> int:
-        db_key = [("is_active", True),
-                  ("created_at", {"$gte": make_timezone_aware(start)} if start else ...),
-                  ("created_at", {"$lte": make_timezone_aware(end)} if end else ...)]
-        query = form_query(db_key)
+        return await get_daily_rollup_sum('message', start=start, end=end)
 
-        return await bot_user_collection.count_documents(query)
 
+class DashboardUser:
+    collection: AgnosticCollection = bot_user_collection
+    facet_match = {"is_active": True}
+    facet_count_stages = [{"$count": "count"}]
 
-class DashboardConversation:
     async def get_count(self, *, start: date = None, end: date = None) -> int:
-        db_key = [("handler", "bot"),
-                  ("created_at", {"$gte": make_timezone_aware(start)} if start else ...),
-                  ("created_at", {"$lte": make_timezone_aware(end)} if end else ...)]
-        query = form_query(db_key)
+        return await get_daily_rollup_sum('user', start=start, end=end)
 
-        pipeline = [{"$match": query},
-                    {"$group": {"_id": None,
-                                "count": {"$addToSet": "$chatbot.convo_id"}}},
-                    {"$project": {"count": {"$size": "$count"}}}]
 
-        cursor = message_collection.aggregate(pipeline)
-        async for count in cursor:
-            return count['count']
+class DashboardConversation:
+    collection: AgnosticCollection = message_collection
+    distinct_field = 'conversations'  # HyperLogLog counters giving distinct conversations over any range
+    facet_match = USER_CONVERSATION_MESSAGE
+    facet_count_stages = [{"$group": {"_id": "$chatbot.convo_id"}},
+                          {"$count": "count"}]
 
-        return len(list(await message_collection.distinct("chatbot.convo_id", query)))
+    async def get_count(self, *, start: date = None, end: date = None) -> int:
+        """
+        Conversations with a user message in the period, each counted once however many days it spans
+        """
+        return await count_conversations(start=start, end=end)
 
 
 class Dashboard:
@@ -62,31 +113,61 @@ class Dashboard:
     def __init__(self, item: DashboardSummary):
         self.dashboard_summary = self._choice[item]()
 
+    async def get_period_counts(self, mode: SummaryMode = SummaryMode.ROLLUP, exact: bool = True) -> dict[str, int]:
+        """
+        :param exact: False estimates distinct counts (conversations) with the daily HyperLogLogs
+        """
+        periods = get_summary_periods()
+        if not exact and (distinct_field := getattr(self.dashboard_summary, 'distinct_field', None)):
+            return {period: await get_distinct_estimate(distinct_field, start=start, end=end)
+                    for period, (start, end) in periods.items()}
+        if mode == SummaryMode.FACET:
+            summary = self.dashboard_summary
+            pipeline = get_facet_pipeline(summary.facet_match, summary.facet_count_stages, periods)
+            async for facets in summary.collection.aggregate(pipeline, allowDiskUse=True):
+                return {period: result[0]['count'] if result else 0 for period, result in facets.items()}
+            return dict.fromkeys(periods, 0)
+
+        return {period: await self.dashboard_summary.get_count(start=start, end=end)
+                for period, (start, end) in periods.items()}
+
+    async def get_card(self, mode: SummaryMode = SummaryMode.ROLLUP, exact: bool = True) -> dict:
+        """
+        # Everything a top card shows, computed from one set of period counts
+        :return:
+        """
+        counts = await self.get_period_counts(mode, exact)
+        weekly_trend_percentage, (wtd_count, count_last_week) = get_weekly_trend(counts['this_week'],
+                                                                                 counts['last_week'])
+        monthly_trend_percentage, (mtd_count, count_last_month) = get_monthly_trend(counts['this_month'],
+                                                                                    counts['last_month'])
+        return {
+            "total": counts['total'],
+            "monthlyTrend": monthly_trend_percentage,
+            "monthlyTarget": {"count": mtd_count, "target": count_last_month},
+            "weeklyTrend": weekly_trend_percentage,
+            "weeklyTarget": {"count": wtd_count, "target": count_last_week},
+            "daily": counts['today']
+        }
+
     async def get_total_count(self) -> int:
         return await self.dashboard_summary.get_count()
 
     async def get_monthly_trend(self) -> (float, str):
-        end_of_last_month = date.today().replace(day=1)  # get first day of this month and put it at 0:00
-        start_of_last_month = (end_of_last_month - timedelta(days=1)).replace(day=1)
-        count_last_month = await self.dashboard_summary.get_count(start=start_of_last_month, end=end_of_last_month)
-        count_last_month = count_last_month or 1  # when zero count
-
-        now = datetime.now()
-        count_now = await self.dashboard_summary.get_count(start=end_of_last_month, end=now)
-        normalized_count = (count_now / date.today().day) * 30
-        return (normalized_count / count_last_month) - 1, (count_now, count_last_month)
+        periods = get_summary_periods()
+        count_last_month = await self.dashboard_summary.get_count(start=periods['last_month'][0],
+                                                                  end=periods['last_month'][1])
+        count_now = await self.dashboard_summary.get_count(start=periods['this_month'][0],
+                                                           end=periods['this_month'][1])
+        return get_monthly_trend(count_now, count_last_month)
 
     async def get_weekly_trend(self) -> (float, str):
-        today = date.today()
-        monday_of_this_week = today - timedelta(days=today.weekday())
-        monday_of_last_week = today - timedelta(days=7)
-        count_last_week = await self.dashboard_summary.get_count(start=monday_of_last_week, end=monday_of_this_week)
-        count_last_week = count_last_week or 1  # when zero count
-
-        now = datetime.now()
-        count_now = await self.dashboard_summary.get_count(start=monday_of_this_week, end=now)
-        normalized_count = (count_now / date.today().isoweekday()) * 7
-        return (normalized_count / count_last_week) - 1, (count_now, count_last_week)
+        periods = get_summary_periods()
+        count_last_week = await self.dashboard_summary.get_count(start=periods['last_week'][0],
+                                                                 end=periods['last_week'][1])
+        count_now = await self.dashboard_summary.get_count(start=periods['this_week'][0],
+                                                           end=periods['this_week'][1])
+        return get_weekly_trend(count_now, count_last_week)
 
     async def get_today_count(self) -> int:
         start = date.today()
@@ -95,22 +176,55 @@ class Dashboard:
         return count_now
 
 
+def get_answered_rate(answered_count: int, unanswered_count: int) -> dict:
+    total = answered_count + unanswered_count
+    return {"answered": answered_count,
+            "unanswered": unanswered_count,
+            "total": total,
+            "rate": answered_count / total if total else None}
+
+
 class DashboardAnswerRate:
+    facet_match = {"$or": [{"chatbot.qnid": {"$exists": True}},
+                           {"chatbot.unanswered": True}]}
+    facet_count_stages = [{"$group": {"_id": None,
+                                      "answered": {"$sum": {"$cond": [
+                                          {"$ne": [{"$type": "$chatbot.qnid"}, "missing"]}, 1, 0]}},
+                                      "unanswered": {"$sum": {"$cond": [
+                                          {"$eq": ["$chatbot.unanswered", True]}, 1, 0]}}}}]
+
+    async def get_card(self, mode: SummaryMode = SummaryMode.ROLLUP) -> dict:
+        """
+        # Answered/unanswered counts and rate of the total, monthly and weekly periods. Rates reuse the counts
+        :return:
+        """
+        periods = {period: dates for period, dates in get_summary_periods().items()
+                   if period in ("total", "this_month", "this_week")}
+        counts = {}
+        if mode == SummaryMode.FACET:
+            pipeline = get_facet_pipeline(self.facet_match, self.facet_count_stages, periods)
+            async for facets in message_collection.aggregate(pipeline, allowDiskUse=True):
+                counts = {period: (result[0]['answered'], result[0]['unanswered']) if result else (0, 0)
+                          for period, result in facets.items()}
+        else:
+            for period, (start, end) in periods.items():
+                counts[period] = (await self.get_answered_count(start=start, end=end),
+                                  await self.get_unanswered_count(start=start, end=end))
+
+        return {
+            "total": get_answered_rate(*counts.get('total', (0, 0))),
+            "monthly": get_answered_rate(*counts.get('this_month', (0, 0))),
+            "weekly": get_answered_rate(*counts.get('this_week', (0, 0))),
+        }
+
     async def get_total_answered_rate(self) -> float:
-        answered_count = await self.get_answered_count()
-        unanswered_count = await self.get_unanswered_count()
-        total = answered_count + unanswered_count
-        return answered_count / total if total else None
+        return get_answered_rate(*(await self.get_total_answered_count())[:2])['rate']
 
     async def get_monthly_answered_rate(self) -> float:
-        answered_count, unanswered_count, total = await self.get_monthly_answered_count()
-        total = answered_count + unanswered_count
-        return answered_count / total if total else None
+        return get_answered_rate(*(await self.get_monthly_answered_count())[:2])['rate']
 
     async def get_weekly_answered_rate(self) -> float:
-        answered_count, unanswered_count, total = await self.get_weekly_answered_count()
-        total = answered_count + unanswered_count
-        return answered_count / total if total else None
+        return get_answered_rate(*(await self.get_weekly_answered_count())[:2])['rate']
 
     async def get_total_answered_count(self) -> (float, str):
         answered_count = await self.get_answered_count()
@@ -142,19 +256,10 @@ class DashboardAnswerRate:
         now = datetime.now()
         answered_count = await self.get_answered_count(start=start, end=now)
         unanswered_count = await self.get_unanswered_count(start=start, end=now)
-        total = answered_count + unanswered_count
-        return answered_count / total if total else None
+        return get_answered_rate(answered_count, unanswered_count)['rate']
 
     async def get_answered_count(self, *, start: date = None, end: date = None) -> int:
-        db_key = [("chatbot.qnid", {"$exists": True}),
-                  ("created_at", {"$gte": make_timezone_aware(start)} if start else ...),
-                  ("created_at", {"$lte": make_timezone_aware(end)} if end else ...)]
-        query = form_query(db_key)
-        return await message_collection.count_documents(query)
+        return await get_daily_rollup_sum('answered', start=start, end=end)
 
     async def get_unanswered_count(self, *, start: date = None, end: date = None) -> int:
-        db_key = [("chatbot.unanswered", True),
-                  ("created_at", {"$gte": make_timezone_aware(start)} if start else ...),
-                  ("created_at", {"$lte": make_timezone_aware(end)} if end else ...)]
-        query = form_query(db_key)
-        return await message_collection.count_documents(query)
+        return await get_daily_rollup_sum('unanswered', start=start, end=end)
@@ -0,0 +1,127 @@
+from datetime import date, datetime, time, timedelta
+from typing import Any
+
+import pytz
+from motor.core import AgnosticCollection
+
+from app.server.core.env_variables import local_config
+from app.server.db_utils.dashboard.day_cache import get_day_cells, iterate_days, period_start
+from app.server.db_utils.dashboard.rollup import day_key, local_day_range
+from app.server.models.dashboard import Granularity
+
+
+class Metric:
+    """
+    One value of every bucket. `accumulator` is the $group accumulator, `output` an optional expression finishing
+    it (e.g. the $size of a set) and `default` the value of buckets without data.
+    """
+
+    def __init__(self, name: str, accumulator: dict, output: Any = None, default: Any = 0):
+        self.name = name
+        self.accumulator = accumulator
+        self.output = output
+        self.default = default
+
+    def output_expression(self) -> dict:
+        return {"$ifNull": [self.output or f"${self.name}", self.default]}
+
+
+def count_metric(name: str, condition: dict = None) -> Metric:
+    """
+    Number of documents in the bucket, only those matching the aggregation `condition` if given
+    """
+    return Metric(name, {"$sum": {"$cond": [condition, 1, 0]} if condition else 1})
+
+
+def distinct_metric(name: str, field: str, condition: dict = None) -> Metric:
+    """
+    Number of distinct values of `field` in the bucket, only of documents matching `condition` if given
+    """
+    value = {"$cond": [condition, field, "$$REMOVE"]} if condition else field
+    return Metric(name, {"$addToSet": value}, {"$size": {"$ifNull": [f"${name}", []]}})
+
+
+def bucket_expression(field: str, granularity: Granularity) -> dict:
+    """
+    Start of the hour, day, ISO week or month containing a datetime field, in the configured timezone
+    """
+    return {"$dateTrunc": {"date": field, "unit": granularity.value, "timezone": local_config.TIMEZONE,
+                           "startOfWeek": "monday"}}
+
+
+def local_wall_clock(field: str) -> dict:
+    """
+    Local date and time of a datetime field stored as if it were UTC, so $densify steps whole local days and months
+    """
+    return {"$let": {"vars": {"parts": {"$dateToParts": {"date": field, "timezone": local_config.TIMEZONE}}},
+                     "in": {"$dateFromParts": {"year": "$$parts.year", "month": "$$parts.month",
+                                               "day": "$$parts.day", "hour": "$$parts.hour"}}}}
+
+
+class TimeSeries:
+    """
+    Metrics of a collection bucketed by hour, day, ISO week or month of `created_at` in a single pipeline.
+    Buckets without data are filled in by the server, so a series always has one entry per period of the range.
+    Documents of other collections can be mixed in with `union`, they carry their collection name in `source`.
+    """
+
+    def __init__(self, name: str, collection: AgnosticCollection, metrics: list[Metric], *,
+                 match: dict = None, union: dict[str, dict] = None):
+        """
+        :param name: day cache namespace, change it whenever the metrics change
+        :param match: filter of the collection documents
+        :param union: {collection name: filter} of the documents of other collections to add
+        """
+        self.name = name
+        self.collection = collection
+        self.metrics = metrics
+        self.match = match or {}
+        self.union = union or {}
+
+    def pipeline(self, start: date, end: date, granularity: Granularity) -> list[dict]:
+        created_at = local_day_range(start, end)
+        pipeline = [{"$match": self.match | {"created_at": created_at}}]
+        for source, match in self.union.items():
+            pipeline.append({"$unionWith": {"coll": source,
+                                            "pipeline": [{"$match": match | {"created_at": created_at}},
+                                                         {"$set": {"source": source}}]}})
+
+        # bounds are in the same naive local time as the buckets, the upper one is exclusive
+        bounds = [datetime.combine(period_start(start, granularity), time.min),
+                  datetime.combine(end + timedelta(days=1), time.min)]
+        pipeline += [
+            {"$group": {"_id": bucket_expression("$created_at", granularity)} |
+                       {metric.name: metric.accumulator for metric in self.metrics}},
+            {"$set": {"bucket": local_wall_clock("$_id")}},
+            {"$densify": {"field": "bucket", "range": {"step": 1, "unit": granularity.value, "bounds": bounds}}},
+            {"$project": {"_id": 0, "bucket": 1} |
+                         {metric.name: metric.output_expression() for metric in self.metrics}},
+            {"$sort": {"bucket": 1}},
+        ]
+        return pipeline
+
+    async def query(self, start: date, end: date, granularity: Granularity) -> list[dict]:
+        """
+        Buckets of the local days start..end (both inclusive) in order, `bucket` is the naive local period start
+        """
+        res = []
+        async for bucket in self.collection.aggregate(self.pipeline(start, end, granularity), allowDiskUse=True):
+            # the codec converted the wall clock stored as UTC to the local timezone, read it back as UTC
+            bucket['bucket'] = bucket['bucket'].astimezone(pytz.utc).replace(tzinfo=None)
+            res.append(bucket)
+        return res
+
+    async def day_cells(self, start: date, end: date) -> dict[str, dict]:
+        return {day_key(bucket.pop('bucket')): bucket for bucket in await self.query(start, end, Granularity.DAY)}
+
+    async def get_periods(self, start: date, end: date, granularity: Granularity) -> list[tuple[date, dict]]:
+        """
+        (period start, metrics) of every day, week or month of the range. Days go through the day cache, longer
+        periods are computed directly since distinct counts of days do not add up.
+        """
+        if granularity != Granularity.DAY:
+            return [(bucket.pop('bucket').date(), bucket) for bucket in await self.query(start, end, granularity)]
+
+        cells = await get_day_cells(self.name, start, end, self.day_cells)
+        empty = {metric.name: metric.default for metric in self.metrics}
+        return [(day, cells.get(day_key(day)) or empty) for day in iterate_days(start, end)]
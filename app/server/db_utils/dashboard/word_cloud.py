@@ -0,0 +1,104 @@
+from collections import Counter
+from datetime import date
+
+from bson import SON
+from pymongo import UpdateOne
+
+from app.server.db.collections import term_frequency_collection
+from app.server.db_utils.dashboard.rollup import day_key
+from app.server.db_utils.helper import common_helper
+from app.server.db_utils.watermark import iterate_new_messages, get_job_state, update_job_state, reset_job_state, \
+    leased_job, not_applied, bulk_write_batch
+from app.server.utils.tokenizer import word_cloud_terms
+
+WORD_CLOUD_JOB = 'word_cloud'
+WORD_CLOUD_DAY_TOP_K = 500  # terms kept per day and n-gram size once a day is closed
+WORD_CLOUD_BATCHES_PER_RUN = 20
+
+
+async def create_word_cloud_indexes():
+    await term_frequency_collection.create_index([("day", 1), ("term", 1)], unique=True)
+    await term_frequency_collection.create_index([("day", 1), ("n", 1), ("count", -1)])
+
+
+@leased_job(WORD_CLOUD_JOB)
+async def refresh_word_cloud(*, batch_size: int = 1000) -> str:
+    """
+    Tokenize the bot messages received since the last run into per day term counts of `term_frequency`
+    """
+    indexed = 0
+    indexed_day = None
+    async for messages in iterate_new_messages(WORD_CLOUD_JOB,
+                                               query={"handler": "bot", "data.text": {"$type": "string"}},
+                                               projection={"created_at": 1, "data.text": 1},
+                                               batch_size=batch_size, max_batches=WORD_CLOUD_BATCHES_PER_RUN):
+        counts = Counter()
+        for message in messages:
+            day = day_key(message['created_at'])
+            for n, term in word_cloud_terms(message['data']['text']):
+                counts[(day, n, term)] += 1
+
+        if counts:
+            batch_id = messages[-1]['_id']
+            requests = [UpdateOne({"day": day, "term": term} | not_applied(batch_id),
+                                  {"$inc": {"count": count}, "$set": {"applied_through": batch_id},
+                                   "$setOnInsert": {"n": n}},
+                                  upsert=True)
+                        for (day, n, term), count in counts.items()]
+            await bulk_write_batch(term_frequency_collection, requests)
+        indexed += len(messages)
+        indexed_day = day_key(messages[-1]['created_at'])
+
+    if indexed_day:
+        await update_job_state(WORD_CLOUD_JOB, indexed_day=indexed_day)
+    pruned = await prune_word_cloud_days()
+    return f"Indexed {indexed} messages and pruned {pruned} days."
+
+
+async def prune_word_cloud_days() -> int:
+    """
+    # Trim every finished day to its WORD_CLOUD_DAY_TOP_K terms per n-gram size, so ranges merge small tables
+    :return:
+    """
+    state = await get_job_state(WORD_CLOUD_JOB)
+    if not (indexed_day := state.get('indexed_day')):
+        return 0
+    # the day of the watermark may still get messages, so is today
+    closed_before = min(indexed_day, day_key(date.today()))
+    day_range = {"$lt": closed_before}
+    if pruned_through := state.get('pruned_through'):
+        day_range["$gt"] = pruned_through
+
+    days = sorted(await term_frequency_collection.distinct('day', {"day": day_range}))
+    for day in days:
+        for n in (1, 2):
+            cursor = term_frequency_collection.find({"day": day, "n": n}, projection={"count": 1},
+                                                    sort=[("count", -1)], skip=WORD_CLOUD_DAY_TOP_K - 1, limit=1)
+            async for threshold in cursor:
+                await term_frequency_collection.delete_many({"day": day, "n": n,
+                                                             "count": {"$lt": threshold['count']}})
+    if days:
+        await update_job_state(WORD_CLOUD_JOB, pruned_through=days[-1])
+    return len(days)
+
+
+@leased_job(WORD_CLOUD_JOB)
+async def rebuild_word_cloud() -> str:
+    await term_frequency_collection.delete_many({})
+    await reset_job_state(WORD_CLOUD_JOB)
+    return await refresh_word_cloud()
+
+
+async def get_word_cloud(start: date, end: date, *, bigrams: bool = False, limit: int = 80) -> list[dict]:
+    """
+    Most frequent terms of the local days start..end (both inclusive), merged from the per day tables
+    """
+    pipeline = [{"$match": {"day": {"$gte": day_key(start), "$lte": day_key(end)},
+                            "n": {"$in": [1, 2] if bigrams else [1]}}},
+                {"$group": {"_id": "$term", "count": {"$sum": "$count"}}},
+                {"$sort": SON([("count", -1)])},
+                {"$limit": limit}]
+    res = []
+    async for item in term_frequency_collection.aggregate(pipeline):
+        res.append(common_helper(item))
+    return res
@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, timedelta
+from enum import Enum
+from typing import AsyncIterator
+
+from bson import ObjectId
+
+from app.server.db.collections import bot_user_collection, message_collection
+from app.server.db_utils.dashboard.rollup import local_day_range
+from app.server.utils.timezone import make_timezone_aware
+
+EXPORT_BATCH_SIZE = 2000  # messages per cursor round trip
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes buffered before a chunk is sent
+EXPORT_FIELDS = ['id', 'convo_id', 'created_at', 'handler', 'sender_id', 'receiver_id', 'platform', 'type', 'text',
+                 'qnid', 'unanswered']
+
+
+class ExportFormat(str, Enum):
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+    @property
+    def media_type(self) -> str:
+        return 'application/x-ndjson' if self == ExportFormat.NDJSON else 'text/csv'
+
+
+async def get_export_query(*, user_id: str = None, tag: str = None, convo_id: str = None, start: date = None,
+                           end: date = None) -> dict:
+    """
+    Message filter of a transcript export, every given filter applies. `start` and `end` are local days, both
+    inclusive.
+    """
+    conditions = []
+    if user_id:
+        conditions.append({"$or": [{"sender_id": ObjectId(user_id)}, {"receiver_id": ObjectId(user_id)}]})
+    if tag:
+        user_ids = await bot_user_collection.distinct('_id', {"tags": tag})
+        conditions.append({"$or": [{"sender_id": {"$in": user_ids}}, {"receiver_id": {"$in": user_ids}}]})
+    if convo_id:
+        conditions.append({"chatbot.convo_id": convo_id})
+    if start and end:
+        conditions.append({"created_at": local_day_range(start, end)})
+    elif start:
+        conditions.append({"created_at": {"$gte": make_timezone_aware(start)}})
+    elif end:
+        conditions.append({"created_at": {"$lt": make_timezone_aware(end + timedelta(days=1))}})
+    if not conditions:
+        return {}
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def export_row(message: dict) -> dict:
+    chatbot = message.get('chatbot') or {}
+    text = (message.get('data') or {}).get('text')
+    return {
+        "id": str(message['_id']),
+        "convo_id": chatbot.get('convo_id'),
+        "created_at": message['created_at'].isoformat() if message.get('created_at') else None,
+        "handler": message.get('handler'),
+        "sender_id": str(message['sender_id']) if message.get('sender_id') else None,
+        "receiver_id": str(message['receiver_id']) if message.get('receiver_id') else None,
+        "platform": message.get('platform'),
+        "type": message.get('type'),
+        "text": text if isinstance(text, str) else None,
+        "qnid": str(chatbot['qnid']) if chatbot.get('qnid') else None,
+        "unanswered": chatbot.get('unanswered', False),
+    }
+
+
+async def iterate_export_rows(query: dict) -> AsyncIterator[dict]:
+    """
+    Rows of the matching messages, oldest first. The cursor fetches one batch at a time, so only a batch is ever
+    held in memory whatever the size of the export.
+    """
+    cursor = message_collection.find(query, projection={"created_at": 1, "handler": 1, "sender_id": 1,
+                                                        "receiver_id": 1, "platform": 1, "type": 1, "data.text": 1,
+                                                        "chatbot.convo_id": 1, "chatbot.qnid": 1,
+                                                        "chatbot.unanswered": 1},
+                                     sort=[("_id", 1)], batch_size=EXPORT_BATCH_SIZE)
+    async for message in cursor:
+        yield export_row(message)
+
+
+async def iterate_export_chunks(rows: AsyncIterator[dict], export_format: ExportFormat) -> AsyncIterator[bytes]:
+    """
+    Encoded rows grouped in chunks of about EXPORT_CHUNK_SIZE bytes, CSV starts with a header line
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if export_format == ExportFormat.CSV:
+        writer.writeheader()
+    async for row in rows:
+        if export_format == ExportFormat.CSV:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write('\n')
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    async for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(query: dict, export_format: ExportFormat, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Body of a transcript export, to be sent with a StreamingResponse
+    .. code-block:: python
+        query = await get_export_query(tag='vip', start=date(2021, 1, 1))
+        StreamingResponse(stream_export(query, ExportFormat.CSV, compress=True), media_type='text/csv')
+    """
+    chunks = iterate_export_chunks(iterate_export_rows(query), export_format)
+    return gzip_chunks(chunks) if compress else chunks
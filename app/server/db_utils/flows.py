@@ -1,10 +1,10 @@
 from datetime import date
 from re import escape
 
-import stringcase
 from bson import ObjectId, Regex
 
 from app.server.db.collections import flow_collection as collection
+from app.server.db_utils.pagination import CountMode, PageCount, get_page_and_count, skip_stages, sort_from_sorter
 from app.server.models.current_user import CurrentUserSchema
 from app.server.models.flow import FlowSchemaDb, NewFlow, FlowItemCreateIn, FlowItem, FlowTypeEnum, QuickReplyPayload, \
     FlowItemEditIn, FlowSchemaDbOut, FlowTypeEnumOut
@@ -28,9 +28,17 @@ async def get_flow_one(_id: str) -> FlowSchemaDbOut:
         return FlowSchemaDbOut(**flow_helper(flow))
 
 
+async def get_flows_by_ids(ids: list) -> dict[str, FlowSchemaDbOut]:
+    """
+    {id: flow} of every flow of `ids` found, in one query
+    """
+    query = {"_id": {"$in": list({ObjectId(_id) for _id in ids})}}
+    return {str(flow['_id']): FlowSchemaDbOut(**flow_helper(flow)) async for flow in collection.find(query)}
+
+
 async def get_flows_and_count_db(*, current_page: int, page_size: int, sorter: str = None, flow_name: str,
-                                 language: str, updated_at: list[date], triggered_counts: list[int]) -> (
-        list[FlowSchemaDb], int):
+                                 language: str, updated_at: list[date], triggered_counts: list[int],
+                                 count_mode: CountMode = CountMode.EXACT) -> (list[FlowSchemaDb], PageCount):
     if updated_at:
         updated_at_start, updated_at_end = updated_at
     db_key = [(f"name", {"$ne": None}),
@@ -42,23 +50,15 @@ async def get_flows_and_count_db(*, current_page: int, page_size: int, sorter: s
                               "$lte": make_timezone_aware(updated_at_end)} if updated_at else ...)]
     query = form_query(db_key)
 
-    flows = await get_flows_db(current_page=current_page, page_size=page_size, sorter=sorter, query=query)
-    total = await get_flows_count_db(query=query)
-    return flows, total
+    page_stages = skip_stages(sort=sort_from_sorter(sorter), current_page=current_page, page_size=page_size)
+    items, count = await get_page_and_count(collection, query=query, page_stages=page_stages, count_mode=count_mode)
+    flows = [FlowSchemaDbOut(**flow_helper(flow)) for flow in items]
+    return flows, count
 
 
 async def get_flows_db(*, current_page: int, page_size: int, sorter: str = None, query: dict) -> list[FlowSchemaDbOut]:
     # always show the newest first
-    sort = [("_id", -1)]
-    if sorter:
-        # [("answers", 1), ("bot_user_group", 1)]
-        for s in sorter.split(','):
-            order = s[:1]
-            key = s[1:]
-            if order == '+':
-                sort = [(stringcase.snakecase(key), 1)]
-            else:
-                sort = [(stringcase.snakecase(key), -1)]
+    sort = sort_from_sorter(sorter)
 
     cursor = collection.find(query, sort=sort)
     cursor.skip((current_page - 1) * page_size).limit(page_size)
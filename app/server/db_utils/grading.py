@@ -1,99 +1,230 @@
+import hashlib
+import json
 import uuid
 from datetime import date
 from re import escape
+from typing import Optional, NamedTuple
 
 from bson import ObjectId, Regex
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-from app.server.db.collections import message_collection
+from app.server.db.collections import message_collection, grading_queue_collection
 from app.server.db.collections import question_collection
-from app.server.db_utils.bot_user import get_bot_user_db
-from app.server.db_utils.flows import get_flow_one
+from app.server.db_utils.bot_user import get_bot_user_names
+from app.server.db_utils.flows import get_flows_by_ids
 from app.server.db_utils.helper import message_helper
-from app.server.db_utils.questions import get_question_one
+from app.server.db_utils.message_search import search_messages, SearchResults
+from app.server.db_utils.pagination import CountMode, PageCount, get_page_and_count, skip_stages
+from app.server.db_utils.questions import get_questions_by_ids
 from app.server.models.current_user import CurrentUserSchema
-from app.server.models.message import MessageGradingSchemaDb, SkipMessage, UpdateMessageResponse
+from app.server.models.message import MessageGradingSchemaDb, SkipMessage, UpdateMessageResponse, BulkGradingResult, \
+    GradingFacets
+from app.server.utils.cache import TTLCache
 from app.server.utils.common import form_query
 from app.server.utils.timezone import get_local_datetime_now, make_timezone_aware
 
+MAX_SEARCH_HITS = 5000
+MAX_TOPIC_FACETS = 50
+SCORE_BOUNDARIES = [step / 10 for step in range(10)] + [1.000001]  # ten buckets, the last one includes 1.0
+GRADING_FACETS_TTL_SECONDS = 30
 
-async def get_grading_messages_and_count_db(topic: str, search_query: str, accuracy: list[float],
-                                            current_page: int, page_size: int, question_status: str, since: list[date]):
-    if since:
-        question_start = make_timezone_aware(since[0])
-        question_end = make_timezone_aware(since[1])
-
-    if question_status == 'Unanswered':
-        db_key = [
-            ("$text", {"$search": f"\"{search_query}\""} if search_query else ...),
-            ("handler", "bot"),
-            ("type", "message"),
-            ("chatbot.unanswered", True),
-            ("adminportal.graded", None),
-            ("created_at", {"$gte": question_start, "$lte": question_end} if since else ...)
-        ]
+grading_facets_cache = TTLCache(maxsize=256, ttl=GRADING_FACETS_TTL_SECONDS)
+
+
+def grading_question_id(message: dict) -> Optional[ObjectId]:
+    """
+    Question shown as the answer of a message: the graded one, else the one the bot answered with, else the first
+    NLP match
+    """
+    if qnid := message.get('adminportal', {}).get('answer'):
+        return qnid
+    if qnid := message.get('chatbot', {}).get('qnid'):
+        return qnid
+    if qns := message.get('nlp', {}).get('nlp_response', {}).get('matched_questions'):
+        return qns[0]['question_id']
+    return None
+
+
+async def enrich_grading_messages(messages: list[dict]) -> list[dict]:
+    """
+    Add the sender name, answer question and its flow to a page of messages with one query per kind: bot users,
+    then questions, then flows, whatever the page size
+    """
+    sender_ids = [message['sender_id'] for message in messages if message.get('sender_id')]
+    names = await get_bot_user_names(sender_ids) if sender_ids else {}
+    question_ids = {message['_id']: qnid for message in messages if (qnid := grading_question_id(message))}
+    questions = await get_questions_by_ids(list(question_ids.values())) if question_ids else {}
+    # the flow of the last answer is the one shown
+    flow_ids = {question_id: question.answers[-1].flow['flow_id']
+                for question_id, question in questions.items() if question.answers}
+    flows = await get_flows_by_ids(list(flow_ids.values())) if flow_ids else {}
+
+    for message in messages:
+        message['fullname'] = names.get(str(message.get('sender_id'))) or 'User'
+        question_id = str(question_ids.get(message['_id']))
+        if flow_id := flow_ids.get(question_id):
+            message['answer_question'] = questions[question_id]
+            message['answer_flow'] = flows.get(str(flow_id))
+    return messages
+
+
+TOPIC_FIELD = "nlp.nlp_response.matched_questions.0.question_topic"
+SCORE_FIELD = "nlp.nlp_response.matched_questions.0.score"
+
+
+def grading_filter_conditions(*, topic: str = None, accuracy: list[float] = None, question_status: str = None,
+                              since: list[date] = None, message_ids: list[ObjectId] = None) -> dict[str, dict]:
+    """
+    Filter of the grading list split by dimension ('base', 'topic', 'accuracy' and 'status'), so a facet can leave
+    its own dimension out. Unanswered messages have no match, topic and accuracy do not apply to them.
+    """
+    unanswered = question_status == 'Unanswered'
+    base = form_query([
+        ("_id", {"$in": message_ids} if message_ids is not None else ...),
+        ("handler", "bot"),
+        ("type", "message"),
+        ("created_at", {"$gte": make_timezone_aware(since[0]), "$lte": make_timezone_aware(since[1])}
+         if since else ...)
+    ])
+    if unanswered:
+        status = {"chatbot.unanswered": True, "adminportal.graded": None}
     elif question_status == 'Answered':
-        db_key = [
-            ("$text", {"$search": f"\"{search_query}\""} if search_query else ...),
-            ("nlp.nlp_response.matched_questions.0.question_topic", topic if topic else ...),
-            ("handler", "bot"),
-            ("type", "message"),
-            ("nlp", {"$ne": None}),
-            ("chatbot.qnid", {"$ne": None}),
-            ("nlp.nlp_response.matched_questions.0.score",
-             {"$gte": accuracy[0] / 100, "$lte": accuracy[1] / 100} if accuracy else ...),
-            ("created_at", {"$gte": question_start, "$lte": question_end} if since else ...)
-        ]
+        status = {"nlp": {"$ne": None}, "chatbot.qnid": {"$ne": None}}
     else:
-        db_key = [
-            ("$text", {"$search": f"\"{search_query}\""} if search_query else ...),
-            ("nlp.nlp_response.matched_questions.0.question_topic", topic if topic else ...),
-            ("handler", "bot"),
-            ("type", "message"),
-            ("nlp", {"$ne": None}),
-            ("nlp.nlp_response.matched_questions.0.score",
-             {"$gte": accuracy[0] / 100, "$lte": accuracy[1] / 100} if accuracy else ...),
-            ("created_at", {"$gte": question_start, "$lte": question_end} if since else ...)
-        ]
-    query = form_query(db_key)
+        status = {"nlp": {"$ne": None}}
+    return {
+        "base": base,
+        "topic": form_query([(TOPIC_FIELD, topic if topic and not unanswered else ...)]),
+        "accuracy": form_query([(SCORE_FIELD, {"$gte": accuracy[0] / 100, "$lte": accuracy[1] / 100}
+                                 if accuracy and not unanswered else ...)]),
+        "status": status,
+    }
+
+
+def build_grading_query(**filters) -> dict:
+    """
+    Query of the grading list, see `grading_filter_conditions` for the filters
+    """
+    return {key: value for conditions in grading_filter_conditions(**filters).values()
+            for key, value in conditions.items()}
+
+
+async def search_grading_messages(search_query: str, since: Optional[list[date]],
+                                  conditions: dict) -> SearchResults:
+    """
+    Best matches of a search among the messages of the grading `conditions`. The date filter is applied inside
+    the message index, the other conditions on each round of candidates, so they hold before the best are kept.
+    """
+    async def keep(message_ids: list[ObjectId]) -> set[ObjectId]:
+        cursor = message_collection.find(conditions | {"_id": {"$in": message_ids}}, projection={"_id": 1})
+        return {message['_id'] async for message in cursor}
+
+    return await search_messages(search_query, handler="bot", start=since[0] if since else None,
+                                 end=since[1] if since else None, limit=MAX_SEARCH_HITS, candidate_filter=keep)
+
+
+async def get_grading_messages_and_count_db(topic: str, search_query: str, accuracy: list[float],
+                                            current_page: int, page_size: int, question_status: str, since: list[date],
+                                            count_mode: CountMode = CountMode.EXACT):
+    filters = {"topic": topic, "accuracy": accuracy, "question_status": question_status, "since": since}
+    results = None
+    if search_query:
+        results = await search_grading_messages(search_query, since, build_grading_query(**filters))
+
+    hit_ids = [hit.message_id for hit in results.hits] if results else None
+    query = build_grading_query(**filters, message_ids=hit_ids)
     sort = [("_id", -1)]
-    cursor = message_collection.find(query, sort=sort)
-    total = await message_collection.count_documents(query)
-    cursor.skip((current_page - 1) * page_size).limit(page_size)
-    messages = []
-    async for message in cursor:
-        user = await get_bot_user_db(message['sender_id'])
-        try:
-            message['fullname'] = f"{user.first_name} {user.last_name}".strip()
-        except:
-            message['fullname'] = 'User'
-
-        if qnid := message.get('adminportal', {}).get('answer'):
-            question = await get_question_one(qnid)
-            if question:
-                for a in question.answers:
-                    flow = await get_flow_one(a.flow['flow_id'])
-                    message['answer_question'] = question
-                    message['answer_flow'] = flow
-        # flow
-        elif qnid := message.get('chatbot', {}).get('qnid'):
-            question = await get_question_one(qnid)
-            if question:
-                for a in question.answers:
-                    flow = await get_flow_one(a.flow['flow_id'])
-                    message['answer_question'] = question
-                    message['answer_flow'] = flow
-        elif qns := message.get('nlp', {}).get('nlp_response', {}).get('matched_questions',
-                                                                       {}):  # get first matched question if it does not have qnid(
-            if len(qns) > 0:
-                question = await get_question_one(qns[0]['question_id'])
-                if question:
-                    for a in question.answers:
-                        flow = await get_flow_one(a.flow['flow_id'])
-                        message['answer_question'] = question
-                        message['answer_flow'] = flow
-
-        messages.append(MessageGradingSchemaDb(**message_helper(message)))
-    return messages, total
+    page_stages = skip_stages(sort=sort, current_page=current_page, page_size=page_size)
+    if results:
+        ranking = {"$addFields": {"rank": {"$indexOfArray": [hit_ids, "$_id"]}}}
+        page_stages = [ranking] + skip_stages(sort=[("rank", 1)], current_page=current_page, page_size=page_size)
+    items, count = await get_page_and_count(message_collection, query=query, page_stages=page_stages,
+                                            count_mode=count_mode)
+    if results and not results.complete:
+        # only the best MAX_SEARCH_HITS matches are listed
+        count = PageCount(count.total, capped=True)
+    messages = [MessageGradingSchemaDb(**message_helper(message)) for message in await enrich_grading_messages(items)]
+    return messages, count
+
+
+def grading_filter_key(**filters) -> str:
+    """
+    Hash of a grading filter, equal filters share cached facets
+    """
+    return hashlib.sha1(json.dumps(filters, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def grading_facet_stages(conditions: dict[str, dict]) -> dict[str, list[dict]]:
+    """
+    $facet of the grading filter counts. Each facet applies every dimension but its own, so its counts tell how
+    many messages picking another value would give.
+    """
+    def other_than(dimension: str) -> dict:
+        return {key: value for name in ('topic', 'accuracy', 'status') if name != dimension
+                for key, value in conditions[name].items()}
+
+    return {
+        "topics": [{"$match": other_than('topic')},
+                   {"$group": {"_id": f"${TOPIC_FIELD}", "count": {"$sum": 1}}},
+                   {"$sort": {"count": -1, "_id": 1}},
+                   {"$limit": MAX_TOPIC_FACETS}],
+        "scores": [{"$match": other_than('accuracy')},
+                   {"$bucket": {"groupBy": f"${SCORE_FIELD}", "boundaries": SCORE_BOUNDARIES, "default": "none",
+                                "output": {"count": {"$sum": 1}}}}],
+        "status": [{"$match": other_than('status')},
+                   {"$group": {"_id": None,
+                               "answered": {"$sum": {"$cond": [{"$ifNull": ["$chatbot.qnid", False]}, 1, 0]}},
+                               "unanswered": {"$sum": {"$cond": [
+                                   {"$and": [{"$eq": ["$chatbot.unanswered", True]},
+                                             {"$ne": ["$adminportal.graded", True]}]}, 1, 0]}},
+                               "graded": {"$sum": {"$cond": [{"$eq": ["$adminportal.graded", True]}, 1, 0]}}}}],
+    }
+
+
+async def get_grading_facets_db(*, topic: str = None, search_query: str = None, accuracy: list[float] = None,
+                                question_status: str = None, since: list[date] = None) -> GradingFacets:
+    """
+    Topic counts, score histogram and status counts of the grading list filter in one $facet pass, cached per
+    filter for GRADING_FACETS_TTL_SECONDS
+    """
+    key = grading_filter_key(topic=topic, search_query=search_query, accuracy=accuracy,
+                             question_status=question_status, since=since)
+    if (facets := grading_facets_cache.get(key)) is not None:
+        return facets
+
+    message_ids = None
+    capped = False
+    if search_query:
+        # facets leave out their own dimension, so only the base filter is applied to the matches
+        base = grading_filter_conditions(since=since)['base']
+        results = await search_grading_messages(search_query, since, base)
+        message_ids = [hit.message_id for hit in results.hits]
+        capped = not results.complete
+    conditions = grading_filter_conditions(topic=topic, accuracy=accuracy, question_status=question_status,
+                                           since=since, message_ids=message_ids)
+    pipeline = [{"$match": conditions['base']}, {"$facet": grading_facet_stages(conditions)}]
+    results = await message_collection.aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+    result = results[0] if results else {"topics": [], "scores": [], "status": []}
+
+    buckets = {bucket['_id']: bucket['count'] for bucket in result['scores']}
+    facets = GradingFacets(
+        topics=[{"topic": item['_id'], "count": item['count']} for item in result['topics']],
+        scores=[{"min": round(lower * 100), "max": round(upper * 100), "count": buckets.get(lower, 0)}
+                for lower, upper in zip(SCORE_BOUNDARIES, SCORE_BOUNDARIES[1:])],
+        unscored=buckets.get('none', 0),
+        status=result['status'][0] if result['status'] else {},
+        capped=capped)
+    grading_facets_cache.set(key, facets)
+    return facets
+
+
+async def complete_grading_item(message_id: str):
+    """
+    Drop a graded or skipped message from the grading queue (see db_utils.grading_queue), whoever leased it
+    """
+    await grading_queue_collection.delete_one({"_id": ObjectId(message_id)})
 
 
 async def skip_message_db(message: SkipMessage, current_user: CurrentUserSchema) -> str:
@@ -106,6 +237,7 @@ async def skip_message_db(message: SkipMessage, current_user: CurrentUserSchema)
         "adminportal.answer": None
     }
     result = await message_collection.update_one(query, {'$set': set_query})
+    await complete_grading_item(message.id)
 
     return f"Skipped {result.modified_count} question."
 
@@ -121,7 +253,9 @@ async def update_message_db(message_item: UpdateMessageResponse, current_user: C
     original_response = message_from_db.get('chatbot', {}).get('qnid')
 
     response = graded_response or original_response
-    if not graded_response and response == message_item.new_response:
+    if not graded_response and str(response) == message_item.new_response:
+        # the grader confirmed the bot's answer, nothing to move but the message is done
+        await complete_grading_item(message_item.id)
         return 'No questions updated'
 
     updated_info_query = {
@@ -134,6 +268,7 @@ async def update_message_db(message_item: UpdateMessageResponse, current_user: C
         "adminportal.answer": ObjectId(message_item.new_response)
     }
     result1 = await message_collection.update_one(query, {'$set': set_message_query})
+    await complete_grading_item(message_item.id)
 
     # delete variation from main question and add variation to new question
     query = {"_id": ObjectId(response),
@@ -162,3 +297,172 @@ async def update_message_db(message_item: UpdateMessageResponse, current_user: C
     return f"Graded {result1 and result1.modified_count} question. " \
            f"Removed {result2 and result2.modified_count} variation from question. " \
            f"Added {result3 and result3.modified_count} variation to question."
+
+
+class GradingMove(NamedTuple):
+    index: int  # of the grading in its batch
+    message_id: ObjectId
+    text: str
+    source: Optional[ObjectId]  # question holding the text as a variation until now
+    target: ObjectId
+
+
+def grading_moves(gradings: list[UpdateMessageResponse],
+                  messages: dict[ObjectId, dict]) -> (list[GradingMove], dict[int, BulkGradingResult]):
+    """
+    Variation moves of a batch of gradings, and the results of the gradings that move nothing (by batch index)
+    """
+    moves = []
+    results = {}
+    for index, grading in enumerate(gradings):
+        try:
+            message_from_db = messages.get(ObjectId(grading.id))
+            new_response = ObjectId(grading.new_response)
+        except InvalidId as e:
+            results[index] = BulkGradingResult(id=grading.id, success=False, status=str(e))
+            continue
+        if not message_from_db:
+            results[index] = BulkGradingResult(id=grading.id, success=False, status='Message not found')
+            continue
+        graded_response = message_from_db.get('adminportal', {}).get('answer')
+        response = graded_response or message_from_db.get('chatbot', {}).get('qnid')
+        if not graded_response and str(response) == str(new_response):
+            results[index] = BulkGradingResult(id=grading.id, success=True, status='No questions updated')
+            continue
+        moves.append(GradingMove(index, message_from_db['_id'], grading.text,
+                                 ObjectId(response) if response else None, new_response))
+    return moves, results
+
+
+def variation_requests(moves: list[GradingMove], updated_info_query: dict, language: str = 'EN'
+                       ) -> (list[tuple[UpdateOne, list[int]]], list[tuple[UpdateOne, list[int]]]):
+    """
+    $pull and $push requests moving the variations of a batch, each with the batch indexes of the gradings it
+    serves. A text moved several times (Q1 -> Q2, then Q2 -> Q3) ends up in the target of its last move only: it is
+    pulled from every question the batch moves it from or to, then pushed once to its final target. The pulls have
+    to be written before the pushes.
+    """
+    final: dict[str, GradingMove] = {}
+    touched: dict[str, set[ObjectId]] = {}
+    movers: dict[str, list[int]] = {}
+    for move in moves:
+        key = move.text.casefold()
+        final[key] = move
+        touched.setdefault(key, set()).update(question for question in (move.source, move.target) if question)
+        movers.setdefault(key, []).append(move.index)
+
+    pulls: dict[ObjectId, tuple[list, list[int]]] = {}
+    pushes: dict[ObjectId, tuple[list, list[int]]] = {}
+    for key, move in final.items():
+        for question_id in touched[key]:
+            texts, indexes = pulls.setdefault(question_id, ([], []))
+            texts.append(Regex(f"^{escape(move.text)}$", "i"))
+            indexes.extend(movers[key])
+        docs, indexes = pushes.setdefault(move.target, ([], []))
+        docs.append({"id": str(uuid.uuid4()), "text": move.text, "language": language, "internal": False})
+        indexes.extend(movers[key])
+
+    pull_requests = [(UpdateOne({"_id": question_id, "is_active": True},
+                                {"$pull": {"alternate_questions": {"text": {"$in": texts}}},
+                                 "$set": updated_info_query}), indexes)
+                     for question_id, (texts, indexes) in pulls.items()]
+    push_requests = [(UpdateOne({"_id": question_id, "is_active": True},
+                                {"$push": {"alternate_questions": {"$each": docs}},
+                                 "$set": updated_info_query}), indexes)
+                     for question_id, (docs, indexes) in pushes.items()]
+    return pull_requests, push_requests
+
+
+async def write_requests(collection, requests: list[tuple[UpdateOne, list[int]]],
+                         session=None) -> (int, dict[int, str]):
+    """
+    (modified documents, {batch index: error}) of an unordered bulk write of `requests`. In a transaction a failed
+    write raises, the transaction is aborted as a whole.
+    """
+    if not requests:
+        return 0, {}
+    try:
+        result = await collection.bulk_write([request for request, _ in requests], ordered=False, session=session)
+        return result.modified_count, {}
+    except BulkWriteError as e:
+        if session:
+            raise
+        failed = {}
+        for error in e.details['writeErrors']:
+            for index in requests[error['index']][1]:
+                failed[index] = error['errmsg']
+        return e.details.get('nModified', 0), failed
+
+
+class TransactionsUnsupported(ValueError):
+    pass
+
+
+deployment_features = {}  # what the server deployment supports, asked once per process
+
+
+async def supports_transactions() -> bool:
+    """
+    Whether the deployment runs transactions: a replica set or a sharded cluster does, a standalone server does not
+    """
+    if 'transactions' not in deployment_features:
+        reply = await message_collection.database.client.admin.command('hello')
+        deployment_features['transactions'] = 'setName' in reply or reply.get('msg') == 'isdbgrid'
+    return deployment_features['transactions']
+
+
+async def bulk_update_messages_db(gradings: list[UpdateMessageResponse], current_user: CurrentUserSchema, *,
+                                  transaction: bool = False, language: str = 'EN') -> (list[BulkGradingResult], str):
+    """
+    Grade many messages at once: one read of the messages, then one bulk write per kind of update instead of four
+    round trips per grading. Each grading gets its result from what was actually written. With `transaction` the
+    writes are all applied or none (replica set only, TransactionsUnsupported otherwise), without it a failed write
+    fails only the gradings it served.
+    """
+    if transaction and not await supports_transactions():
+        raise TransactionsUnsupported("Transactions need a replica set, grade without transaction")
+    ids = [ObjectId(grading.id) for grading in gradings if ObjectId.is_valid(grading.id)]
+    messages = {message['_id']: message async for message in
+                message_collection.find({"_id": {"$in": ids}}, projection={"adminportal.answer": 1,
+                                                                          "chatbot.qnid": 1})}
+    updated_info_query = {
+        "updated_at": get_local_datetime_now(),
+        "updated_by": ObjectId(current_user.userId),
+    }
+    moves, results = grading_moves(gradings, messages)
+
+    async def write(session=None) -> (int, int, dict[int, str]):
+        message_requests = [(UpdateOne({"_id": move.message_id},
+                                       {"$set": updated_info_query | {"adminportal.graded": True,
+                                                                      "adminportal.answer": move.target}}),
+                             [move.index])
+                            for move in moves]
+        graded, failed = await write_requests(message_collection, message_requests, session)
+        # only the variations of messages actually graded are moved
+        pulls, pushes = variation_requests([move for move in moves if move.index not in failed],
+                                           updated_info_query, language)
+        pulled, pull_failed = await write_requests(question_collection, pulls, session)
+        pushed, push_failed = await write_requests(question_collection, pushes, session)
+        failed = pull_failed | push_failed | failed
+        # confirmed answers are done as well, failed gradings stay queued
+        done = [ObjectId(gradings[move.index].id) for move in moves if move.index not in failed]
+        done += [ObjectId(result.id) for result in results.values() if result.success]
+        if done:
+            await grading_queue_collection.delete_many({"_id": {"$in": done}}, session=session)
+        return graded, pulled + pushed, failed
+
+    if transaction:
+        try:
+            async with await message_collection.database.client.start_session() as session:
+                async with session.start_transaction():
+                    graded, updated, failed = await write(session)
+        except BulkWriteError as e:
+            error = e.details['writeErrors'][0]['errmsg'] if e.details.get('writeErrors') else str(e)
+            graded, updated, failed = 0, 0, {move.index: error for move in moves}
+    else:
+        graded, updated, failed = await write()
+
+    for move in moves:
+        results[move.index] = BulkGradingResult(id=gradings[move.index].id, success=move.index not in failed,
+                                                status=failed.get(move.index, 'Graded'))
+    return [results[index] for index in sorted(results)], f"Graded {graded} messages. Updated {updated} questions."
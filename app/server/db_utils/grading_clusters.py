@@ -0,0 +1,165 @@
+import asyncio
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany
+
+from app.server.db.collections import grading_cluster_collection, message_collection
+from app.server.db_utils.grading import bulk_update_messages_db
+from app.server.db_utils.pagination import CountMode, PageCount, get_page_and_count, skip_stages
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job, not_applied, \
+    bulk_write_batch
+from app.server.models.current_user import CurrentUserSchema
+from app.server.models.message import GradingClusterSchema, UpdateMessageResponse, BulkGradingResult
+from app.server.utils.minhash import MinHash, text_shingles
+
+GRADING_CLUSTER_JOB = 'grading_clusters'
+GRADING_CLUSTER_BATCHES_PER_RUN = 20
+CLUSTER_SIMILARITY = 0.45  # estimated Jaccard similarity to the cluster's first message to join it
+CLUSTERS_SORT = [("count", -1), ("_id", -1)]
+CLUSTER_FIELD = 'adminportal.cluster_id'  # cluster of a message, clusters do not list their messages
+
+minhash = MinHash()
+
+
+async def create_grading_cluster_indexes():
+    await grading_cluster_collection.create_index([("bands", 1)])
+    await grading_cluster_collection.create_index([("count", -1), ("_id", -1)])
+    # messages of a cluster
+    await message_collection.create_index([(CLUSTER_FIELD, 1)], sparse=True)
+
+
+def new_cluster(message: dict, signature: list[int], bands: list[str]) -> dict:
+    # named after its first message, a replayed batch creates the same cluster again
+    return {"_id": message['_id'],
+            "text": message['data']['text'],
+            "signature": signature,
+            "bands": bands,
+            "count": 1,
+            "created_at": message['created_at'],
+            "last_message_at": message['created_at']}
+
+
+def sign_messages(messages: list[dict]) -> list[tuple[dict, list[int], list[str]]]:
+    """
+    (message, signature, band keys) of the messages with any words. CPU bound, run off the event loop.
+    """
+    signed = []
+    for message in messages:
+        if shingles := text_shingles(message['data']['text']):
+            signature = minhash.signature(shingles)
+            signed.append((message, signature, minhash.band_keys(signature)))
+    return signed
+
+
+@leased_job(GRADING_CLUSTER_JOB)
+async def refresh_grading_clusters(*, batch_size: int = 1000) -> str:
+    """
+    Put the unanswered messages received since the last run in the cluster of their near duplicates, or start
+    one. Candidates are the clusters sharing an LSH band with the message, fetched with one query per batch.
+    Each message records its cluster, clusters only keep their size, and the sizes are guarded by the batch.
+    """
+    loop = asyncio.get_running_loop()
+    clustered = 0
+    async for messages in iterate_new_messages(GRADING_CLUSTER_JOB,
+                                               query={"handler": "bot", "type": "message",
+                                                      "chatbot.unanswered": True, "adminportal.graded": None,
+                                                      CLUSTER_FIELD: None, "data.text": {"$type": "string"}},
+                                               projection={"data.text": 1, "created_at": 1},
+                                               batch_size=batch_size, max_batches=GRADING_CLUSTER_BATCHES_PER_RUN):
+        signed = await loop.run_in_executor(None, sign_messages, messages)
+        all_bands = list({band for _, _, bands in signed for band in bands})
+        if not all_bands:
+            continue
+
+        band_index: dict[str, list[dict]] = {}
+        async for cluster in grading_cluster_collection.find({"bands": {"$in": all_bands}},
+                                                             projection={"signature": 1, "bands": 1}):
+            for band in cluster['bands']:
+                band_index.setdefault(band, []).append(cluster)
+
+        created = {}
+        joined: dict[ObjectId, list[dict]] = {}
+        members: dict[ObjectId, list[ObjectId]] = {}
+        for message, signature, bands in signed:
+            candidates = {cluster['_id']: cluster for band in bands for cluster in band_index.get(band, [])}
+            best = max(candidates.values(), key=lambda c: minhash.similarity(signature, c['signature']), default=None)
+            if best and minhash.similarity(signature, best['signature']) >= CLUSTER_SIMILARITY:
+                if best['_id'] in created:
+                    cluster = created[best['_id']]
+                    cluster['count'] += 1
+                    cluster['last_message_at'] = max(cluster['last_message_at'], message['created_at'])
+                else:
+                    joined.setdefault(best['_id'], []).append(message)
+                members.setdefault(best['_id'], []).append(message['_id'])
+                continue
+            cluster = new_cluster(message, signature, bands)
+            created[cluster['_id']] = cluster
+            members[cluster['_id']] = [message['_id']]
+            for band in bands:
+                band_index.setdefault(band, []).append(cluster)
+
+        batch_id = messages[-1]['_id']
+        requests = [InsertOne(cluster | {"applied_through": batch_id}) for cluster in created.values()]
+        requests += [UpdateOne({"_id": cluster_id} | not_applied(batch_id),
+                               {"$inc": {"count": len(cluster_messages)},
+                                "$max": {"last_message_at": max(message['created_at']
+                                                                for message in cluster_messages)},
+                                "$set": {"applied_through": batch_id}})
+                     for cluster_id, cluster_messages in joined.items()]
+        if requests:
+            await bulk_write_batch(grading_cluster_collection, requests)
+        await message_collection.bulk_write([UpdateMany({"_id": {"$in": message_ids}},
+                                                        {"$set": {CLUSTER_FIELD: cluster_id}})
+                                             for cluster_id, message_ids in members.items()], ordered=False)
+        clustered += len(signed)
+    return f"Clustered {clustered} messages."
+
+
+@leased_job(GRADING_CLUSTER_JOB)
+async def rebuild_grading_clusters() -> str:
+    await grading_cluster_collection.delete_many({})
+    await message_collection.update_many({CLUSTER_FIELD: {"$exists": True}}, {"$unset": {CLUSTER_FIELD: ""}})
+    await reset_job_state(GRADING_CLUSTER_JOB)
+    return await refresh_grading_clusters()
+
+
+async def get_grading_clusters_db(*, current_page: int, page_size: int, min_count: int = 2,
+                                  count_mode: CountMode = CountMode.EXACT) -> (list[GradingClusterSchema], PageCount):
+    """
+    Clusters of near duplicate unanswered messages, the largest first, with how many of their messages are still
+    ungraded
+    """
+    stages = skip_stages(sort=CLUSTERS_SORT, current_page=current_page, page_size=page_size) + \
+        [{"$project": {"signature": 0, "bands": 0, "applied_through": 0}}]
+    items, count = await get_page_and_count(grading_cluster_collection, query={"count": {"$gte": min_count}},
+                                            page_stages=stages, count_mode=count_mode)
+    pending = {group['_id']: group['pending'] async for group in message_collection.aggregate([
+        {"$match": {CLUSTER_FIELD: {"$in": [cluster['_id'] for cluster in items]}, "adminportal.graded": None}},
+        {"$group": {"_id": f"${CLUSTER_FIELD}", "pending": {"$sum": 1}}}])}
+    clusters = [GradingClusterSchema(id=str(cluster['_id']),
+                                     text=cluster['text'],
+                                     count=cluster['count'],
+                                     pending=pending.get(cluster['_id'], 0),
+                                     last_message_at=cluster['last_message_at'])
+                for cluster in items]
+    return clusters, count
+
+
+async def apply_cluster_grading_db(cluster_id: str, new_response: str, current_user: CurrentUserSchema, *,
+                                   transaction: bool = False) -> Optional[tuple[list[BulkGradingResult], str]]:
+    """
+    Grade every still ungraded message of a cluster with the same answer in one bulk write, then drop the cluster.
+    None when there is no such cluster.
+    """
+    cluster = await grading_cluster_collection.find_one({"_id": ObjectId(cluster_id)}, projection={"_id": 1})
+    if not cluster:
+        return None
+    gradings = [UpdateMessageResponse(messageId=str(message['_id']), messageResponse=new_response,
+                                      messageText=message['data']['text'])
+                async for message in message_collection.find({CLUSTER_FIELD: cluster['_id'],
+                                                              "adminportal.graded": None},
+                                                             projection={"data.text": 1})]
+    results, status = await bulk_update_messages_db(gradings, current_user, transaction=transaction)
+    await grading_cluster_collection.delete_one({"_id": cluster['_id']})
+    return results, status
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import pytz
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.server.db.collections import grading_queue_collection, message_collection
+from app.server.db_utils.grading import enrich_grading_messages
+from app.server.db_utils.helper import message_helper
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job
+from app.server.models.current_user import CurrentUserSchema
+from app.server.models.message import MessageGradingSchemaDb
+from app.server.utils.timezone import get_local_datetime_now
+
+GRADING_QUEUE_JOB = 'grading_queue'
+GRADING_QUEUE_BATCHES_PER_RUN = 20
+LOW_CONFIDENCE_SCORE = 0.6  # answered messages whose best match scored below this need a look
+DEFAULT_LEASE_SECONDS = 300
+MAX_CLAIM = 50
+CLAIM_ROUNDS = 3  # claims cut short by concurrent graders read the queue head again that often
+NOT_LEASED = datetime(1970, 1, 1, tzinfo=pytz.utc)  # lease_until of free items, before any lease expiry
+
+GRADING_CANDIDATE_QUERY = {
+    "handler": "bot",
+    "type": "message",
+    "adminportal.graded": None,
+    "$or": [{"chatbot.unanswered": True},
+            {"nlp.nlp_response.matched_questions.0.score": {"$lt": LOW_CONFIDENCE_SCORE}}],
+}
+
+
+async def create_grading_queue_indexes():
+    # free and expired items, oldest message first
+    await grading_queue_collection.create_index([("lease_until", 1), ("_id", 1)])
+    await grading_queue_collection.create_index([("leased_by", 1)])
+    await grading_queue_collection.create_index([("claim", 1)])
+
+
+def grading_queue_item(message: dict) -> dict:
+    return {"reason": 'unanswered' if message.get('chatbot', {}).get('unanswered') else 'low_confidence',
+            "created_at": message['created_at'],
+            "lease_until": NOT_LEASED,
+            "leased_by": None}
+
+
+@leased_job(GRADING_QUEUE_JOB)
+async def refresh_grading_queue(*, batch_size: int = 1000) -> str:
+    """
+    Queue the ungraded unanswered and low confidence messages received since the last run
+    """
+    queued = 0
+    async for messages in iterate_new_messages(GRADING_QUEUE_JOB, query=GRADING_CANDIDATE_QUERY,
+                                               projection={"created_at": 1, "chatbot.unanswered": 1},
+                                               batch_size=batch_size, max_batches=GRADING_QUEUE_BATCHES_PER_RUN):
+        requests = [UpdateOne({"_id": message['_id']}, {"$setOnInsert": grading_queue_item(message)}, upsert=True)
+                    for message in messages]
+        await grading_queue_collection.bulk_write(requests, ordered=False)
+        queued += len(messages)
+    return f"Queued {queued} messages."
+
+
+@leased_job(GRADING_QUEUE_JOB)
+async def rebuild_grading_queue() -> str:
+    await grading_queue_collection.delete_many({})
+    await reset_job_state(GRADING_QUEUE_JOB)
+    return await refresh_grading_queue()
+
+
+async def claim_grading_items(current_user: CurrentUserSchema, *, count: int,
+                              lease_seconds: int = DEFAULT_LEASE_SECONDS) -> (list[MessageGradingSchemaDb], datetime):
+    """
+    Lease the next `count` free items to a grader. A claim reads the head of the (lease_until, _id) index, marks the
+    items still free with a claim token in one `update_many` and reads back what it marked, so concurrent graders
+    never get the same message and a claim costs the same however long the queue is or however many it takes.
+    Leases not released by grading or skipping expire and the items are handed out again.
+    """
+    now = get_local_datetime_now()
+    lease_until = now + timedelta(seconds=lease_seconds)
+    grader = ObjectId(current_user.userId)
+    token = ObjectId()
+    wanted = min(count, MAX_CLAIM)
+    claimed = []
+    for _ in range(CLAIM_ROUNDS):
+        cursor = grading_queue_collection.find({"lease_until": {"$lt": now}}, projection={"_id": 1},
+                                               sort=[("lease_until", 1), ("_id", 1)], limit=wanted - len(claimed))
+        free = [item['_id'] for item in await cursor.to_list(length=None)]
+        if not free:
+            break
+        # an item another grader claimed meanwhile is no longer free and is left out
+        await grading_queue_collection.update_many({"_id": {"$in": free}, "lease_until": {"$lt": now}},
+                                                   {"$set": {"lease_until": lease_until, "leased_by": grader,
+                                                             "claim": token}})
+        claimed = [item['_id'] async for item in grading_queue_collection.find({"claim": token},
+                                                                               projection={"_id": 1})]
+        if len(claimed) >= wanted:
+            break
+    if not claimed:
+        return [], lease_until
+
+    messages = await message_collection.find({"_id": {"$in": claimed}}, sort=[("_id", 1)]).to_list(length=None)
+    # graded from the list meanwhile, nothing left to do for them
+    if graded := [message['_id'] for message in messages if message.get('adminportal', {}).get('graded')]:
+        await grading_queue_collection.delete_many({"_id": {"$in": graded}})
+    messages = [message for message in messages if not message.get('adminportal', {}).get('graded')]
+    messages = await enrich_grading_messages(messages)
+    return [MessageGradingSchemaDb(**message_helper(message)) for message in messages], lease_until
+
+
+async def release_grading_items(current_user: CurrentUserSchema, message_ids: list[str] = None) -> str:
+    """
+    Hand back the leases of a grader, all of them or only those of `message_ids`
+    """
+    query = {"leased_by": ObjectId(current_user.userId)}
+    if message_ids:
+        query["_id"] = {"$in": [ObjectId(_id) for _id in message_ids]}
+    result = await grading_queue_collection.update_many(query, {"$set": {"lease_until": NOT_LEASED,
+                                                                         "leased_by": None}})
+    return f"Released {result.modified_count} messages."
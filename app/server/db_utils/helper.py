@@ -1,6 +1,16 @@
 from app.server.models.flow import FlowTypeEnumOut
 from app.server.utils.common import clean_dict_helper
 
+MESSAGE_PREVIEW_PLACEHOLDERS = {
+    FlowTypeEnumOut.GENERIC_TEMPLATE.value: '[Generic Template]',
+    FlowTypeEnumOut.IMAGES.value: '[Image]',
+    FlowTypeEnumOut.IMAGE.value: '[Image]',
+    FlowTypeEnumOut.FILE.value: '[Attachment]',
+    FlowTypeEnumOut.BUTTON_TEMPLATE.value: '[Button Template]',
+    FlowTypeEnumOut.VIDEOS.value: '[Video]',
+    FlowTypeEnumOut.VIDEO.value: '[Video]',
+}
+
 
 def message_helper(message) -> dict:
     message['type'] = str(FlowTypeEnumOut(message['type']))
@@ -10,6 +20,18 @@ def message_helper(message) -> dict:
     })
 
 
+def message_preview(message: dict) -> str:
+    """
+    One line a conversation list shows for a raw message, e.g. 'Bot: [Image]' for an image the bot sent
+    """
+    sender = '' if message.get('handler') == 'bot' else 'Bot: '
+    if message.get('type') == FlowTypeEnumOut.MESSAGE:
+        text = (message.get('data') or {}).get('text') or ''
+    else:
+        text = MESSAGE_PREVIEW_PLACEHOLDERS.get(message.get('type'), 'Unsupported Message')
+    return sender + text
+
+
 def bot_user_helper(bot_user) -> dict:
     return clean_dict_helper({
         **bot_user,
@@ -18,6 +40,16 @@ def bot_user_helper(bot_user) -> dict:
     })
 
 
+def conversation_summary_helper(conversation) -> dict:
+    return clean_dict_helper({
+        **conversation,
+        "id": conversation["_id"],
+        "participants": [str(participant) for participant in conversation.get('participants', [])],
+        "last_message": {**conversation['last_message'], "id": str(conversation['last_message']['id'])}
+        if conversation.get('last_message') else None
+    })
+
+
 def question_helper(question) -> dict:
     # return {
     #     **question,
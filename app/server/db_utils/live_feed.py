@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+
+from fastapi.encoders import jsonable_encoder
+from motor.core import AgnosticCollection
+from pymongo.errors import OperationFailure
+
+from app.server.db.collections import bot_user_collection, message_collection
+from app.server.db_utils.helper import message_helper, bot_user_helper
+from app.server.db_utils.watermark import CHANGE_STREAM_HISTORY_LOST
+from app.server.models.bot_user import BotUserSchemaDb
+from app.server.models.message import MessageSchemaDb
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 100  # events a slow client may lag behind before newer ones are dropped for it
+RETRY_DELAY = 5  # seconds before watching again after a change stream error
+
+
+class FeedFilter(NamedTuple):
+    """
+    Events a subscriber wants, every given field has to match
+    """
+    convo_id: Optional[str] = None
+    user_id: Optional[str] = None
+    tag: Optional[str] = None
+
+    def matches(self, event: dict) -> bool:
+        if self.convo_id and event.get('convo_id') != self.convo_id:
+            return False
+        if self.user_id and self.user_id not in event['user_ids']:
+            return False
+        if self.tag and self.tag not in event['tags']:
+            return False
+        return True
+
+
+class LiveFeed:
+    """
+    One change stream consumer per watched collection shared by every connected client. Events are fanned out to
+    the queue of each subscriber whose filter matches, so the database sees the same load for one or a hundred
+    clients. Consumers start with the first subscriber, stop with the last one and resume where they stopped after
+    an error.
+    .. code-block:: python
+        queue = live_feed.subscribe(FeedFilter(convo_id=convo_id))
+        try:
+            event = await queue.get()
+        finally:
+            live_feed.unsubscribe(queue)
+    """
+
+    def __init__(self):
+        self.subscribers: dict[asyncio.Queue, FeedFilter] = {}
+        self.consumers: list[asyncio.Task] = []
+
+    def subscribe(self, feed_filter: FeedFilter) -> asyncio.Queue:
+        if not self.consumers:
+            self.consumers = [asyncio.create_task(self.consume(message_collection, self.message_event)),
+                              asyncio.create_task(self.consume(bot_user_collection, self.bot_user_event))]
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers[queue] = feed_filter
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.pop(queue, None)
+        if not self.subscribers:
+            # nobody listens, no change stream stays open
+            for consumer in self.consumers:
+                consumer.cancel()
+            self.consumers = []
+
+    def publish(self, event: dict):
+        payload = {"event": event['event'], "data": event['data']}
+        for queue, feed_filter in list(self.subscribers.items()):
+            if not feed_filter.matches(event):
+                continue
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                logger.warning("Live feed subscriber is lagging, dropping a %s event", event['event'])
+
+    async def consume(self, collection: AgnosticCollection, to_event):
+        resume_token = None
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        while True:
+            try:
+                async with collection.watch(pipeline, full_document='updateLookup',
+                                            resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        if self.subscribers and change.get('fullDocument'):
+                            self.publish(await to_event(change['fullDocument']))
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAM_HISTORY_LOST:
+                    logger.exception("Change stream on %s failed, watching again in %ss", collection.name,
+                                     RETRY_DELAY)
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                # the resume token fell off the oplog, the changes since are lost and watching goes on from now
+                logger.warning("Change stream history of %s lost, watching from now", collection.name)
+                resume_token = None
+            except Exception:
+                logger.exception("Change stream on %s failed, watching again in %ss", collection.name, RETRY_DELAY)
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def message_event(self, message: dict) -> dict:
+        # the bot user of a message is its sender when it came in, its receiver when the bot sent it
+        user_id = message.get('sender_id') if message.get('handler') == 'bot' else message.get('receiver_id')
+        tags = []
+        if user_id and any(feed_filter.tag for feed_filter in self.subscribers.values()):
+            user = await bot_user_collection.find_one({"_id": user_id}, projection={"tags": 1})
+            tags = (user or {}).get('tags', [])
+        return {"event": "message",
+                "convo_id": message.get('chatbot', {}).get('convo_id'),
+                "user_ids": [str(message[key]) for key in ('sender_id', 'receiver_id') if message.get(key)],
+                "tags": tags,
+                "data": jsonable_encoder(MessageSchemaDb(**message_helper(message)), by_alias=True,
+                                         exclude_none=True)}
+
+    async def bot_user_event(self, bot_user: dict) -> dict:
+        return {"event": "bot_user",
+                "convo_id": None,
+                "user_ids": [str(bot_user['_id'])],
+                "tags": bot_user.get('tags', []),
+                "data": jsonable_encoder(BotUserSchemaDb(**bot_user_helper(bot_user)), by_alias=True,
+                                         exclude_none=True)}
+
+
+live_feed = LiveFeed()
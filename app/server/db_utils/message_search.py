@@ -0,0 +1,264 @@
+import asyncio
+import heapq
+from collections import defaultdict, Counter
+from datetime import date, datetime, timedelta
+from typing import NamedTuple, Optional, Awaitable, Callable
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.server.db.collections import message_postings_collection, message_terms_collection
+from app.server.db_utils.watermark import iterate_new_messages, reset_job_state, leased_job, not_applied, \
+    bulk_write_batch
+from app.server.utils.search_query import SearchClause, ClauseKind, parse_search_query, contains_phrase, \
+    bm25_idf, bm25_impact
+from app.server.utils.timezone import make_timezone_aware
+from app.server.utils.tokenizer import tokenize, STOP_WORDS
+
+MESSAGE_INDEX_JOB = 'message_index'
+MESSAGE_INDEX_BATCHES_PER_RUN = 20
+MAX_PREFIX_EXPANSIONS = 50  # most frequent terms a `word*` stands for
+STATS_ID = ''  # `message_terms` document holding the corpus totals, no term is empty
+SEARCH_TOP_K = 1000  # best matches a search returns
+POSTINGS_CHUNK = 500  # postings of a term read per round, best impact first
+MAX_POSTINGS_PER_TERM = 20_000  # a search reads no more postings of a term, however frequent
+
+
+class SearchHit(NamedTuple):
+    message_id: ObjectId
+    score: float
+    sender_id: Optional[ObjectId]
+    convo_id: Optional[str]
+    created_at: datetime
+
+
+class SearchResults(NamedTuple):
+    hits: list[SearchHit]
+    complete: bool  # False when more messages may match than `hits` holds
+
+
+class ClauseTerms(NamedTuple):
+    clause: SearchClause
+    terms: list[str]  # indexed terms of the clause, prefixes expanded
+    offsets: list[int]  # positions of the terms in a phrase
+
+
+async def create_message_index_indexes():
+    await message_postings_collection.create_index([("term", 1), ("m", 1)], unique=True)
+    # postings of a term, best impact first
+    await message_postings_collection.create_index([("term", 1), ("w", -1)])
+
+
+def message_terms(message: dict) -> tuple[dict[str, list[int]], int]:
+    """
+    ({term: positions}, length) of a message. Stop words are not indexed but keep their positions, so phrases
+    around them still match.
+    """
+    tokens = tokenize(message['data']['text'])
+    positions = defaultdict(list)
+    for position, token in enumerate(tokens):
+        if token not in STOP_WORDS:
+            positions[token].append(position)
+    return positions, len(tokens)
+
+
+def message_posting(message: dict, term_positions: list[int], length: int, average_length: float) -> dict:
+    """
+    Posting of a term in a message. It keeps the term positions (for phrases), the term's BM25 impact (the postings
+    of a term are read best first) and the fields searches filter or group on, so queries never read `message`.
+    The impact uses the average length at indexing time, which drifts slowly.
+    """
+    return {"p": term_positions, "l": length, "w": bm25_impact(len(term_positions), length, average_length),
+            "h": message.get('handler'), "s": message.get('sender_id'),
+            "c": message.get('chatbot', {}).get('convo_id'), "t": message['created_at']}
+
+
+@leased_job(MESSAGE_INDEX_JOB)
+async def refresh_message_index(*, batch_size: int = 1000) -> str:
+    """
+    Add the text messages received since the last run to the inverted index. Postings are upserted once per term
+    and message, and the frequencies are guarded by the batch, so a replayed batch changes nothing.
+    """
+    indexed = 0
+    async for messages in iterate_new_messages(MESSAGE_INDEX_JOB, query={"data.text": {"$type": "string"}},
+                                               projection={"created_at": 1, "data.text": 1, "handler": 1,
+                                                           "sender_id": 1, "chatbot.convo_id": 1},
+                                               batch_size=batch_size, max_batches=MESSAGE_INDEX_BATCHES_PER_RUN):
+        indexed += len(messages)
+        terms = [(message, *message_terms(message)) for message in messages]
+        terms = [(message, positions, length) for message, positions, length in terms if positions]
+        if not terms:
+            continue
+        documents = len(terms)
+        length = sum(message_length for _, _, message_length in terms)
+        stats = await message_terms_collection.find_one({"_id": STATS_ID}) or {}
+        average_length = (stats.get('length', 0) + length) / (stats.get('documents', 0) + documents)
+
+        batch_id = messages[-1]['_id']
+        requests = []
+        document_frequencies = Counter()
+        for message, positions, message_length in terms:
+            for term, term_positions in positions.items():
+                posting = message_posting(message, term_positions, message_length, average_length)
+                requests.append(UpdateOne({"term": term, "m": message['_id']}, {"$setOnInsert": posting},
+                                          upsert=True))
+                document_frequencies[term] += 1
+        await bulk_write_batch(message_postings_collection, requests)
+
+        requests = [UpdateOne({"_id": term} | not_applied(batch_id),
+                              {"$inc": {"df": count}, "$set": {"applied_through": batch_id}}, upsert=True)
+                    for term, count in document_frequencies.items()]
+        requests.append(UpdateOne({"_id": STATS_ID} | not_applied(batch_id),
+                                  {"$inc": {"documents": documents, "length": length},
+                                   "$set": {"applied_through": batch_id}}, upsert=True))
+        await bulk_write_batch(message_terms_collection, requests)
+    return f"Indexed {indexed} messages."
+
+
+@leased_job(MESSAGE_INDEX_JOB)
+async def rebuild_message_index() -> str:
+    await message_postings_collection.delete_many({})
+    await message_terms_collection.delete_many({})
+    await reset_job_state(MESSAGE_INDEX_JOB)
+    return await refresh_message_index()
+
+
+async def expand_prefix(prefix: str) -> list[str]:
+    query = {"_id": {"$gte": prefix, "$lt": prefix + "\uffff"}}
+    cursor = message_terms_collection.find(query, projection={"_id": 1}, sort=[("df", -1)],
+                                           limit=MAX_PREFIX_EXPANSIONS)
+    return [term['_id'] async for term in cursor]
+
+
+async def get_clause_terms(text: str) -> Optional[list[ClauseTerms]]:
+    """
+    Indexed terms of every clause of a search, None when a clause cannot match anything. Clauses made of stop words
+    only are left out.
+    """
+    clause_terms = []
+    for clause in parse_search_query(text):
+        if clause.kind == ClauseKind.PREFIX:
+            if not (terms := await expand_prefix(clause.terms[0])):
+                return None
+            clause_terms.append(ClauseTerms(clause, terms, []))
+            continue
+        indexed = [(offset, term) for offset, term in enumerate(clause.terms) if term not in STOP_WORDS]
+        if indexed:
+            clause_terms.append(ClauseTerms(clause, [term for _, term in indexed], [offset for offset, _ in indexed]))
+    return clause_terms
+
+
+def posting_filter(*, start: date = None, end: date = None, handler: str = None) -> dict:
+    """
+    Postings of the messages of the local days start..end (both inclusive) sent to `handler`
+    """
+    query = {}
+    created_at = {}
+    if start:
+        created_at["$gte"] = make_timezone_aware(start)
+    if end:
+        created_at["$lt"] = make_timezone_aware(end + timedelta(days=1))
+    if created_at:
+        query["t"] = created_at
+    if handler:
+        query["h"] = handler
+    return query
+
+
+def match_clause(clause_terms: ClauseTerms, postings: dict[str, dict]) -> bool:
+    """
+    Whether a message matches one clause, given its {term: posting} of the search terms
+    """
+    if clause_terms.clause.kind == ClauseKind.PHRASE:
+        if not all(term in postings for term in clause_terms.terms):
+            return False
+        return contains_phrase([postings[term]['p'] for term in clause_terms.terms], clause_terms.offsets)
+    return any(term in postings for term in clause_terms.terms)
+
+
+async def score_messages(message_ids: list[ObjectId], clause_terms: list[ClauseTerms],
+                         idf: dict[str, float]) -> list[SearchHit]:
+    """
+    Hits of the messages matching every clause, from all their postings of the search terms
+    """
+    postings = defaultdict(dict)
+    async for posting in message_postings_collection.find({"term": {"$in": list(idf)}, "m": {"$in": message_ids}}):
+        postings[posting['m']][posting['term']] = posting
+    hits = []
+    for message_id, message_postings in postings.items():
+        if not all(match_clause(clause, message_postings) for clause in clause_terms):
+            continue
+        posting = next(iter(message_postings.values()))
+        score = sum(idf[term] * term_posting['w'] for term, term_posting in message_postings.items())
+        hits.append(SearchHit(message_id, score, posting.get('s'), posting.get('c'), posting['t']))
+    return hits
+
+
+async def search_messages(text: str, *, start: date = None, end: date = None, handler: str = None,
+                          limit: int = SEARCH_TOP_K,
+                          candidate_filter: Callable[[list[ObjectId]], Awaitable[set[ObjectId]]] = None
+                          ) -> SearchResults:
+    """
+    Best `limit` messages matching every clause of a search query (see `parse_search_query`), best BM25 score first.
+    The postings of each term are read best impact first, POSTINGS_CHUNK at a time, and every message seen is
+    scored from all its postings. Reading stops once no unseen message can beat the `limit`th score (the threshold
+    algorithm) or after MAX_POSTINGS_PER_TERM postings of a term, so a frequent term costs no more than a rare one.
+    .. code-block:: python
+        results = await search_messages('"opening hours" libr*', handler='bot', start=date(2021, 1, 1))
+    :param candidate_filter: ids of the given messages to consider, applied before the best ones are kept
+    """
+    clause_terms = await get_clause_terms(text)
+    if not clause_terms:
+        return SearchResults([], True)
+    terms = sorted(set().union(*(clause.terms for clause in clause_terms)))
+
+    stats = {doc['_id']: doc async for doc in message_terms_collection.find({"_id": {"$in": [STATS_ID, *terms]}})}
+    documents = max(stats.get(STATS_ID, {}).get('documents', 0), 1)
+    idf = {term: bm25_idf(stats.get(term, {}).get('df', 0), documents) for term in terms}
+
+    query = posting_filter(start=start, end=end, handler=handler)
+    cursors = {term: message_postings_collection.find({"term": term} | query, projection={"m": 1, "w": 1},
+                                                      sort=[("w", -1)], limit=MAX_POSTINGS_PER_TERM,
+                                                      batch_size=POSTINGS_CHUNK)
+               for term in terms}
+    frontier = dict.fromkeys(terms, 0.0)  # impact of the last posting read of each term still read
+    read = Counter()
+    best: list[tuple[float, datetime, ObjectId, SearchHit]] = []  # heap of the best hits, worst first
+    seen = set()
+    matched = 0
+    capped = False
+    while cursors:
+        chunks = await asyncio.gather(*(cursor.to_list(length=POSTINGS_CHUNK) for cursor in cursors.values()))
+        new_ids = set()
+        for term, postings in zip(list(cursors), chunks):
+            read[term] += len(postings)
+            if postings:
+                frontier[term] = postings[-1]['w']
+            if read[term] >= MAX_POSTINGS_PER_TERM:
+                capped = True
+                del cursors[term]
+            elif len(postings) < POSTINGS_CHUNK:
+                # every posting of the term was seen, an unseen message does not have it
+                del cursors[term]
+            new_ids.update(posting['m'] for posting in postings if posting['m'] not in seen)
+        seen |= new_ids
+
+        candidates = list(new_ids)
+        if candidates and candidate_filter:
+            candidates = list(await candidate_filter(candidates))
+        for hit in await score_messages(candidates, clause_terms, idf) if candidates else []:
+            matched += 1
+            entry = (hit.score, hit.created_at, hit.message_id, hit)
+            if len(best) < limit:
+                heapq.heappush(best, entry)
+            elif entry[:3] > best[0][:3]:
+                heapq.heapreplace(best, entry)
+
+        threshold = sum(idf[term] * frontier[term] for term in cursors)
+        if len(best) >= limit and best[0][0] >= threshold:
+            break
+
+    for cursor in cursors.values():
+        await cursor.close()
+    hits = [entry[3] for entry in sorted(best, key=lambda entry: entry[:3], reverse=True)]
+    return SearchResults(hits, not cursors and not capped and matched <= limit)
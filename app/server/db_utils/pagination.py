@@ -0,0 +1,81 @@
+import asyncio
+from enum import Enum
+from typing import NamedTuple, Optional
+
+import stringcase
+from bson import SON
+from motor.core import AgnosticCollection
+
+COUNT_CAP = 10_000
+
+
+class CountMode(str, Enum):
+    EXACT = 'exact'
+    ESTIMATED = 'estimated'  # collection metadata when unfiltered, capped otherwise
+    CAPPED = 'capped'  # stop counting past COUNT_CAP
+
+
+class PageCount(NamedTuple):
+    total: int
+    capped: bool = False
+
+    @property
+    def label(self) -> Optional[str]:
+        """
+        "10,000+" when the count stopped at the cap, None when `total` is the count
+        """
+        return f"{self.total:,}+" if self.capped else None
+
+
+def sort_from_sorter(sorter: Optional[str], default: list[tuple] = None) -> list[tuple]:
+    """
+    Sort of a table sorter such as '+triggeredCount' or '-updatedAt', the newest first when absent
+    """
+    sort = default or [("_id", -1)]
+    if sorter:
+        # [("answers", 1), ("bot_user_group", 1)]
+        for s in sorter.split(','):
+            order = s[:1]
+            key = s[1:]
+            if order == '+':
+                sort = [(stringcase.snakecase(key), 1)]
+            else:
+                sort = [(stringcase.snakecase(key), -1)]
+    return sort
+
+
+def skip_stages(*, sort: list[tuple], current_page: int, page_size: int) -> list[dict]:
+    return [{"$sort": SON(sort)},
+            {"$skip": (current_page - 1) * page_size},
+            {"$limit": page_size}]
+
+
+async def count_matches(collection: AgnosticCollection, stages: list[dict], count_mode: CountMode,
+                        cap: int = COUNT_CAP) -> PageCount:
+    if count_mode == CountMode.ESTIMATED and not stages:
+        return PageCount(await collection.estimated_document_count())
+    limit = [] if count_mode == CountMode.EXACT else [{"$limit": cap + 1}]
+    result = await collection.aggregate(stages + limit + [{"$count": "total"}], allowDiskUse=True).to_list(length=1)
+    total = result[0]['total'] if result else 0
+    return PageCount(cap, True) if count_mode != CountMode.EXACT and total > cap else PageCount(total)
+
+
+async def get_page_and_count(collection: AgnosticCollection, *, query: dict = None, pipeline: list[dict] = None,
+                             page_stages: list[dict], count_mode: CountMode = CountMode.EXACT,
+                             cap: int = COUNT_CAP) -> (list[dict], PageCount):
+    """
+    One page and the total of a filtered listing. The page runs as $match, $sort, $limit so the server reads it
+    from an index, the count runs concurrently as a separate $count the server can answer from an index too.
+    .. code-block:: python
+        items, count = await get_page_and_count(collection, query={"is_active": True},
+                                                page_stages=skip_stages(sort=sort, current_page=2, page_size=20))
+    :param query: $match of the listing, may use indexes ($text included)
+    :param pipeline: further filtering stages after the query
+    :param page_stages: sort, skip/limit and whatever shapes the items, they only run on the page
+    :param count_mode: ESTIMATED and CAPPED trade an exact total for not counting every match
+    """
+    stages = ([{"$match": query}] if query else []) + (pipeline or [])
+    items, count = await asyncio.gather(
+        collection.aggregate(stages + page_stages, allowDiskUse=True).to_list(length=None),
+        count_matches(collection, stages, count_mode, cap))
+    return items, count
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from typing import Optional
+
+from app.server.db.collections import question_collection
+
+QUESTION_LOOKUP_MAX_AGE_SECONDS = 300  # also picks up edits made by other processes
+
+_questions: dict[str, dict] = {}
+_loaded_at: Optional[float] = None
+_load_lock: Optional[asyncio.Lock] = None  # created on first use so it binds to the server's event loop
+
+
+async def get_question_lookup() -> dict[str, dict]:
+    """
+    {qnid: {"topic": ..., "text": {language: ...}}} of every question, including removed ones that old messages
+    still point to. Kept in process and reloaded after question edits or every QUESTION_LOOKUP_MAX_AGE_SECONDS.
+    """
+    global _questions, _loaded_at, _load_lock
+    if _loaded_at is not None and time.monotonic() - _loaded_at < QUESTION_LOOKUP_MAX_AGE_SECONDS:
+        return _questions
+    _load_lock = _load_lock or asyncio.Lock()
+    async with _load_lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at >= QUESTION_LOOKUP_MAX_AGE_SECONDS:
+            questions = {}
+            async for question in question_collection.find({}, projection={"topic": 1, "text": 1}):
+                questions[str(question['_id'])] = {"topic": question.get('topic'), "text": question.get('text') or {}}
+            _questions, _loaded_at = questions, time.monotonic()
+    return _questions
+
+
+async def get_question_text(qnid: str, language: str) -> Optional[str]:
+    return (await get_question_lookup()).get(qnid, {}).get('text', {}).get(language)
+
+
+def invalidate_question_lookup():
+    global _loaded_at
+    _loaded_at = None
@@ -2,17 +2,19 @@ import uuid
 from datetime import datetime, date
 from re import escape
 
-import stringcase
 from bson import Regex, ObjectId
 
 from app.server.db.collections import flow_collection
 from app.server.db.collections import question_collection as collection
-from app.server.db_utils.flows import add_flows_to_db_from_question
+from app.server.db_utils.dashboard.enrichment import restamp_question_messages
+from app.server.db_utils.flows import add_flows_to_db_from_question, flow_helper
 from app.server.db_utils.helper import question_helper
+from app.server.db_utils.pagination import CountMode, PageCount, get_page_and_count, skip_stages, sort_from_sorter
+from app.server.db_utils.question_lookup import invalidate_question_lookup
 from app.server.models.current_user import CurrentUserSchema
-from app.server.models.flow import NewFlow
+from app.server.models.flow import NewFlow, FlowSchemaDbOut
 from app.server.models.question import QuestionSchemaDb, QuestionIn
-from app.server.utils.common import form_query, RequestMethod
+from app.server.utils.common import form_query, RequestMethod, Status
 from app.server.utils.timezone import make_timezone_aware, get_local_datetime_now
 
 
@@ -22,20 +24,52 @@ async def get_question_one(_id: str) -> QuestionSchemaDb:
         return QuestionSchemaDb(**question_helper(question))
 
 
+async def get_questions_by_ids(ids: list) -> dict[str, QuestionSchemaDb]:
+    """
+    {id: question} of every question of `ids` found, in one query
+    """
+    query = {"_id": {"$in": list({ObjectId(_id) for _id in ids})}}
+    return {str(question['_id']): QuestionSchemaDb(**question_helper(question)) async for question in
+            collection.find(query)}
+
+
+def question_status_expression() -> dict:
+    """
+    Status of a question computed by the server: ACTIVE unless scheduled, SCHEDULE between `active_at` and
+    `expire_at`, INACTIVE outside of them
+    """
+    return {"$cond": [{"$not": ["$active_at"]},
+                      Status.ACTIVE.value,
+                      {"$cond": [{"$and": [{"$lte": ["$active_at", "$$NOW"]}, {"$lte": ["$$NOW", "$expire_at"]}]},
+                                 Status.SCHEDULE.value,
+                                 Status.INACTIVE.value]}]}
+
+
+def resolve_answer_stages() -> list[dict]:
+    """
+    Stages adding the status and the flow of the last answer (the one a question shows) with a single $lookup
+    """
+    return [
+        {"$set": {"answer_flow_id": {"$convert": {"input": {"$last": "$answers.flow.flow_id"}, "to": "objectId",
+                                                  "onError": None, "onNull": None}}}},
+        {"$lookup": {"from": "flow", "localField": "answer_flow_id", "foreignField": "_id", "as": "answer_flow"}},
+        {"$set": {"answer_flow": {"$first": "$answer_flow"}, "status": question_status_expression()}},
+        {"$unset": "answer_flow_id"},
+    ]
+
+
+def question_with_answer_helper(question: dict) -> QuestionSchemaDb:
+    answer_flow = question.pop('answer_flow', None)
+    result = QuestionSchemaDb(**question_helper(question))
+    if answer_flow:
+        result.answer_flow = FlowSchemaDbOut(**flow_helper(answer_flow))
+    return result
+
+
 async def get_questions_db(*, current_page: int, page_size: int, sorter: str = None, query: dict) -> list[
     QuestionSchemaDb]:
     # always show the newest first
-    sort = [("_id", -1)]
-    if sorter:
-        # [("answers", 1), ("bot_user_group", 1)]
-        for s in sorter.split(','):
-            order = s[:1]
-            key = s[1:]
-            if order == '+':
-                sort = [(stringcase.snakecase(key), 1)]
-            else:
-                sort = [(stringcase.snakecase(key), -1)]
-
+    sort = sort_from_sorter(sorter)
     cursor = collection.find(query, sort=sort)
     cursor.skip((current_page - 1) * page_size).limit(page_size)
     questions = []
@@ -51,8 +85,12 @@ async def get_questions_count_db(*, query: dict) -> int:
 
 async def get_questions_and_count_db(*, current_page: int, page_size: int, sorter: str = None, question_text: str,
                                      language: str, topic: str,
-                                     updated_at: list[date], triggered_counts: list[int]) -> (
-        list[QuestionSchemaDb], int):
+                                     updated_at: list[date], triggered_counts: list[int],
+                                     count_mode: CountMode = CountMode.EXACT,
+                                     resolve_answers: bool = False) -> (list[QuestionSchemaDb], PageCount):
+    """
+    :param resolve_answers: also set `answer_flow` and `status` of the page questions, in the same query
+    """
     if updated_at:
         updated_at_start, updated_at_end = updated_at
     db_key = [("topic", Regex(f".*{escape(topic)}.*", "i") if topic else ...),
@@ -64,9 +102,12 @@ async def get_questions_and_count_db(*, current_page: int, page_size: int, sorte
                               "$lte": make_timezone_aware(updated_at_end)} if updated_at else ...)]
     query = form_query(db_key)
 
-    questions = await get_questions_db(current_page=current_page, page_size=page_size, sorter=sorter, query=query)
-    total = await get_questions_count_db(query=query)
-    return questions, total
+    page_stages = skip_stages(sort=sort_from_sorter(sorter), current_page=current_page, page_size=page_size)
+    if resolve_answers:
+        page_stages += resolve_answer_stages()
+    items, count = await get_page_and_count(collection, query=query, page_stages=page_stages, count_mode=count_mode)
+    questions = [question_with_answer_helper(question) for question in items]
+    return questions, count
 
 
 async def get_topics_db():
@@ -78,6 +119,7 @@ async def get_topics_db():
 async def add_question_db(question: QuestionIn, current_user: CurrentUserSchema) -> str:
     doc = await process_question(question, current_user, method=RequestMethod.ADD)
     result = await collection.insert_one(doc)
+    invalidate_question_lookup()
     return f"Added {1 if result.acknowledged else 0} question."
 
 
@@ -144,8 +186,13 @@ async def process_question(question: QuestionIn, current_user: CurrentUserSchema
 
 async def edit_question_db(question: QuestionIn, current_user: CurrentUserSchema):
     doc = await process_question(question, current_user, method=RequestMethod.EDIT)
+    previous = await collection.find_one({"_id": ObjectId(question.id)}, projection={"topic": 1, "text": 1})
     new_values = {"$set": doc}
     result = await collection.update_one({"_id": ObjectId(question.id)}, new_values)
+    invalidate_question_lookup()
+    # messages carry a copy of the topic and text, see db_utils.dashboard.enrichment
+    if previous and (previous.get('topic'), previous.get('text')) != (doc['topic'], doc['text']):
+        await restamp_question_messages(question.id, doc)
     return f"Updated {result.modified_count} question."
 
 
@@ -0,0 +1,178 @@
+import functools
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import AsyncIterator, Optional
+
+from bson import ObjectId
+from motor.core import AgnosticCollection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from app.server.db.collections import job_state_collection, message_collection
+from app.server.utils.timezone import get_local_datetime_now
+
+JOB_LEASE_SECONDS = 300  # a worker dying with the lease blocks the job that long, every batch renews it
+WATERMARK_LAG_SECONDS = 60  # documents inserted up to that long after their _id was made are still picked up
+LEASE_FIELDS = ('lease_until', 'lease_token')
+DUPLICATE_KEY = 11000
+CHANGE_STREAM_HISTORY_LOST = 286  # the resume token fell off the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573  # a standalone server, change streams need a replica set
+
+_held_leases: ContextVar[dict[str, ObjectId]] = ContextVar('held_leases', default={})
+
+
+async def get_job_state(job: str) -> dict:
+    return await job_state_collection.find_one({"_id": job}) or {}
+
+
+async def update_job_state(job: str, **values):
+    await job_state_collection.update_one({"_id": job},
+                                          {"$set": values | {"updated_at": get_local_datetime_now()}},
+                                          upsert=True)
+
+
+async def reset_job_state(job: str):
+    """
+    Forget everything a job stored but its lease, which the caller usually holds
+    """
+    state = await get_job_state(job)
+    if fields := {key: "" for key in state if key not in ('_id', *LEASE_FIELDS)}:
+        await job_state_collection.update_one({"_id": job}, {"$unset": fields})
+
+
+async def acquire_job_lease(job: str) -> Optional[ObjectId]:
+    """
+    Token of a new lease on `job`, None while another worker holds an unexpired one
+    """
+    now = get_local_datetime_now()
+    token = ObjectId()
+    try:
+        await job_state_collection.update_one(
+            {"_id": job, "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS), "lease_token": token}},
+            upsert=True)
+    except DuplicateKeyError:
+        # the state exists and its lease did not expire, the upsert tried to insert it again
+        return None
+    return token
+
+
+async def renew_job_lease(job: str, token: ObjectId, **values) -> bool:
+    """
+    Extend the lease and set `values` in the same update, False when the lease was lost meanwhile
+    """
+    now = get_local_datetime_now()
+    result = await job_state_collection.update_one(
+        {"_id": job, "lease_token": token},
+        {"$set": values | {"lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}})
+    return result.matched_count == 1
+
+
+async def release_job_lease(job: str, token: ObjectId):
+    await job_state_collection.update_one({"_id": job, "lease_token": token},
+                                          {"$set": {"lease_until": None}, "$unset": {"lease_token": ""}})
+
+
+def leased_job(job: str):
+    """
+    Run the decorated coroutine only while holding the lease of `job`, so one worker at a time runs it. Calls
+    made while the lease is held (a rebuild calling its refresh) reuse it.
+    .. code-block:: python
+        @leased_job('word_cloud')
+        async def refresh_word_cloud() -> str:
+            async for messages in iterate_new_messages('word_cloud'):
+                ...
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            held = _held_leases.get()
+            if job in held:
+                return await func(*args, **kwargs)
+            token = await acquire_job_lease(job)
+            if not token:
+                return f"Job {job} is running elsewhere."
+            reset = _held_leases.set(held | {job: token})
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _held_leases.reset(reset)
+                await release_job_lease(job, token)
+
+        return wrapper
+
+    return decorator
+
+
+def settled_id() -> ObjectId:
+    """
+    Upper bound of the `_id`s a watermark may pass, see `iterate_new_documents`
+    """
+    return ObjectId.from_datetime(get_local_datetime_now() - timedelta(seconds=WATERMARK_LAG_SECONDS))
+
+
+def not_applied(batch_id: ObjectId) -> dict:
+    """
+    Filter of the documents the batch ending at `batch_id` was not applied to yet. Updates also `$set`
+    `applied_through` to `batch_id`, so a batch replayed after a crash skips what it already counted: updates
+    match nothing and upserts fail on the unique index of the rest of their filter, see `bulk_write_batch`.
+    """
+    return {"applied_through": {"$not": {"$gte": batch_id}}}
+
+
+async def bulk_write_batch(collection: AgnosticCollection, requests: list):
+    """
+    `bulk_write` of a batch guarded by `not_applied`, duplicate keys are the upserts already applied
+    """
+    try:
+        await collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get('writeConcernErrors') or any(error['code'] != DUPLICATE_KEY
+                                                      for error in e.details['writeErrors']):
+            raise
+
+
+async def iterate_new_documents(job: str, collection: AgnosticCollection, *, query: dict = None,
+                                projection: dict = None, batch_size: int = 1000, max_batches: Optional[int] = None,
+                                state_key: str = 'last_id') -> AsyncIterator[list[dict]]:
+    """
+    Yield documents inserted after the job's watermark in `_id` order, one batch at a time. The watermark only moves
+    past a batch once the consumer asks for the next one, so a job crashing mid-batch redoes that batch.
+    Only documents whose `_id` is WATERMARK_LAG_SECONDS old are read, `_id`s are made by the clients and a late
+    insert must not land below the watermark. The caller has to hold the job's lease (`leased_job`), iterating
+    stops when the lease is lost.
+    :param job: name of the incremental job, one watermark is kept per job in `job_state`
+    :param max_batches: stop after that many batches, the next run continues where this one stopped
+    :param state_key: field of the job state holding the watermark
+    """
+    if not (token := _held_leases.get().get(job)):
+        raise RuntimeError(f"Iterating job {job} without holding its lease")
+    last_id: Optional[ObjectId] = (await get_job_state(job)).get(state_key)
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        settled = settled_id()
+        batch_query = dict(query or {})
+        batch_query["_id"] = {"$gt": last_id, "$lt": settled} if last_id else {"$lt": settled}
+        cursor = collection.find(batch_query, projection=projection, sort=[("_id", 1)], limit=batch_size)
+        documents = await cursor.to_list(length=batch_size)
+        if not documents:
+            return
+        yield documents
+        last_id = documents[-1]['_id']
+        if not await renew_job_lease(job, token, **{state_key: last_id}):
+            return
+        batches += 1
+
+
+async def iterate_new_messages(job: str, *, query: dict = None, projection: dict = None, batch_size: int = 1000,
+                               max_batches: Optional[int] = None) -> AsyncIterator[list[dict]]:
+    """
+    `iterate_new_documents` of the message collection
+    .. code-block:: python
+        async for messages in iterate_new_messages('word_cloud', query={"handler": "bot"}):
+            await index(messages)
+    """
+    async for messages in iterate_new_documents(job, message_collection, query=query, projection=projection,
+                                                batch_size=batch_size, max_batches=max_batches,
+                                                state_key='last_message_id'):
+        yield messages
@@ -28,13 +28,64 @@ class ConversationBotUserSchema(BotUserSchemaDb):
         allow_population_by_field_name = True
 
 
+class ConversationLastMessage(BaseModel):
+    id: str
+    preview: str
+    handler: Optional[str]
+    created_at: datetime
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class ConversationSummarySchema(BaseModel):
+    id: str
+    participants: list[str]
+    first_message_at: datetime
+    last_message_at: datetime
+    message_count: int
+    user_message_count: int
+    answered_count: int
+    unanswered_count: int
+    last_message: Optional[ConversationLastMessage]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class GetConversationSummariesTable(BaseModel):
+    data: list[ConversationSummarySchema]
+    success: bool
+    total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+    next_cursor: Optional[str]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
 class GetConversationsTable(BaseModel):
     data: list[ConversationBotUserSchema]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+    next_cursor: Optional[str]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
 
 
 class GetConversationsMessageTable(BaseModel):
     data: list[ConversationMessageUserSchema]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+    next_cursor: Optional[str]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
@@ -1,3 +1,5 @@
+from enum import Enum
+
 from pydantic.main import BaseModel
 
 
@@ -5,3 +7,10 @@ class QuestionRankingDataModel(BaseModel):
     id: str
     count: int
     text: str
+
+
+class Granularity(str, Enum):
+    HOUR = 'hour'
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
@@ -864,6 +864,11 @@ class GetFlowsTable(BaseModel):
     data: list[FlowSchemaDbOut]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
 
 
 class NewFlow(BaseModel):
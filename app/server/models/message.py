@@ -112,12 +112,86 @@ class GetMessagesTable(BaseModel):
     data: list[MessageSchemaDb]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+    next_cursor: Optional[str]
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
 
 
 class GetGradingsTable(BaseModel):
     data: list[MessageGradingSchemaDb]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class GradingTopicFacet(BaseModel):
+    topic: Optional[str]
+    count: int
+
+
+class GradingScoreFacet(BaseModel):
+    min: int  # accuracy percentages, as the accuracy filter takes them
+    max: int
+    count: int
+
+
+class GradingStatusFacet(BaseModel):
+    answered: int = 0
+    unanswered: int = 0
+    graded: int = 0
+
+
+class GradingFacets(BaseModel):
+    topics: list[GradingTopicFacet]
+    scores: list[GradingScoreFacet]
+    unscored: int  # messages without any NLP match
+    status: GradingStatusFacet
+    capped: bool = False  # the search matched more messages than the counts cover
+
+
+class GetGradingFacets(BaseModel):
+    data: GradingFacets
+    success: bool
+
+
+class GradingClusterSchema(BaseModel):
+    id: str
+    text: str  # first message of the cluster
+    count: int
+    pending: int  # messages not graded yet
+    last_message_at: datetime
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class GetGradingClustersTable(BaseModel):
+    data: list[GradingClusterSchema]
+    success: bool
+    total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
+
+
+class ClaimGradingsResponse(BaseModel):
+    data: list[MessageGradingSchemaDb]
+    success: bool
+    lease_until: datetime
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
 
 
 class SkipMessage(BaseModel):
@@ -128,3 +202,25 @@ class UpdateMessageResponse(BaseModel):
     new_response: str = Field(alias='messageResponse')
     id: str = Field(alias='messageId')
     text: str = Field(alias='messageText')
+
+
+class BulkUpdateMessageResponse(BaseModel):
+    gradings: list[UpdateMessageResponse]
+    transaction: bool = False  # all or nothing, needs a replica set
+
+
+class BulkGradingResult(BaseModel):
+    id: str
+    success: bool
+    status: str
+
+
+class BulkGradingResponse(BaseModel):
+    data: list[BulkGradingResult]
+    success: bool
+    status: str
+
+
+class ApplyClusterGrading(BaseModel):
+    new_response: str = Field(alias='messageResponse')
+    transaction: bool = False  # all or nothing, needs a replica set
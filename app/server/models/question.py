@@ -23,7 +23,7 @@ class QuestionAnswerSchema(BaseModel):
 
 class QuestionSchemaDbToBeImplement(BaseModel):
     triggered_count: Optional[int]
-    status: Optional[str]
+    status: Optional[Status]
     answer_flow: Optional[FlowSchemaDb]
 
 
@@ -129,6 +129,11 @@ class GetQuestionsTable(BaseModel):
     data: list[QuestionSchemaOut]
     success: bool
     total: int
+    total_label: Optional[str]  # e.g. "10,000+" when the count was capped
+
+    class Config:
+        alias_generator = to_camel
+        allow_population_by_field_name = True
 
 
 class QuestionIn(BaseModel):
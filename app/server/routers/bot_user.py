@@ -1,7 +1,10 @@
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Depends
 
-from ..db_utils.bot_user import get_bot_user_db, update_bot_user_db
+from ..db_utils.bot_user import get_bot_user_db, update_bot_user_db, rebuild_bot_user_search, \
+    rebuild_last_message_previews
 from ..models.bot_user import BotUserSchemaDb, BotUserUpdateModel
+from ..models.current_user import CurrentUserSchema
+from ..utils.security import get_current_active_user
 
 router = APIRouter(
     tags=["Bot User"],
@@ -10,6 +13,24 @@ router = APIRouter(
 )
 
 
+@router.post("/search/rebuild")
+async def bot_user_search_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_bot_user_search()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/last-message-preview/rebuild")
+async def last_message_preview_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_last_message_previews()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
 @router.get("/{bot_user_id}", response_model_exclude_none=True, response_model=BotUserSchemaDb)
 async def get_bot_user(bot_user_id: str):
     return await get_bot_user_db(bot_user_id)
@@ -11,6 +11,7 @@ from ..db_utils.broadcasts import (get_broadcast_templates_list, get_broadcast_t
 from ..db_utils.flows import get_flow_one
 from ..models.broadcast import NewBroadcastTemplate, BroadcastIn
 from ..models.flow import FlowSchemaDbOut
+from ..utils.dataloader import Loaders, get_loaders
 from ..utils.security import get_current_active_user
 
 router = APIRouter(
@@ -80,8 +81,10 @@ async def delete_broadcast_template(template_id: str,
 async def get_broadcast_histories(tags: Optional[list[str]] = Query(None),
                                   intersect: Optional[bool] = Query(None),
                                   status: Optional[str] = Query(None),
-                                  current_user: CurrentUserSchema = Depends(get_current_active_user)):
-    broadcast_history = await get_broadcast_history_list(tags=tags, intersect=intersect, status=status)
+                                  current_user: CurrentUserSchema = Depends(get_current_active_user),
+                                  loaders: Loaders = Depends(get_loaders)):
+    broadcast_history = await get_broadcast_history_list(tags=tags, intersect=intersect, status=status,
+                                                         loaders=loaders)
     return {'data': broadcast_history}
 
 
@@ -93,8 +96,9 @@ async def get_flow(flow_id: str):
 
 @router.get("/history/{broadcast_id}")
 async def get_broadcast_history(broadcast_id: str,
-                                current_user: CurrentUserSchema = Depends(get_current_active_user)):
-    broadcast = await get_broadcast_history_one(broadcast_id)
+                                current_user: CurrentUserSchema = Depends(get_current_active_user),
+                                loaders: Loaders = Depends(get_loaders)):
+    broadcast = await get_broadcast_history_one(broadcast_id, loaders)
     return {'data': broadcast}
 
 
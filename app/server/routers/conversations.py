@@ -1,11 +1,25 @@
+import asyncio
+import json
+from datetime import date
 from typing import Optional
 
-from fastapi import APIRouter, Query
+from bson.errors import InvalidId
+from fastapi import APIRouter, Query, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 
+from ..db_utils.conversation_summary import rebuild_conversation_summaries
 from ..db_utils.conversations import get_conversations_and_count_db, get_message_conversations_and_count_db, \
-    get_user_message_conversations_and_count_db, get_convo_conversations_and_count_db
-from ..models.conversations import GetConversationsTable, GetConversationsMessageTable
+    get_user_message_conversations_and_count_db, get_convo_conversations_and_count_db, get_conversation_summaries_db
+from ..db_utils.export import ExportFormat, get_export_query, stream_export
+from ..db_utils.live_feed import FeedFilter, live_feed
+from ..db_utils.message_search import rebuild_message_index
+from ..db_utils.pagination import CountMode
+from ..models.current_user import CurrentUserSchema
+from ..models.conversations import GetConversationsTable, GetConversationsMessageTable, \
+    GetConversationSummariesTable
 from ..models.message import GetMessagesTable
+from ..utils.pagination import InvalidCursor
+from ..utils.security import get_current_active_user
 
 router = APIRouter(
     tags=["conversations"],
@@ -13,20 +27,32 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+KEEPALIVE_INTERVAL = 15  # seconds, also how soon a gone client is noticed
+
+# every listing takes either current/pageSize or the nextCursor of the previous page, which stays fast on deep pages
+
 
 @router.get("/", response_model_exclude_none=True, response_model=GetConversationsTable)
 async def get_conversations(tags: Optional[list[str]] = Query(None),
                             search_query: Optional[str] = Query(None, alias="searchQuery"),
                             current_page: int = Query(1, alias="current"),
                             page_size: int = Query(20, alias="pageSize"),
+                            cursor: Optional[str] = Query(None),
+                            count_mode: CountMode = Query(CountMode.EXACT, alias="countMode"),
                             ):
-    conversations, total = await get_conversations_and_count_db(current_page=current_page, page_size=page_size,
-                                                                tags=tags, search_query=search_query)
+    try:
+        conversations, count, next_cursor = await get_conversations_and_count_db(
+            current_page=current_page, page_size=page_size, tags=tags, search_query=search_query, cursor=cursor,
+            count_mode=count_mode)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     result = {
         "data": conversations,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label,
+        "next_cursor": next_cursor
     }
     return result
 
@@ -35,14 +61,20 @@ async def get_conversations(tags: Optional[list[str]] = Query(None),
 async def get_conversations_message(search_query: Optional[str] = Query(None, alias="searchQuery"),
                                     current_page: int = Query(1, alias="current"),
                                     page_size: int = Query(20, alias="pageSize"),
+                                    cursor: Optional[str] = Query(None),
                                     ):
-    conversations, total = await get_message_conversations_and_count_db(current_page=current_page, page_size=page_size,
-                                                                        search_query=search_query)
+    try:
+        conversations, count, next_cursor = await get_message_conversations_and_count_db(
+            current_page=current_page, page_size=page_size, search_query=search_query, cursor=cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     result = {
         "data": conversations,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label,
+        "next_cursor": next_cursor
     }
     return result
 
@@ -51,14 +83,22 @@ async def get_conversations_message(search_query: Optional[str] = Query(None, al
 async def get_conversations_message(user_id: str = Query(None),
                                     current_page: int = Query(1, alias="current"),
                                     page_size: int = Query(20, alias="pageSize"),
+                                    cursor: Optional[str] = Query(None),
+                                    count_mode: CountMode = Query(CountMode.EXACT, alias="countMode"),
                                     ):
-    messages, total = await get_user_message_conversations_and_count_db(current_page=current_page, page_size=page_size,
-                                                                        user_id=user_id)
+    try:
+        messages, count, next_cursor = await get_user_message_conversations_and_count_db(
+            current_page=current_page, page_size=page_size, user_id=user_id, cursor=cursor,
+            count_mode=count_mode)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     result = {
         "data": messages,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label,
+        "next_cursor": next_cursor
     }
     return result
 
@@ -67,13 +107,136 @@ async def get_conversations_message(user_id: str = Query(None),
 async def get_conversations_message(convo_id: str = Query(None),
                                     current_page: int = Query(1, alias="current"),
                                     page_size: int = Query(20, alias="pageSize"),
+                                    cursor: Optional[str] = Query(None),
+                                    count_mode: CountMode = Query(CountMode.EXACT, alias="countMode"),
                                     ):
-    messages, total = await get_convo_conversations_and_count_db(current_page=current_page, page_size=page_size,
-                                                                 convo_id=convo_id)
+    try:
+        messages, count, next_cursor = await get_convo_conversations_and_count_db(
+            current_page=current_page, page_size=page_size, convo_id=convo_id, cursor=cursor,
+            count_mode=count_mode)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     result = {
         "data": messages,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label,
+        "next_cursor": next_cursor
+    }
+    return result
+
+
+@router.get("/summaries", response_model_exclude_none=True, response_model=GetConversationSummariesTable)
+async def get_conversation_summaries(user_id: Optional[str] = Query(None, alias="userId"),
+                                     current_page: int = Query(1, alias="current"),
+                                     page_size: int = Query(20, alias="pageSize"),
+                                     cursor: Optional[str] = Query(None),
+                                     count_mode: CountMode = Query(CountMode.EXACT, alias="countMode"),
+                                     ):
+    try:
+        conversations, count, next_cursor = await get_conversation_summaries_db(
+            current_page=current_page, page_size=page_size, user_id=user_id, cursor=cursor, count_mode=count_mode)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = {
+        "data": conversations,
+        "success": True,
+        "total": count.total,
+        "total_label": count.label,
+        "next_cursor": next_cursor
     }
     return result
+
+
+@router.get("/export")
+async def export_transcripts(export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+                             compress: bool = Query(False, alias="gzip"),
+                             user_id: Optional[str] = Query(None, alias="userId"),
+                             tag: Optional[str] = Query(None),
+                             convo_id: Optional[str] = Query(None, alias="convoId"),
+                             start: Optional[date] = Query(None),
+                             end: Optional[date] = Query(None),
+                             current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    """
+    Every matching message streamed straight from the database cursor, so memory stays flat however large the
+    export is
+    """
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    try:
+        query = await get_export_query(user_id=user_id, tag=tag, convo_id=convo_id, start=start, end=end)
+    except InvalidId as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    filename = f"transcripts.{export_format.value}" + (".gz" if compress else "")
+    return StreamingResponse(stream_export(query, export_format, compress),
+                             media_type='application/gzip' if compress else export_format.media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@router.get("/live")
+async def live_conversations(request: Request,
+                             convo_id: Optional[str] = Query(None, alias="convoId"),
+                             user_id: Optional[str] = Query(None, alias="userId"),
+                             tag: Optional[str] = Query(None)):
+    """
+    Server-sent events of new and updated messages and bot users, instead of polling the listings
+    """
+
+    async def events():
+        queue = live_feed.subscribe(FeedFilter(convo_id=convo_id, user_id=user_id, tag=tag))
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            live_feed.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/live/ws")
+async def live_conversations_ws(websocket: WebSocket,
+                                convo_id: Optional[str] = Query(None, alias="convoId"),
+                                user_id: Optional[str] = Query(None, alias="userId"),
+                                tag: Optional[str] = Query(None)):
+    """
+    Same events as /live over a WebSocket, each one a {"event", "data"} JSON message
+    """
+    await websocket.accept()
+    queue = live_feed.subscribe(FeedFilter(convo_id=convo_id, user_id=user_id, tag=tag))
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                event = {"event": "keepalive"}
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        live_feed.unsubscribe(queue)
+
+
+@router.post("/summaries/rebuild")
+async def summaries_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_conversation_summaries()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/search-index/rebuild")
+async def search_index_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_message_index()
+    return {
+        "status": status,
+        "success": True,
+    }
@@ -1,10 +1,21 @@
-from datetime import datetime, date
-
-from fastapi import APIRouter, Query
-
-from app.server.db_utils.dashboard.summary import Dashboard, DashboardSummary, DashboardAnswerRate
-from app.server.db_utils.dashboard.top_search import question_ranking, top_topics_of_week, get_word_cloud, \
-    user_count_trend, message_count_trend, conversation_count_trend, nlp_confidence_trend, top_question
+from datetime import datetime, date, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Query, Depends, HTTPException
+
+from app.server.db_utils.dashboard.confidence import nlp_confidence_trend, rebuild_confidence_sketches
+from app.server.db_utils.dashboard.day_cache import clear_day_cache
+from app.server.db_utils.dashboard.distinct import rebuild_distinct_counters
+from app.server.db_utils.dashboard.enrichment import rebuild_enrichment
+from app.server.db_utils.dashboard.rollup import rebuild_dashboard_daily
+from app.server.db_utils.dashboard.word_cloud import get_word_cloud, rebuild_word_cloud
+from app.server.db_utils.dashboard.summary import Dashboard, DashboardSummary, DashboardAnswerRate, SummaryMode
+from app.server.db_utils.dashboard.question_ranking import question_ranking, RECENT_DAY_WEIGHT
+from app.server.db_utils.dashboard.top_search import top_topics_of_week, \
+    user_count_trend, message_count_trend, conversation_count_trend, top_question, message_activity_heatmap
+from app.server.models.dashboard import Granularity
+from app.server.models.current_user import CurrentUserSchema
+from app.server.utils.security import get_current_active_user
 
 Message = Dashboard(DashboardSummary.MESSAGE)
 User = Dashboard(DashboardSummary.USER)
@@ -19,122 +30,128 @@ router = APIRouter(
 
 
 @router.get("/top-part/messages")
-async def get_user_message():
-    weekly_trend_percentage, (wtd_count, count_last_week) = await Message.get_weekly_trend()
-    monthly_trend_percentage, (mtd_count, count_last_month) = await Message.get_monthly_trend()
+async def get_user_message(mode: SummaryMode = Query(SummaryMode.ROLLUP)):
     res = {
-        "data": {
-            "total": await Message.get_total_count(),
-            "monthlyTrend": monthly_trend_percentage,
-            "monthlyTarget": {"count": mtd_count, "target": count_last_month},
-            "weeklyTrend": weekly_trend_percentage,
-            "weeklyTarget": {"count": wtd_count, "target": count_last_week},
-            "daily": await Message.get_today_count()
-        },
+        "data": await Message.get_card(mode),
         "status": True
     }
     return res
 
 
 @router.get("/top-part/users")
-async def get_users():
-    weekly_trend_percentage, (wtd_count, count_last_week) = await User.get_weekly_trend()
-    monthly_trend_percentage, (mtd_count, count_last_month) = await User.get_monthly_trend()
+async def get_users(mode: SummaryMode = Query(SummaryMode.ROLLUP)):
     res = {
-        "data": {
-            "total": await User.get_total_count(),
-            "monthlyTrend": monthly_trend_percentage,
-            "monthlyTarget": {"count": mtd_count, "target": count_last_month},
-            "weeklyTrend": weekly_trend_percentage,
-            "weeklyTarget": {"count": wtd_count, "target": count_last_week},
-            "daily": await User.get_today_count()
-        },
+        "data": await User.get_card(mode),
         "status": True
     }
     return res
 
 
 @router.get("/top-part/conversations")
-async def get_conversations():
-    weekly_trend_percentage, (wtd_count, count_last_week) = await Conversation.get_weekly_trend()
-    monthly_trend_percentage, (mtd_count, count_last_month) = await Conversation.get_monthly_trend()
+async def get_conversations(mode: SummaryMode = Query(SummaryMode.ROLLUP), exact: bool = Query(True)):
     res = {
-        "data": {
-            "total": await Conversation.get_total_count(),
-            "monthlyTrend": monthly_trend_percentage,
-            "monthlyTarget": {"count": mtd_count, "target": count_last_month},
-            "weeklyTrend": weekly_trend_percentage,
-            "weeklyTarget": {"count": wtd_count, "target": count_last_week},
-            "daily": await Conversation.get_today_count()
-        },
+        "data": await Conversation.get_card(mode, exact),
         "status": True
     }
     return res
 
 
 @router.get("/top-part/answer-rate")
-async def get_conversations():
-    weekly_answered_count, weekly_unanswered_count, weekly_total = await AnswerRate.get_weekly_answered_count()
-    monthly_answered_count, monthly_unanswered_count, monthly_total = await AnswerRate.get_monthly_answered_count()
-    total_answered_count, total_unanswered_count, total = await AnswerRate.get_total_answered_count()
+async def get_conversations(mode: SummaryMode = Query(SummaryMode.ROLLUP)):
     res = {
-        "data": {
-            "total": {"answered": total_answered_count,
-                      "unanswered": total_unanswered_count,
-                      "total": total,
-                      "rate": await AnswerRate.get_total_answered_rate()},
-            "monthly": {"answered": monthly_answered_count,
-                        "unanswered": monthly_unanswered_count,
-                        "total": monthly_total,
-                        "rate": await AnswerRate.get_monthly_answered_rate()},
-            "weekly": {"answered": weekly_answered_count,
-                       "unanswered": weekly_unanswered_count,
-                       "total": weekly_total,
-                       "rate": await AnswerRate.get_weekly_answered_rate()},
-        },
+        "data": await AnswerRate.get_card(mode),
         "status": True
     }
     return res
 
 
+MAX_HEATMAP_DAYS = 92
+
+
+def validate_since(since: list[date]) -> tuple[date, date]:
+    if len(since) != 2:
+        raise HTTPException(status_code=400, detail="since takes exactly two dates, the start and the end.")
+    start, end = since
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+
+def validate_trend_granularity(granularity: Granularity):
+    if granularity == Granularity.HOUR:
+        raise HTTPException(status_code=400, detail="Hourly buckets are only served by the activity heatmap.")
+
+
 @router.post("/middle-part/user-trend")
-async def user_trend(since: list[date]):
+async def user_trend(since: list[date], exact: bool = Query(True),
+                     granularity: Granularity = Query(Granularity.DAY)):
+    validate_since(since)
+    validate_trend_granularity(granularity)
     res = {
-        "data": await user_count_trend(since),
+        "data": await user_count_trend(since, exact=exact, granularity=granularity),
         "status": True
     }
     return res
 
 
 @router.post("/middle-part/message-trend")
-async def message_trend(since: list[date]):
+async def message_trend(since: list[date], granularity: Granularity = Query(Granularity.DAY)):
+    validate_since(since)
+    validate_trend_granularity(granularity)
     res = {
-        "data": await message_count_trend(since),
+        "data": await message_count_trend(since, granularity),
+        "status": True
+    }
+    return res
+
+
+@router.post("/middle-part/activity-heatmap")
+async def activity_heatmap(since: list[date]):
+    start, end = validate_since(since)
+    if (end - start).days >= MAX_HEATMAP_DAYS:
+        raise HTTPException(status_code=400, detail=f"The heatmap covers at most {MAX_HEATMAP_DAYS} days.")
+    res = {
+        "data": await message_activity_heatmap(since),
         "status": True
     }
     return res
 
 
 @router.post("/middle-part/conversation-trend")
-async def message_trend(since: list[date]):
+async def message_trend(since: list[date], exact: bool = Query(True),
+                        granularity: Granularity = Query(Granularity.DAY)):
+    validate_since(since)
+    validate_trend_granularity(granularity)
     res = {
-        "data": await conversation_count_trend(since),
+        "data": await conversation_count_trend(since, exact=exact, granularity=granularity),
         "status": True
     }
     return res
 
 
 @router.post("/middle-part/nlp-trend")
-async def message_trend(since: list[date]):
+async def message_trend(since: list[date], granularity: Granularity = Query(Granularity.DAY)):
+    validate_since(since)
+    validate_trend_granularity(granularity)
     res = {
-        "data": await nlp_confidence_trend(since),
+        "data": await nlp_confidence_trend(since, granularity),
         "status": True
     }
     return res
 
 
+@router.post("/middle-part/nlp-trend/rebuild")
+async def nlp_trend_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_confidence_sketches()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
 @router.post("/middle-part/top-question")
 async def message_trend(since: list[date]):
+    validate_since(since)
     res = {
         "data": await top_question(since),
         "status": True
@@ -143,10 +160,13 @@ async def message_trend(since: list[date]):
 
 
 @router.get("/bottom-part/questions-trend")
-async def trend_question(sort_by: str = Query(None, alias="sortBy")):
+async def trend_question(sort_by: str = Query(None, alias="sortBy"),
+                         window: int = Query(7, ge=1, le=90),
+                         recent_weight: float = Query(RECENT_DAY_WEIGHT, gt=0, le=1, alias="recentWeight")):
     # today = datetime.now()
     today = datetime(2020, 4, 12)
-    data, total_model, average_model = await question_ranking(today, sorter=sort_by)
+    data, total_model, average_model = await question_ranking(today, sorter=sort_by, window=window,
+                                                              recent_weight=recent_weight)
     res = {
         "data": {"table": data, "total": total_model, "average": average_model},
         "status": True
@@ -168,12 +188,64 @@ async def top_topics():
 
 
 @router.get("/bottom-part/word-cloud")
-async def word_cloud():
+async def word_cloud(since: Optional[list[date]] = Query(None),
+                     bigrams: bool = Query(False),
+                     limit: int = Query(80, ge=1, le=500)):
     today = datetime.now()
     today = datetime(2020, 4, 1)
+    if since:
+        start, end = validate_since(since)
+    else:
+        start, end = today.date() - timedelta(days=7), today.date() - timedelta(days=1)
     res = {
-        "data": await get_word_cloud(today),
+        "data": await get_word_cloud(start, end, bigrams=bigrams, limit=limit),
         "date": today,
         "status": True
     }
     return res
+
+
+@router.post("/bottom-part/word-cloud/rebuild")
+async def word_cloud_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_word_cloud()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/rollup/rebuild")
+async def rebuild_rollup(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_dashboard_daily()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.delete("/cache")
+async def clear_cache(metric: str = Query(None),
+                      current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await clear_day_cache(metric)
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/distinct-counters/rebuild")
+async def distinct_counters_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_distinct_counters()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/enrichment/rebuild")
+async def enrichment_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_enrichment()
+    return {
+        "status": status,
+        "success": True,
+    }
@@ -6,6 +6,7 @@ from pydantic import BaseModel
 
 from ..db_utils.flows import get_flow_one, get_flows_filtered_field_list, get_flows_and_count_db, \
     add_flows_to_db_from_flow, remove_flow_db, edit_flow_db
+from ..db_utils.pagination import CountMode
 from ..models.current_user import CurrentUserSchema
 from ..models.flow import FlowSchemaDbOut, GetFlowsTable, FlowItemCreateIn, DeleteFlows, FlowItemEditIn, FlowResponse
 from ..utils.security import get_current_active_user
@@ -34,15 +35,18 @@ async def get_flows(flow_name: Optional[str] = Query(None, alias="name"),
                     updated_at: Optional[list[date]] = Query(None, alias="updatedAt"),
                     current_page: int = Query(1, alias="current"), page_size: int = Query(20, alias="pageSize"),
                     triggered_counts: list[int] = Query(None, alias="triggeredCount"),
-                    sort_by: str = Query(None, alias="sortBy"), language: str = 'EN'):
-    flows, total = await get_flows_and_count_db(current_page=current_page, page_size=page_size,
+                    sort_by: str = Query(None, alias="sortBy"), language: str = 'EN',
+                    count_mode: CountMode = Query(CountMode.EXACT, alias="countMode")):
+    flows, count = await get_flows_and_count_db(current_page=current_page, page_size=page_size,
                                                 sorter=sort_by, flow_name=flow_name, language=language,
-                                                updated_at=updated_at, triggered_counts=triggered_counts)
+                                                updated_at=updated_at, triggered_counts=triggered_counts,
+                                                count_mode=count_mode)
 
     result = {
         "data": flows,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label
     }
     return result
 
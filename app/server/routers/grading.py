@@ -1,10 +1,20 @@
 from datetime import date
+from typing import Optional
 
-from fastapi import APIRouter, Query
+from bson import ObjectId
+from fastapi import APIRouter, Query, Depends, HTTPException
 
-from ..db_utils.grading import get_grading_messages_and_count_db, skip_message_db, update_message_db
+from ..db_utils.grading import get_grading_messages_and_count_db, skip_message_db, update_message_db, \
+    bulk_update_messages_db, get_grading_facets_db, TransactionsUnsupported
+from ..db_utils.grading_clusters import get_grading_clusters_db, apply_cluster_grading_db, \
+    rebuild_grading_clusters
+from ..db_utils.grading_queue import claim_grading_items, release_grading_items, rebuild_grading_queue, \
+    DEFAULT_LEASE_SECONDS, MAX_CLAIM
+from ..db_utils.pagination import CountMode
 from ..models.current_user import CurrentUserSchema
-from ..models.message import GetGradingsTable, SkipMessage, UpdateMessageResponse
+from ..models.message import GetGradingsTable, SkipMessage, UpdateMessageResponse, ClaimGradingsResponse, \
+    BulkUpdateMessageResponse, BulkGradingResponse, GetGradingFacets, GetGradingClustersTable, ApplyClusterGrading
+from ..utils.security import get_current_active_user
 
 router = APIRouter(
     tags=["gradings"],
@@ -20,20 +30,145 @@ async def get_gradings_message(topic: str = Query(None),
                                current_page: int = Query(1, alias="current"),
                                page_size: int = Query(20, alias="pageSize"),
                                question_status: str = Query(None, alias="questionStatus"),
-                               since: list[date] = Query(None)):
-    messages, total = await get_grading_messages_and_count_db(topic=topic, search_query=search_query,
+                               since: list[date] = Query(None),
+                               count_mode: CountMode = Query(CountMode.EXACT, alias="countMode")):
+    messages, count = await get_grading_messages_and_count_db(topic=topic, search_query=search_query,
                                                               accuracy=accuracy, question_status=question_status,
                                                               current_page=current_page, page_size=page_size,
-                                                              since=since)
+                                                              since=since,
+                                                              count_mode=count_mode)
 
     result = {
         "data": messages,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label
     }
     return result
 
 
+MAX_BULK_GRADINGS = 1000
+
+
+@router.get("/facets", response_model=GetGradingFacets)
+async def get_gradings_facets(topic: str = Query(None),
+                              search_query: str = Query(None, alias="text"),
+                              accuracy: list[float] = Query(None),
+                              question_status: str = Query(None, alias="questionStatus"),
+                              since: list[date] = Query(None)):
+    """
+    How many messages each filter value gives, for the same filters as the grading list
+    """
+    facets = await get_grading_facets_db(topic=topic, search_query=search_query, accuracy=accuracy,
+                                         question_status=question_status, since=since)
+    return {
+        "data": facets,
+        "success": True,
+    }
+
+
+@router.patch("/bulk", response_model=BulkGradingResponse)
+async def bulk_update_message_response(gradings: BulkUpdateMessageResponse,
+                                       current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    """
+    Grade many messages in one request, each grading gets its own result
+    """
+    if len(gradings.gradings) > MAX_BULK_GRADINGS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_GRADINGS} gradings per request")
+    try:
+        results, status = await bulk_update_messages_db(gradings.gradings, current_user,
+                                                        transaction=gradings.transaction)
+    except TransactionsUnsupported as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "data": results,
+        "success": True,
+        "status": status,
+    }
+
+
+@router.get("/clusters", response_model=GetGradingClustersTable, response_model_exclude_none=True)
+async def get_grading_clusters(current_page: int = Query(1, alias="current"),
+                               page_size: int = Query(20, alias="pageSize"),
+                               min_count: int = Query(2, alias="minCount", ge=1),
+                               count_mode: CountMode = Query(CountMode.EXACT, alias="countMode")):
+    """
+    Near duplicate unanswered messages grouped together, the largest groups first
+    """
+    clusters, count = await get_grading_clusters_db(current_page=current_page, page_size=page_size,
+                                                    min_count=min_count, count_mode=count_mode)
+    return {
+        "data": clusters,
+        "success": True,
+        "total": count.total,
+        "total_label": count.label
+    }
+
+
+@router.post("/clusters/rebuild")
+async def grading_clusters_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_grading_clusters()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/clusters/{cluster_id}/apply", response_model=BulkGradingResponse)
+async def apply_cluster_grading(cluster_id: str, grading: ApplyClusterGrading,
+                                current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    """
+    Grade every ungraded message of a cluster with one answer
+    """
+    try:
+        applied = ObjectId.is_valid(cluster_id) and await apply_cluster_grading_db(
+            cluster_id, grading.new_response, current_user, transaction=grading.transaction)
+    except TransactionsUnsupported as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not applied:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    results, status = applied
+    return {
+        "data": results,
+        "success": True,
+        "status": status,
+    }
+
+
+@router.post("/queue/claim", response_model=ClaimGradingsResponse, response_model_exclude_none=True)
+async def claim_gradings(count: int = Query(20, ge=1, le=MAX_CLAIM),
+                         lease_seconds: int = Query(DEFAULT_LEASE_SECONDS, alias="leaseSeconds", ge=30, le=3600),
+                         current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    """
+    Next messages to grade, leased to the caller until they are graded, skipped, released or the lease ends
+    """
+    messages, lease_until = await claim_grading_items(current_user, count=count, lease_seconds=lease_seconds)
+    return {
+        "data": messages,
+        "success": True,
+        "lease_until": lease_until
+    }
+
+
+@router.post("/queue/release")
+async def release_gradings(message_ids: Optional[list[str]] = Query(None, alias="messageIds"),
+                           current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await release_grading_items(current_user, message_ids)
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
+@router.post("/queue/rebuild")
+async def grading_queue_rebuild(current_user: CurrentUserSchema = Depends(get_current_active_user)):
+    status = await rebuild_grading_queue()
+    return {
+        "status": status,
+        "success": True,
+    }
+
+
 @router.delete("/")
 async def skip_questions(message: SkipMessage,
                          # current_user: CurrentUserSchema = Depends(get_current_active_user)
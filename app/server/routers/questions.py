@@ -4,14 +4,12 @@ from typing import Optional
 from fastapi import APIRouter, Query, Depends
 from pydantic import BaseModel
 
-from ..db_utils.flows import get_flow_one
+from ..db_utils.pagination import CountMode
 from ..db_utils.questions import get_questions_and_count_db, get_topics_db, add_question_db, remove_questions_db, \
     edit_question_db, get_question_filtered_field_list
 from ..models.current_user import CurrentUserSchema
 from ..models.question import GetQuestionsTable, QuestionIn, DeleteQuestion
-from ..utils.common import Status
 from ..utils.security import get_current_active_user
-from ..utils.timezone import get_local_datetime_now
 
 router = APIRouter(
     tags=["questions"],
@@ -29,29 +27,21 @@ async def get_questions(topic: Optional[str] = Query(None),
                         current_page: int = Query(1, alias="current"),
                         page_size: int = Query(20, alias="pageSize"),
                         triggered_counts: list[int] = Query(None, alias="triggeredCount"),
-                        language: str = 'EN'):
-    questions, total = await get_questions_and_count_db(current_page=current_page, page_size=page_size,
+                        language: str = 'EN',
+                        count_mode: CountMode = Query(CountMode.EXACT, alias="countMode")):
+    questions, count = await get_questions_and_count_db(current_page=current_page, page_size=page_size,
                                                         sorter=sort_by, topic=topic,
                                                         question_text=question_text, language=language,
                                                         updated_at=updated_at,
-                                                        triggered_counts=triggered_counts)
-
-    for q in questions:
-        q.status = Status.ACTIVE
-        if q.active_at:
-            if q.active_at <= get_local_datetime_now() <= q.expire_at:
-                q.status = Status.SCHEDULE
-            else:
-                q.status = Status.INACTIVE
-
-        for a in q.answers:
-            flow = await get_flow_one(a.flow['flow_id'])
-            q.answer_flow = flow
+                                                        triggered_counts=triggered_counts,
+                                                        count_mode=count_mode,
+                                                        resolve_answers=True)
 
     result = {
         "data": questions,
         "success": True,
-        "total": total
+        "total": count.total,
+        "total_label": count.label
     }
     return result
 
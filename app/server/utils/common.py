@@ -79,18 +79,6 @@ def form_pipeline(fields: list[tuple]) -> list[dict]:
     return pipeline
 
 
-def add_user_pipeline(source_field: str, destination_field: str) -> []:
-    """
-    # Retrieve the vlookup pipeline for portal user
-    :return:
-    """
-    return [{"$lookup": {"from": "portal_user",
-                         "localField": source_field,
-                         "foreignField": "_id",
-                         "as": destination_field}},
-            {"$unwind": f"${destination_field}"}]
-
-
 def to_camel(string: str) -> str:
     return stringcase.camelcase(string)
 
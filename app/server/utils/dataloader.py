@@ -0,0 +1,99 @@
+import asyncio
+from typing import Any, Hashable, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.core import AgnosticCollection
+
+from app.server.db.collections import question_collection, flow_collection, bot_user_collection, \
+    portal_user_collection
+from app.server.utils.pagination import get_dotted
+
+
+class DataLoader:
+    """
+    Documents of one collection by key. Every `load` made in the same event loop tick is answered by a single
+    `$in` query, each key is fetched at most once and the documents are kept for the life of the loader (one
+    request, see `get_loaders`).
+    .. code-block:: python
+        loader = DataLoader(flow_collection)
+        flows = await asyncio.gather(*(loader.load(flow_id) for flow_id in flow_ids))  # one query
+    """
+
+    def __init__(self, collection: AgnosticCollection, *, key: str = '_id', projection: dict = None):
+        """
+        :param key: field the documents are loaded by, string ids are converted to ObjectIds for `_id`
+        """
+        self.collection = collection
+        self.key = key
+        self.projection = projection
+        self.cache: dict[Hashable, asyncio.Future] = {}
+        self.pending: list[Hashable] = []
+        self.tasks: set[asyncio.Task] = set()  # the event loop only keeps weak references to tasks
+
+    def normalize(self, key: Any) -> Hashable:
+        if self.key == '_id' and isinstance(key, str):
+            try:
+                return ObjectId(key)
+            except InvalidId:
+                return key
+        return key
+
+    async def load(self, key: Any) -> Optional[dict]:
+        """
+        Document of `key`, None when there is none
+        """
+        key = self.normalize(key)
+        if (future := self.cache.get(key)) is None:
+            loop = asyncio.get_running_loop()
+            future = self.cache[key] = loop.create_future()
+            if not self.pending:
+                # runs once the loads already scheduled in this tick have queued their keys
+                loop.call_soon(self.schedule_dispatch)
+            self.pending.append(key)
+        return await asyncio.shield(future)
+
+    def schedule_dispatch(self):
+        task = asyncio.create_task(self.dispatch())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def load_many(self, keys: list[Any]) -> list[Optional[dict]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    async def dispatch(self):
+        keys, self.pending = self.pending, []
+        try:
+            cursor = self.collection.find({self.key: {"$in": keys}}, projection=self.projection)
+            documents = {get_dotted(document, self.key): document async for document in cursor}
+        except Exception as e:
+            for key in keys:
+                # not cached, a later load tries again
+                self.cache.pop(key).set_exception(e)
+            return
+        for key in keys:
+            self.cache[key].set_result(documents.get(key))
+
+
+class Loaders:
+    """
+    Request scoped loaders of the collections routers commonly resolve ids of
+    """
+
+    def __init__(self):
+        self.question = DataLoader(question_collection)
+        self.flow = DataLoader(flow_collection)
+        self.bot_user = DataLoader(bot_user_collection)
+        self.bot_user_by_facebook_id = DataLoader(bot_user_collection, key='facebook.id')
+        self.portal_user = DataLoader(portal_user_collection, projection={"password": 0, "password_history": 0})
+
+
+def get_loaders() -> Loaders:
+    """
+    FastAPI dependency, every request gets its own loaders so nothing is cached across requests
+    .. code-block:: python
+        @router.get("/")
+        async def get_items(loaders: Loaders = Depends(get_loaders)):
+            flow = await loaders.flow.load(flow_id)
+    """
+    return Loaders()
@@ -0,0 +1,56 @@
+import math
+from hashlib import blake2b
+from typing import Any, Iterable
+
+
+class HyperLogLog:
+    """
+    Distinct counter with a fixed 2^precision bytes footprint, about 1.04 / sqrt(2^precision) relative error
+    (1.6% with the default 4KB). Counters merge by register-wise max, so daily counters combine into the distinct
+    count of any range without double counting.
+    """
+
+    def __init__(self, precision: int = 12, registers: bytes = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(f"Expected {self.size} registers, got {len(self.registers)}")
+
+    @classmethod
+    def from_bytes(cls, registers: bytes) -> 'HyperLogLog':
+        return cls(int(math.log2(len(registers))), registers)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    def add(self, value: Any):
+        hashed = int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable[Any]) -> 'HyperLogLog':
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        if other.size != self.size:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        raw = alpha * self.size ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * self.size and zeros:
+            # small range correction (linear counting)
+            return round(self.size * math.log(self.size / zeros))
+        return round(raw)
+
+    def __len__(self):
+        return self.estimate()
@@ -0,0 +1,81 @@
+import random
+from hashlib import blake2b
+from typing import Iterable
+
+from app.server.utils.tokenizer import tokenize, STOP_WORDS
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+# chat shorthand spelled out before shingling, so 'reset pw' and 'reset password' are the same question
+WORD_SYNONYMS = {
+    "pw": "password", "pwd": "password", "passwd": "password", "acct": "account", "info": "information",
+    "msg": "message", "addr": "address", "appt": "appointment", "dept": "department", "reg": "registration",
+    "ur": "your", "pls": "please", "plz": "please", "thx": "thanks",
+}
+
+
+def text_words(text: str) -> list[str]:
+    """
+    Normalized words of a text with shorthand spelled out, stop words left out unless nothing else is left
+    """
+    tokens = [WORD_SYNONYMS.get(token, token) for token in tokenize(text)]
+    return [token for token in tokens if token not in STOP_WORDS] or tokens
+
+
+def text_shingles(text: str, size: int = 3) -> set[str]:
+    """
+    Every word of a text plus the character shingles within each word. Whole words weigh the wording, shingles
+    within words make 'library' and 'libary' overlap, which whole words would not.
+    """
+    shingles = set()
+    for word in text_words(text):
+        padded = f" {word} "
+        shingles.add(word)
+        shingles.update(padded[i:i + size] for i in range(len(padded) - size + 1))
+    return shingles
+
+
+class MinHash:
+    """
+    Fixed size signatures whose share of equal values estimates the Jaccard similarity of two shingle sets, plus
+    the locality sensitive hashing (LSH) band keys that make similar signatures land in a common bucket.
+    With 128 values in 32 bands of 4 rows, sets 40% similar share a band half of the time, 60% similar ones
+    almost always.
+    .. code-block:: python
+        minhash = MinHash()
+        signature = minhash.signature(text_shingles("how do i reset my password?"))
+        keys = minhash.band_keys(signature)
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("The number of permutations must be a multiple of the number of bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        # the same seed gives the same permutations in every process, stored signatures stay comparable
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+
+    def signature(self, shingles: Iterable[str]) -> list[int]:
+        hashes = [int.from_bytes(blake2b(shingle.encode(), digest_size=4).digest(), 'big') for shingle in
+                  set(shingles)]
+        if not hashes:
+            return [MAX_HASH] * len(self.permutations)
+        return [min(((a * value + b) % MERSENNE_PRIME) & MAX_HASH for value in hashes) for a, b in self.permutations]
+
+    def band_keys(self, signature: list[int]) -> list[str]:
+        """
+        One key per band, two signatures with an equal band share its key
+        """
+        keys = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            keys.append(f"{band}:{blake2b(repr(rows).encode(), digest_size=8).hexdigest()}")
+        return keys
+
+    @staticmethod
+    def similarity(signature: list[int], other: list[int]) -> float:
+        return sum(a == b for a, b in zip(signature, other)) / len(signature)
@@ -0,0 +1,69 @@
+import base64
+import binascii
+from typing import Any, Optional
+
+from bson import json_util
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values: list[Any]) -> str:
+    """
+    Opaque token of the sort key values (ending with `_id`) of the last item of a page
+    """
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> list[Any]:
+    """
+    Sort key values of a cursor from `encode_cursor`, ObjectIds and datetimes come back as such
+    :param length: number of sort keys the listing uses, a cursor of another listing is rejected
+    """
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Malformed cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor("Cursor does not belong to this listing")
+    return values
+
+
+def keyset_query(sort: list[tuple[str, int]], values: list[Any]) -> dict:
+    """
+    Query of the items strictly after `values` in `sort` order. The last sort key must be unique (`_id`) so the
+    order is total and no item is repeated or skipped between pages.
+    .. code-block:: python
+        keyset_query([("received_at", -1), ("_id", -1)], [received_at, _id])
+        # {"$or": [{"received_at": {"$lt": received_at}}, {"received_at": received_at, "_id": {"$lt": _id}}]}
+    """
+    branches = []
+    for index, (key, direction) in enumerate(sort):
+        value = values[index]
+        branch = {previous: values[i] for i, (previous, _) in enumerate(sort[:index])}
+        if value is None:
+            # null sorts first, nothing is before it and everything else is after it
+            if direction == -1:
+                continue
+            branch[key] = {"$ne": None}
+        else:
+            branch[key] = {"$lt" if direction == -1 else "$gt": value}
+        branches.append(branch)
+    return {"$or": branches} if len(branches) > 1 else branches[0] if branches else {"_id": {"$exists": False}}
+
+
+def next_cursor(items: list[dict], sort: list[tuple[str, int]], page_size: int) -> Optional[str]:
+    """
+    Cursor of the page after `items` (raw documents), None on the last page
+    """
+    if len(items) < page_size:
+        return None
+    last = items[-1]
+    return encode_cursor([get_dotted(last, key) for key, _ in sort])
+
+
+def get_dotted(doc: dict, path: str) -> Any:
+    for key in path.split('.'):
+        doc = doc.get(key) if isinstance(doc, dict) else None
+    return doc
@@ -0,0 +1,29 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+def run_periodically(job: Callable[[], Awaitable], *, interval: float) -> asyncio.Task:
+    """
+    Run `job` on the current event loop every `interval` seconds until the app shuts down.
+    A failing run is logged and retried on the next tick instead of killing the loop.
+    .. code-block:: python
+        @app.on_event('startup')
+        async def startup():
+            run_periodically(refresh_dashboard_daily, interval=60)
+    :param job: coroutine function without arguments
+    :param interval: seconds to sleep between two runs
+    :return: the asyncio task driving the job
+    """
+
+    async def loop():
+        while True:
+            try:
+                await job()
+            except Exception:
+                logger.exception("Periodic job %s failed", job.__name__)
+            await asyncio.sleep(interval)
+
+    return asyncio.create_task(loop())
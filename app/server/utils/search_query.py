@@ -0,0 +1,72 @@
+import math
+import re
+from enum import Enum
+from typing import NamedTuple
+
+from app.server.utils.tokenizer import tokenize
+
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class ClauseKind(str, Enum):
+    TERM = 'term'
+    PREFIX = 'prefix'  # word*
+    PHRASE = 'phrase'  # "several words"
+
+
+class SearchClause(NamedTuple):
+    kind: ClauseKind
+    terms: tuple[str, ...]
+
+
+def parse_search_query(text: str) -> list[SearchClause]:
+    """
+    Clauses of a search box query, all of which a message has to match.
+    .. code-block:: python
+        parse_search_query('"opening hours" libr*')
+        # [SearchClause(PHRASE, ('opening', 'hours')), SearchClause(PREFIX, ('libr',))]
+    Words are normalized like indexed text, so a word the tokenizer splits (e.g. 'e-mail') becomes a phrase.
+    """
+    clauses = []
+    for phrase, word in QUERY_PATTERN.findall(text or ''):
+        is_prefix = not phrase and word.endswith('*')
+        tokens = tuple(tokenize(phrase or word.rstrip('*')))
+        if not tokens:
+            continue
+        if len(tokens) > 1:
+            clauses.append(SearchClause(ClauseKind.PHRASE, tokens))
+        else:
+            clauses.append(SearchClause(ClauseKind.PREFIX if is_prefix else ClauseKind.TERM, tokens))
+    return clauses
+
+
+def contains_phrase(positions: list[list[int]], offsets: list[int] = None) -> bool:
+    """
+    Whether the words whose positions are given in phrase order appear at their `offsets` in the phrase, next to
+    each other when no offsets are given (offsets skip the words of a phrase that are not indexed)
+    """
+    offsets = offsets or list(range(len(positions)))
+    following = [(offset - offsets[0], set(p)) for offset, p in zip(offsets[1:], positions[1:])]
+    return any(all(start + offset in p for offset, p in following) for start in positions[0])
+
+
+def bm25_idf(document_frequency: int, documents: int) -> float:
+    return math.log(1 + (documents - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+def bm25_impact(term_frequency: int, document_length: int, average_length: float) -> float:
+    """
+    Okapi BM25 weight of one term in one message without the term's idf, which only depends on the message
+    """
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * document_length / (average_length or 1))
+    return term_frequency * (BM25_K1 + 1) / (term_frequency + norm)
+
+
+def bm25(term_frequency: int, document_frequency: int, document_length: int, documents: int,
+         average_length: float) -> float:
+    """
+    Okapi BM25 weight of one term in one message
+    """
+    return bm25_idf(document_frequency, documents) * bm25_impact(term_frequency, document_length, average_length)
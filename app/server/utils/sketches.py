@@ -0,0 +1,85 @@
+from typing import Optional
+
+
+class ConfidenceSketch:
+    """
+    Mergeable quantile sketch for scores in [0, 1], such as NLP confidences.
+    Because the domain is bounded, a fixed grid of BINS buckets gives what a t-digest or KLL sketch would, with a
+    guaranteed rank error below 1 / BINS, exact merges (bucket counts add up) and a size that never grows with
+    the number of values. Buckets are stored sparsely, keyed by their index as a string so they fit in a document.
+    """
+    BINS = 1000
+
+    def __init__(self, *, count: int = 0, total: float = 0.0, minimum: float = None, maximum: float = None,
+                 bins: dict[str, int] = None):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.bins = dict(bins or {})
+
+    @classmethod
+    def from_document(cls, doc: Optional[dict]) -> 'ConfidenceSketch':
+        if not doc:
+            return cls()
+        return cls(count=doc.get('count', 0), total=doc.get('sum', 0.0), minimum=doc.get('min'),
+                   maximum=doc.get('max'), bins=doc.get('bins'))
+
+    def bin_of(self, value: float) -> str:
+        return str(min(max(int(value * self.BINS), 0), self.BINS - 1))
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        key = self.bin_of(value)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other: 'ConfidenceSketch') -> 'ConfidenceSketch':
+        self.count += other.count
+        self.total += other.total
+        for bound, pick in (('minimum', min), ('maximum', max)):
+            values = [v for v in (getattr(self, bound), getattr(other, bound)) if v is not None]
+            setattr(self, bound, pick(values) if values else None)
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        return self
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Value below which a fraction `q` of the values lie, interpolated inside its bucket
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for index in sorted(int(key) for key in self.bins):
+            count = self.bins[str(index)]
+            if cumulative + count >= target:
+                value = (index + (target - cumulative) / count) / self.BINS
+                return min(max(value, self.minimum), self.maximum)
+            cumulative += count
+        return self.maximum
+
+    def histogram(self, buckets: int = 10) -> list[int]:
+        """
+        Number of values in each of `buckets` equal-width ranges of [0, 1]
+        """
+        res = [0] * buckets
+        for key, count in self.bins.items():
+            res[int(key) * buckets // self.BINS] += count
+        return res
+
+    def to_update(self) -> dict:
+        """
+        MongoDB update merging this sketch into a stored one
+        """
+        update = {"$inc": {"count": self.count, "sum": self.total} | {f"bins.{k}": c for k, c in self.bins.items()}}
+        if self.count:
+            update |= {"$min": {"min": self.minimum}, "$max": {"max": self.maximum}}
+        return update
@@ -0,0 +1,63 @@
+import re
+import unicodedata
+from typing import Iterable
+
+from app.server.routers.word_cloud.stop_words import default_stop_words
+
+TOKEN_PATTERN = re.compile(r"[\w'’]+")
+STOP_WORDS = frozenset(default_stop_words)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase and fold accents, so 'Café' and 'cafe' become the same token
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split a message into normalized word tokens, keeping inner apostrophes ("don't") and dropping 1-letter tokens
+    """
+    if not text:
+        return []
+    tokens = (token.strip("'’") for token in TOKEN_PATTERN.findall(normalize_text(text)))
+    return [token for token in tokens if len(token) > 1]
+
+
+def name_tokens(text: str) -> list[str]:
+    """
+    Normalized words of a person's name, single letters included so initials are searchable
+    """
+    if not text:
+        return []
+    return [token for token in (t.strip("'’") for t in TOKEN_PATTERN.findall(normalize_text(text))) if token]
+
+
+def prefix_tokens(tokens: Iterable[str], max_length: int = 15) -> list[str]:
+    """
+    Every prefix of every token up to `max_length` characters, so a multikey index answers search-as-you-type
+    """
+    prefixes = set()
+    for token in tokens:
+        prefixes.update(token[:length] for length in range(1, min(len(token), max_length) + 1))
+    return sorted(prefixes)
+
+
+def word_cloud_terms(text: str, *, stop_words: Iterable[str] = STOP_WORDS) -> list[tuple[int, str]]:
+    """
+    (n, term) of every unigram and bigram of a message worth showing in a word cloud. Stop words are skipped and
+    a bigram is only formed by two adjacent non stop words.
+    """
+    terms = []
+    previous = None
+    for token in tokenize(text):
+        if token in stop_words or token.isdigit():
+            previous = None
+            continue
+        terms.append((1, token))
+        if previous:
+            terms.append((2, f"{previous} {token}"))
+        previous = token
+    return terms